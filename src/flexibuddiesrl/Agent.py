@@ -4,9 +4,21 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 from .Util import T
+from .Checkpoint import save_checkpoint, load_checkpoint, save_async
+from .Instrumentation import PhaseTimer, Diagnostics, memory_report, _networks
 
 
 class Agent(ABC):
+    # set to a Metrics (see Metrics.py) to publish update counts, losses,
+    # exploration and learning rate gauges from the training calls
+    metrics = None
+    # set to True to compute grad norms, PPO's approximate kl / clip fraction,
+    # critic explained variance and Q statistics on device during every
+    # reinforcement_learn call, read back once into last_diagnostics
+    diagnostics = False
+    last_diagnostics = None
+    # set with set_obs_codec when observations are stored quantized
+    obs_codec = None
 
     @abstractmethod
     def train_actions(
@@ -46,6 +58,30 @@ class Agent(ABC):
         y: float = 0.0
         return float(x), float(y)  # loss
 
+    @abstractmethod
+    def imitation_loss(
+        self,
+        observations,
+        continuous_actions=None,
+        discrete_actions=None,
+        action_mask=None,
+    ):
+        """
+        (discrete loss, continuous loss) of one batch of demonstrations
+        without touching the optimizer. imitation_learn and
+        Imitation.ImitationTrainer are built on it.
+        """
+        return 0.0, 0.0
+
+    def _imitation_optimizer(self):
+        # the optimizer imitation gradients are applied with
+        return self.optimizer
+
+    def _imitation_step(self):
+        # apply the accumulated imitation gradients, agents with grad
+        # clipping or target networks extend this
+        self._imitation_optimizer().step()
+
     @abstractmethod
     def utility_function(self, observations, actions=None):
         return 0  # Returns the single-agent critic for a single action.
@@ -70,6 +106,63 @@ class Agent(ABC):
     def load(self, checkpoint_path):
         print("Load not implemented")
 
+    def save_checkpoint(self, path):
+        # single memory-mappable file, see Checkpoint.py for the layout
+        save_checkpoint(self, path)
+
+    def load_checkpoint(self, path, mmap=True, restore_rng=True):
+        return load_checkpoint(self, path, mmap=mmap, restore_rng=restore_rng)
+
+    def save_async(self, path):
+        # snapshot now, write + fsync + rename on a background thread
+        return save_async(self, path)
+
+    def memory_report(self, batch=None, agent_num=0, inplace=False):
+        # bytes per network / optimizer / grads / buffers, with a batch also
+        # the peak activation memory of one reinforcement_learn call
+        return memory_report(self, batch, agent_num, inplace)
+
+    def set_obs_codec(self, codec):
+        """
+        Declare the ObsCodec (see Util.py) the observations handed to this
+        agent are encoded with, or None for float observations. Every encoder
+        and critic that reads observations decodes them in its first layer.
+        The codec is configuration, not network state: checkpoints are
+        unchanged and it has to be set again after load rebuilds networks.
+        """
+        self.obs_codec = codec
+        for name, net in _networks(self).items():
+            if isinstance(net, list):
+                continue
+            for m in net.modules():
+                if isinstance(m, (ffEncoder, ValueS, ValueSA)):
+                    m.obs_codec = codec
+                elif isinstance(m, (MixedActor, StochasticActor, QS)):
+                    if m.encoder is None and codec is not None:
+                        raise ValueError(
+                            f"{name} reads observations without an encoder, "
+                            "give it hidden dims to decode them"
+                        )
+
+    def _publish_diagnostics(self, diag: Diagnostics):
+        self.last_diagnostics = diag.fetch()
+        if self.metrics is not None:
+            for k, v in self.last_diagnostics.items():
+                self.metrics.set(k, v)
+
+    @property
+    def timer(self) -> PhaseTimer:
+        # created on first use so agents never need to call super().__init__
+        t = self.__dict__.get("_timer")
+        if t is None:
+            t = PhaseTimer()
+            self.__dict__["_timer"] = t
+        return t
+
+    @timer.setter
+    def timer(self, t: PhaseTimer):
+        self.__dict__["_timer"] = t
+
 
 def _orthogonal_init(layer, std=np.sqrt(2), bias_const=0.0):
     torch.nn.init.orthogonal_(layer.weight, std)
@@ -78,6 +171,8 @@ def _orthogonal_init(layer, std=np.sqrt(2), bias_const=0.0):
 
 
 class ffEncoder(nn.Module):
+    obs_codec = None  # see Agent.set_obs_codec
+
     def __init__(
         self,
         obs_dim,
@@ -115,7 +210,11 @@ class ffEncoder(nn.Module):
     def forward(self, x, debug=False):
         if debug:
             print(f"ffEncoder: x {x}")
-        x = T(x, self.device).float()
+        if self.obs_codec is not None:
+            # compact dtype over the transfer, float32 from the first layer on
+            x = self.obs_codec.decode(torch.as_tensor(x, device=self.device))
+        else:
+            x = T(x, self.device).float()
         if debug:
             print(f"ffEncoder after T: x {x}")
             interlist = []
@@ -245,6 +344,25 @@ class MixedActor(nn.Module):
 
         return continuous_actions, discrete_actions
 
+    def imitation_loss(
+        self, x, continuous_actions=None, discrete_actions=None, action_mask=None
+    ):
+        """
+        Behaviour cloning loss of the deterministic actions: mse to the
+        demonstrated continuous actions and cross entropy of each discrete
+        head's softmax against the demonstrated index
+        """
+        c_act, d_act = self.forward(x, action_mask=action_mask, gumbel=False)
+        discrete_loss, continuous_loss = 0, 0
+        if c_act is not None and continuous_actions is not None:
+            continuous_loss = F.mse_loss(c_act, continuous_actions)
+        if discrete_actions is not None:
+            for i, probs in enumerate(d_act or []):
+                discrete_loss += F.nll_loss(
+                    torch.log(probs + 1e-8), discrete_actions[..., i].long()
+                )
+        return discrete_loss, continuous_loss
+
 
 class StochasticActor(nn.Module):
     def __init__(
@@ -603,13 +721,9 @@ class StochasticActor(nn.Module):
                     assert (
                         c_dist is not None
                     ), "Somehow we want log probs from a distirbution that doesn't exist"
-                    print(c_dist.log_prob(continuous_activations))
                     continuous_log_probs = c_dist.log_prob(continuous_activations).sum(
                         axis=-1
                     )
-            print(
-                f"{self.clamp_type} Continuous actions: {continuous_actions}, log probs: {continuous_log_probs} from  {c_dist.log_prob(continuous_activations) if c_dist is not None else None} continuous_activations: {continuous_activations}, means: {continuous_means}, stds: {torch.exp(continuous_log_std_logits) if continuous_log_std_logits is not None else None}"
-            )
         if self.discrete_action_dims is not None and len(self.discrete_action_dims) > 0:
             assert (
                 discrete_logits is not None
@@ -675,6 +789,8 @@ class StochasticActor(nn.Module):
 
 
 class ValueSA(nn.Module):
+    obs_codec = None
+
     def __init__(
         self, obs_dim, action_dim, hidden_dim=256, device="cpu", activation="relu"
     ):
@@ -694,6 +810,8 @@ class ValueSA(nn.Module):
     def forward(self, x, u, debug=False):
         if debug:
             print(f"ValueSA: x {x}, u {u}")
+        if self.obs_codec is not None:
+            x = self.obs_codec.decode(x)
         x = self.activation(self.l1(torch.cat([x, u], -1)))
         x = self.activation(self.l2(x))
         x = self.l3(x)
@@ -701,6 +819,8 @@ class ValueSA(nn.Module):
 
 
 class ValueS(nn.Module):
+    obs_codec = None
+
     def __init__(
         self,
         obs_dim,
@@ -728,7 +848,10 @@ class ValueS(nn.Module):
         self.to(device)
 
     def forward(self, x):
-        x = T(x, self.device)
+        if self.obs_codec is not None:
+            x = self.obs_codec.decode(torch.as_tensor(x, device=self.device))
+        else:
+            x = T(x, self.device)
         x = self.activation(self.l1(x))
         x = self.activation(self.l2(x))
         x = self.l3(x)
@@ -0,0 +1,678 @@
+import subprocess
+import sys
+import os
+import json
+import hashlib
+import time
+import platform
+import traceback
+import numpy as np
+
+_IMPORT_SNIPPET = """
+import time
+s = time.perf_counter()
+import flexibuddiesrl
+t_pkg = time.perf_counter() - s
+{access}
+t_total = time.perf_counter() - s
+print(t_pkg, t_total)
+"""
+
+
+def import_time(attrs=(), repeats=10, python=sys.executable):
+    """
+    Cold import time of flexibuddiesrl, measured in fresh interpreters since
+    a worker process pays it once on startup. attrs are accessed right after
+    the import, e.g. ("DQN",) times what an actor that only needs DQN pays.
+    Returns {"package_ms": {...}, "total_ms": {...}} with median / min / max.
+    """
+    access = "\n".join(f"flexibuddiesrl.{a}" for a in attrs)
+    snippet = _IMPORT_SNIPPET.format(access=access)
+    pkg, total = [], []
+    for _ in range(repeats):
+        out = subprocess.run(
+            [python, "-c", snippet], capture_output=True, text=True, check=True
+        ).stdout.split()
+        pkg.append(float(out[0]) * 1000)
+        total.append(float(out[1]) * 1000)
+
+    def stats(x):
+        return {
+            "median": float(np.median(x)),
+            "min": float(np.min(x)),
+            "max": float(np.max(x)),
+        }
+
+    return {"attrs": list(attrs), "package_ms": stats(pkg), "total_ms": stats(total)}
+
+
+def machine_info():
+    import torch
+
+    return {
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "torch_threads": torch.get_num_threads(),
+    }
+
+
+def synthetic_batch(
+    n, obs_dim, continuous_action_dim, discrete_action_dims, device="cpu"
+):
+    """A random time ordered FlexiBatch of n transitions for one agent"""
+    from flexibuff import FlexiBatch
+
+    ddims = discrete_action_dims or []
+    rv = {
+        "obs": np.random.rand(1, n, obs_dim).astype(np.float32),
+        "obs_": np.random.rand(1, n, obs_dim).astype(np.float32),
+        "global_rewards": np.random.rand(n).astype(np.float32),
+        "discrete_actions": np.stack(
+            [np.random.randint(0, d, size=(1, n)) for d in ddims] or [np.zeros((1, n))],
+            axis=-1,
+        ).astype(np.int64),
+        "discrete_log_probs": -np.random.rand(1, n, max(1, len(ddims))).astype(
+            np.float32
+        ),
+        "continuous_actions": np.random.uniform(
+            -0.5, 0.5, size=(1, n, max(1, continuous_action_dim))
+        ).astype(np.float32),
+        "continuous_log_probs": -np.random.rand(
+            1, n, max(1, continuous_action_dim)
+        ).astype(np.float32),
+    }
+    batch = FlexiBatch(
+        registered_vals=rv,
+        terminated=(np.random.rand(n) < 0.05).astype(np.float32),
+    )
+    batch.to_torch(device)
+    return batch
+
+
+def benchmark_agents(obs_dim=8, continuous_action_dim=2, discrete_action_dims=[3, 4]):
+    """
+    {name: constructor} for every configuration the suites cover: DQN in each
+    dqntype mode, PPO with each advantage_type, TD3 and DDPG. Constructors
+    are returned instead of agents so each benchmark starts from a fresh one.
+    """
+    from .DQN import DQN
+    from .PG_stabalized import PG
+    from .TD3 import TD3
+    from .DDPG import DDPG
+
+    common = dict(
+        obs_dim=obs_dim,
+        discrete_action_dims=discrete_action_dims,
+        max_actions=np.ones(continuous_action_dim, dtype=np.float32),
+        min_actions=-np.ones(continuous_action_dim, dtype=np.float32),
+        hidden_dims=[64, 64],
+        device="cpu",
+    )
+    agents = {}
+    for mode, kw in [
+        ("egreedy", {}),
+        ("soft", {"entropy": 0.1}),
+        ("munchausen", {"entropy": 0.1, "munchausen": 0.9}),
+    ]:
+        agents[f"DQN-{mode}"] = lambda kw=kw: DQN(
+            continuous_action_dims=continuous_action_dim, **common, **kw
+        )
+    for adv in ["gae", "a2c", "constant", "gv", "g"]:
+        agents[f"PG-{adv}"] = lambda adv=adv: PG(
+            continuous_action_dim=continuous_action_dim,
+            advantage_type=adv,
+            **common,
+        )
+    agents["TD3"] = lambda: TD3(
+        continuous_action_dim=continuous_action_dim, rand_steps=0, **common
+    )
+    agents["DDPG"] = lambda: DDPG(
+        continuous_action_dim=continuous_action_dim, rand_steps=0, **common
+    )
+    return agents
+
+
+def latency_stats(times):
+    """p50 / p99 / mean in milliseconds from a list of seconds"""
+    t = np.asarray(times) * 1000
+    return {
+        "p50_ms": float(np.percentile(t, 50)),
+        "p99_ms": float(np.percentile(t, 99)),
+        "mean_ms": float(t.mean()),
+        "n": int(t.shape[0]),
+    }
+
+
+def time_calls(fn, budget_s=0.5, min_calls=20, max_calls=2000, warmup=3):
+    """Calls fn until budget_s has passed (within min / max calls), returns seconds per call"""
+    for _ in range(warmup):
+        fn()
+    times = []
+    start = time.perf_counter()
+    while len(times) < max_calls and (
+        len(times) < min_calls or time.perf_counter() - start < budget_s
+    ):
+        s = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - s)
+    return times
+
+
+# metrics an agent does not implement yet, recorded as unsupported instead of
+# timing a stub
+UNSUPPORTED = {"DQN": ["ego_actions"]}
+
+
+def micro_benchmarks(
+    agents=None,
+    batch_sizes=(1, 32, 1024),
+    rl_batch_size=256,
+    imitation_batch_size=256,
+    budget_s=0.5,
+    obs_dim=8,
+    continuous_action_dim=2,
+    discrete_action_dims=[3, 4],
+    verbose=False,
+):
+    """
+    Cpu micro benchmarks on synthetic data. For every agent configuration:
+        train_actions.b{B} / ego_actions.b{B}: latency for B observations
+        reinforcement_learn: latency per call and updates_per_s
+        imitation_learn: latency per call and samples_per_s
+    A metric that raises records {"error": ...} instead of stopping the run,
+    one the agent does not implement (see UNSUPPORTED) {"unsupported": ...}.
+    Returns {"meta": machine_info(), "results": {agent: {metric: stats}}}.
+    """
+    if agents is None:
+        agents = benchmark_agents(obs_dim, continuous_action_dim, discrete_action_dims)
+    rl_batch = synthetic_batch(
+        rl_batch_size, obs_dim, continuous_action_dim, discrete_action_dims
+    )
+    il_batch = synthetic_batch(
+        imitation_batch_size, obs_dim, continuous_action_dim, discrete_action_dims
+    )
+    results = {}
+    for name, make in agents.items():
+        agent = make()
+        res = {}
+        unsupported = UNSUPPORTED.get(type(agent).__name__, [])
+
+        def run(metric, fn, per_call=None):
+            method = metric.split(".")[0]
+            if method in unsupported:
+                res[metric] = {
+                    "unsupported": f"{type(agent).__name__}.{method} is not implemented"
+                }
+                return
+            try:
+                stats = latency_stats(time_calls(fn, budget_s=budget_s))
+                if per_call is not None:
+                    stats[per_call[0]] = per_call[1] * 1000 / stats["mean_ms"]
+                res[metric] = stats
+            except Exception as e:
+                res[metric] = {"error": f"{type(e).__name__}: {e}"}
+                if verbose:
+                    traceback.print_exc()
+            if verbose:
+                print(f"{name}.{metric}: {res[metric]}")
+
+        for b in batch_sizes:
+            obs = np.random.rand(b, obs_dim).astype(np.float32)
+            if b == 1:
+                obs = obs[0]
+            run(f"train_actions.b{b}", lambda: agent.train_actions(obs, step=False))
+            run(f"ego_actions.b{b}", lambda: agent.ego_actions(obs))
+        run(
+            "reinforcement_learn",
+            lambda: agent.reinforcement_learn(rl_batch, 0),
+            per_call=("updates_per_s", 1),
+        )
+        run(
+            "imitation_learn",
+            lambda: agent.imitation_learn(
+                il_batch.obs[0],
+                il_batch.continuous_actions[0],
+                il_batch.discrete_actions[0],
+            ),
+            per_call=("samples_per_s", imitation_batch_size),
+        )
+        results[name] = res
+    return {"meta": machine_info(), "results": results}
+
+
+def env_agents(env_id):
+    """
+    {name: constructor} for the end to end benchmark on a classic control env.
+    CartPole is driven by a discrete head, Pendulum by one continuous action.
+    TD3 / DDPG need both a continuous and a discrete head, so they carry an
+    unused one of each the same way test.py builds its joint agents.
+    """
+    from .DQN import DQN
+    from .PG_stabalized import PG
+    from .TD3 import TD3
+    from .DDPG import DDPG
+
+    discrete = env_id == "CartPole-v1"
+    obs_dim = 4 if discrete else 3
+    bound = 1.0 if discrete else 2.0
+    bounds = dict(
+        max_actions=np.full(1, bound, dtype=np.float32),
+        min_actions=np.full(1, -bound, dtype=np.float32),
+    )
+    common = dict(obs_dim=obs_dim, hidden_dims=[64, 64], device="cpu", **bounds)
+    ddims = [2] if discrete else None
+    cdim = 0 if discrete else 1
+    return {
+        "DQN": lambda: DQN(
+            discrete_action_dims=ddims,
+            continuous_action_dims=cdim,
+            n_c_action_bins=9,
+            **common,
+        ),
+        "PG": lambda: PG(
+            discrete_action_dims=ddims, continuous_action_dim=cdim, **common
+        ),
+        # rand_steps=0 so the short env_benchmark runs time the policy, not
+        # the random warmup
+        "TD3": lambda: TD3(
+            discrete_action_dims=[2], continuous_action_dim=1, rand_steps=0, **common
+        ),
+        "DDPG": lambda: DDPG(
+            discrete_action_dims=[2], continuous_action_dim=1, rand_steps=0, **common
+        ),
+    }
+
+
+def env_benchmark(
+    make_agent,
+    env_id="CartPole-v1",
+    n_steps=2000,
+    online=False,
+    batch_size=256,
+    rollout_len=512,
+    learning_starts=256,
+    train_every=1,
+    seed=0,
+):
+    """
+    Runs the train loop from test.py (act, step, save_transition, learn) on a
+    local gymnasium env and times each part of it.
+    online: PPO style, learn on the whole buffer every rollout_len steps and
+        clear it, otherwise sample batch_size transitions every train_every
+        steps once learning_starts transitions are stored.
+    Returns env steps/s, updates/s and the fraction of wall time spent in
+    act (train_actions), env (step / reset), buffer (save / sample) and
+    learn (reinforcement_learn), plus whatever is left as other.
+    """
+    import gymnasium as gym
+    from flexibuff import FlexibleBuffer
+
+    agent = make_agent()
+    env = gym.make(env_id)
+    discrete = isinstance(env.action_space, gym.spaces.Discrete)
+    obs_dim = env.observation_space.shape[0]
+    ddims = getattr(agent, "discrete_action_dims", None) or []
+    cdim = getattr(agent, "continuous_action_dim", None)
+    if cdim is None:
+        cdim = getattr(agent, "continuous_action_dims", 0)
+    buffer = FlexibleBuffer(
+        num_steps=rollout_len if online else max(n_steps, batch_size),
+        n_agents=1,
+        discrete_action_cardinalities=ddims if len(ddims) > 0 else None,
+        track_action_mask=False,
+        path="./benchmark_buffer",
+        name="benchmark_buffer",
+        memory_weights=False,
+        global_registered_vars={"global_rewards": (None, np.float32)},
+        individual_registered_vars={
+            "obs": ([obs_dim], np.float32),
+            "obs_": ([obs_dim], np.float32),
+            "discrete_log_probs": ([max(1, len(ddims))], np.float32),
+            "continuous_log_probs": (None, np.float32),
+            "discrete_actions": ([max(1, len(ddims))], np.int64),
+            "continuous_actions": ([max(1, cdim)], np.float32),
+        },
+    )
+    dact_default = np.zeros(max(1, len(ddims)), dtype=np.int64)
+    dlp_default = np.zeros(max(1, len(ddims)), dtype=np.float32)
+    cact_default = np.zeros(max(1, cdim), dtype=np.float32)
+
+    t = {"act": 0.0, "env": 0.0, "buffer": 0.0, "learn": 0.0}
+    n_updates = 0
+    episode_returns = []
+    ep_ret = 0.0
+    start = time.perf_counter()
+    s = time.perf_counter()
+    obs, _ = env.reset(seed=seed)
+    t["env"] += time.perf_counter() - s
+    for step in range(n_steps):
+        s = time.perf_counter()
+        dact, cact, dlp, clp, _ = agent.train_actions(obs, step=True)
+        t["act"] += time.perf_counter() - s
+
+        action = int(np.reshape(dact, -1)[0]) if discrete else np.reshape(cact, 1)
+        s = time.perf_counter()
+        obs_, reward, terminated, truncated, _ = env.step(action)
+        t["env"] += time.perf_counter() - s
+        ep_ret += float(reward)
+
+        s = time.perf_counter()
+        buffer.save_transition(
+            terminated=terminated,
+            registered_vals={
+                "global_rewards": reward,
+                "obs": [obs],
+                "obs_": [obs_],
+                "discrete_actions": [
+                    dact_default if dact is None or np.size(dact) == 0 else dact
+                ],
+                "discrete_log_probs": [
+                    dlp if isinstance(dlp, np.ndarray) and dlp.size > 0 else dlp_default
+                ],
+                "continuous_actions": [cact_default if cact is None else cact],
+                "continuous_log_probs": [0.0 if clp is None else float(np.sum(clp))],
+            },
+        )
+        learn = (
+            buffer.steps_recorded >= rollout_len
+            if online
+            else step >= learning_starts and step % train_every == 0
+        )
+        batch = None
+        if learn:
+            if online:
+                batch = buffer.sample_transitions(
+                    idx=np.arange(0, buffer.steps_recorded),
+                    as_torch=True,
+                    device="cpu",
+                )
+            else:
+                batch = buffer.sample_transitions(
+                    batch_size=batch_size, as_torch=True, device="cpu"
+                )
+        t["buffer"] += time.perf_counter() - s
+
+        if batch is not None:
+            s = time.perf_counter()
+            agent.reinforcement_learn(batch, 0)
+            t["learn"] += time.perf_counter() - s
+            n_updates += 1
+            if online:
+                buffer.reset()
+
+        obs = obs_
+        if terminated or truncated:
+            episode_returns.append(ep_ret)
+            ep_ret = 0.0
+            s = time.perf_counter()
+            obs, _ = env.reset()
+            t["env"] += time.perf_counter() - s
+    wall = time.perf_counter() - start
+    env.close()
+    fractions = {k: v / wall for k, v in t.items()}
+    fractions["other"] = max(0.0, 1.0 - sum(fractions.values()))
+    return {
+        "env": env_id,
+        "steps": n_steps,
+        "wall_s": wall,
+        "env_steps_per_s": n_steps / wall,
+        "updates": n_updates,
+        "updates_per_s": n_updates / wall,
+        "time_fraction": fractions,
+        "mean_episode_return": (
+            float(np.mean(episode_returns)) if episode_returns else None
+        ),
+    }
+
+
+def env_benchmarks(envs=("CartPole-v1", "Pendulum-v1"), n_steps=2000, verbose=False):
+    """env_benchmark for every algorithm on every env, errors are recorded per run"""
+    results = {}
+    for env_id in envs:
+        for name, make in env_agents(env_id).items():
+            key = f"{name}.{env_id}"
+            try:
+                results[key] = env_benchmark(
+                    make, env_id, n_steps=n_steps, online=name == "PG"
+                )
+            except Exception as e:
+                results[key] = {"error": f"{type(e).__name__}: {e}"}
+                if verbose:
+                    traceback.print_exc()
+            if verbose:
+                print(f"{key}: {results[key]}")
+    return {"meta": machine_info(), "results": results}
+
+
+# metrics the regression gate compares, and whether bigger is better
+GATED_METRICS = {
+    "p50_ms": False,
+    "p99_ms": False,
+    "updates_per_s": True,
+    "samples_per_s": True,
+    "env_steps_per_s": True,
+}
+
+
+def machine_fingerprint(meta=None):
+    """Short hash of the hardware / software that benchmark numbers depend on"""
+    meta = machine_info() if meta is None else meta
+    key = json.dumps(
+        {
+            k: meta.get(k)
+            for k in ["machine", "processor", "cpu_count", "python", "torch"]
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+
+def flatten_metrics(results):
+    """{"DQN-egreedy.train_actions.b1.p99_ms": value, ...} for the gated metrics"""
+    flat = {}
+    for name, res in results["results"].items():
+        # micro results nest metrics one level deeper than env results
+        groups = res.items() if "error" not in res else []
+        if any(k in GATED_METRICS for k in res):
+            groups = [(None, res)]
+        for metric, stats in groups:
+            if not isinstance(stats, dict):
+                continue
+            for k, v in stats.items():
+                if k in GATED_METRICS and v is not None:
+                    key = name if metric is None else f"{name}.{metric}"
+                    flat[f"{key}.{k}"] = float(v)
+    return flat
+
+
+def run_suites(suites=("micro",), repeats=3, budget_s=0.5, n_steps=2000):
+    """Runs the suites repeats times, returns {metric: [value per repeat]}"""
+    runs = {}
+    for _ in range(repeats):
+        flat = {}
+        if "micro" in suites:
+            flat.update(
+                {
+                    f"micro.{k}": v
+                    for k, v in flatten_metrics(
+                        micro_benchmarks(budget_s=budget_s)
+                    ).items()
+                }
+            )
+        if "env" in suites:
+            flat.update(
+                {
+                    f"env.{k}": v
+                    for k, v in flatten_metrics(env_benchmarks(n_steps=n_steps)).items()
+                }
+            )
+        for k, v in flat.items():
+            runs.setdefault(k, []).append(v)
+    return runs
+
+
+def compare_to_baseline(baseline, current, tolerance=0.1):
+    """
+    baseline / current: {metric: [value per repeat]}. A metric regresses when
+    its median is more than tolerance (relative) worse than the baseline
+    median and even the best current repeat is worse than that median, so a
+    single noisy repeat can not fail the gate. A baseline metric the current
+    run does not have (it errored or was removed) counts as a regression
+    with current None. Returns a list of {"metric", "baseline", "current",
+    "change"} for every regression.
+    """
+    regressions = []
+    for metric in sorted(set(baseline) - set(current)):
+        regressions.append(
+            {
+                "metric": metric,
+                "baseline": float(np.median(baseline[metric])),
+                "current": None,
+                "change": float("inf"),
+            }
+        )
+    for metric, values in current.items():
+        if metric not in baseline:
+            continue
+        higher_better = GATED_METRICS[metric.rsplit(".", 1)[-1]]
+        base = float(np.median(baseline[metric]))
+        cur = float(np.median(values))
+        if base == 0:
+            continue
+        # positive change is always worse
+        if higher_better:
+            change = (base - cur) / base
+            best = max(values)
+            consistent = best < base
+        else:
+            change = (cur - base) / base
+            best = min(values)
+            consistent = best > base
+        if change > tolerance and consistent:
+            regressions.append(
+                {"metric": metric, "baseline": base, "current": cur, "change": change}
+            )
+    return sorted(regressions, key=lambda r: -r["change"])
+
+
+def regression_gate(
+    baseline_dir="./benchmark_baselines",
+    suites=("micro",),
+    tolerance=0.1,
+    repeats=3,
+    budget_s=0.5,
+    n_steps=2000,
+    update=False,
+    verbose=True,
+):
+    """
+    Re-runs the suites and compares them with the stored baseline for this
+    machine's fingerprint. Writes the baseline instead if there is none yet
+    or update is True. Returns 1 if any metric regressed, otherwise 0, so it
+    can be used directly as a process exit code. Metrics in the baseline
+    that errored or are gone fail the gate too, pass update=True to accept
+    a changed metric set.
+    """
+    meta = machine_info()
+    path = os.path.join(baseline_dir, f"{machine_fingerprint(meta)}.json")
+    current = run_suites(suites, repeats, budget_s, n_steps)
+    if update or not os.path.exists(path):
+        os.makedirs(baseline_dir, exist_ok=True)
+        write_json({"meta": meta, "suites": list(suites), "metrics": current}, path)
+        if verbose:
+            print(f"Wrote baseline with {len(current)} metrics to {path}")
+        return 0
+    with open(path, "r") as f:
+        baseline = json.load(f)["metrics"]
+    regressions = compare_to_baseline(baseline, current, tolerance)
+    if verbose:
+        for r in regressions:
+            if r["current"] is None:
+                print(f"MISSING {r['metric']}: errored or removed")
+                continue
+            print(
+                f"REGRESSION {r['metric']}: {r['baseline']:.4g} -> {r['current']:.4g} ({r['change'] * 100:.1f}% worse)"
+            )
+        print(
+            f"{len(regressions)} of {len(baseline)} baseline metrics regressed beyond {tolerance * 100:.0f}% or are missing"
+        )
+    return 1 if len(regressions) > 0 else 0
+
+
+def write_json(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="flexibuddiesrl benchmarks")
+    parser.add_argument(
+        "--suite",
+        choices=["import", "micro", "env", "gate"],
+        default="micro",
+        help="What to run",
+    )
+    parser.add_argument(
+        "--steps", type=int, default=2000, help="Env steps per env benchmark"
+    )
+    parser.add_argument("--out", type=str, default=None, help="Write json here")
+    parser.add_argument(
+        "--budget", type=float, default=0.5, help="Seconds spent per metric"
+    )
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument(
+        "--baseline-dir",
+        type=str,
+        default="./benchmark_baselines",
+        help="gate: where per machine baselines are stored",
+    )
+    parser.add_argument(
+        "--gate-suites",
+        nargs="+",
+        choices=["micro", "env"],
+        default=["micro"],
+        help="gate: which suites to compare",
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1, help="gate: allowed relative slowdown"
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=3, help="gate: repetitions per suite"
+    )
+    parser.add_argument(
+        "--update", action="store_true", help="gate: overwrite the baseline"
+    )
+    args = parser.parse_args()
+
+    if args.suite == "gate":
+        sys.exit(
+            regression_gate(
+                baseline_dir=args.baseline_dir,
+                suites=args.gate_suites,
+                tolerance=args.tolerance,
+                repeats=args.repeats,
+                budget_s=args.budget,
+                n_steps=args.steps,
+                update=args.update,
+            )
+        )
+
+    if args.suite == "import":
+        res = {
+            "+".join(a) or "package": import_time(a, repeats=5)
+            for a in [(), ("Agent",), ("DQN",), ("PG",), ("TD3", "DDPG", "DQN", "PG")]
+        }
+    elif args.suite == "env":
+        res = env_benchmarks(n_steps=args.steps, verbose=args.verbose)
+    else:
+        res = micro_benchmarks(budget_s=args.budget, verbose=args.verbose)
+    if args.out is not None:
+        write_json(res, args.out)
+    print(json.dumps(res, indent=2))
@@ -0,0 +1,522 @@
+import json
+import os
+import random
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+import torch
+import torch.nn as nn
+
+# File layout:
+#   8 bytes   MAGIC
+#   8 bytes   little endian uint64 header length
+#   header    utf-8 json {"agent", "version", "attrs", "tensors"}
+#   padding   up to a multiple of ALIGN
+#   tensors   raw contiguous bytes, every tensor starts on an ALIGN boundary
+# so a loader can mmap the file once and view every tensor in place.
+MAGIC = b"FBRLCKPT"
+VERSION = 1
+ALIGN = 64
+# step counters that should survive a reload even if they are not in attrs
+COUNTERS = ["step", "steps", "rl_step", "eps", "g_mean"]
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def agent_modules(agent):
+    """
+    The networks that make up an agent. nn.Module agents (DQN, PG) are their
+    own single module, other agents (TD3, DDPG) own several module attributes.
+    """
+    if isinstance(agent, nn.Module):
+        return {"": agent}
+    return {k: v for k, v in vars(agent).items() if isinstance(v, nn.Module)}
+
+
+def _attr_names(agent):
+    names = list(getattr(agent, "attrs", []))
+    for c in COUNTERS:
+        if c not in names and hasattr(agent, c):
+            names.append(c)
+    return names
+
+
+def agent_optimizers(agent):
+    return {
+        k: v for k, v in vars(agent).items() if isinstance(v, torch.optim.Optimizer)
+    }
+
+
+def rng_state():
+    """torch, cuda, numpy and python random states, torch.load(weights_only) safe"""
+    np_state = np.random.get_state()
+    state = {
+        "torch": torch.get_rng_state(),
+        "numpy": [
+            np_state[0],
+            torch.from_numpy(np_state[1].astype(np.int64)),
+            int(np_state[2]),
+            int(np_state[3]),
+            float(np_state[4]),
+        ],
+        "random": random.getstate(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def _as_tuple(x):
+    return tuple(_as_tuple(v) for v in x) if isinstance(x, (list, tuple)) else x
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"].to("cpu", torch.uint8))
+    n = state["numpy"]
+    keys = n[1].numpy() if torch.is_tensor(n[1]) else np.asarray(n[1])
+    np.random.set_state((n[0], keys.astype(np.uint32), n[2], n[3], n[4]))
+    random.setstate(_as_tuple(state["random"]))
+    if "cuda" in state and torch.cuda.is_available():
+        cuda = [t.to("cpu", torch.uint8) for t in state["cuda"]]
+        torch.cuda.set_rng_state_all(cuda[: torch.cuda.device_count()])
+
+
+def training_state(agent):
+    """
+    Everything besides the weights that a resumed learner needs to continue
+    with identical updates: optimizer moments, step / annealing counters and
+    the global rng states.
+    """
+    return {
+        "optimizers": {k: v.state_dict() for k, v in agent_optimizers(agent).items()},
+        "counters": {c: getattr(agent, c) for c in COUNTERS if hasattr(agent, c)},
+        "rng": rng_state(),
+    }
+
+
+def load_training_state(agent, state, restore_rng=True):
+    for k, sd in state.get("optimizers", {}).items():
+        opt = getattr(agent, k, None)
+        if isinstance(opt, torch.optim.Optimizer):
+            # json turns the int param ids into strings
+            sd = dict(sd, state={int(i): s for i, s in sd["state"].items()})
+            opt.load_state_dict(sd)
+    for c, v in state.get("counters", {}).items():
+        setattr(agent, c, v)
+    if restore_rng and "rng" in state:
+        set_rng_state(state["rng"])
+
+
+def save_training_state(agent, checkpoint_path):
+    """Companion to the per-directory Agent.save, writes checkpoint_path/training_state"""
+    torch.save(training_state(agent), os.path.join(checkpoint_path, "training_state"))
+
+
+def load_training_state_file(agent, checkpoint_path, restore_rng=True):
+    """Loads checkpoint_path/training_state if it exists, older saves have none"""
+    path = os.path.join(checkpoint_path, "training_state")
+    if not os.path.exists(path):
+        return False
+    state = torch.load(path, weights_only=True, map_location="cpu")
+    load_training_state(agent, state, restore_rng)
+    return True
+
+
+def _encode(value, key, tensors):
+    """json friendly version of an attr, tensors go into the tensor section"""
+    if torch.is_tensor(value):
+        tensors[key] = value
+        return {"__tensor__": key}
+    if isinstance(value, np.ndarray):
+        return {"__ndarray__": value.tolist(), "dtype": str(value.dtype)}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_encode(v, f"{key}.{i}", tensors) for i, v in enumerate(value)]
+    if isinstance(value, dict):
+        return {k: _encode(v, f"{key}.{k}", tensors) for k, v in value.items()}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    # a str() of it could not be loaded back into the same type
+    raise TypeError(f"Can not checkpoint {key} of type {type(value).__name__}")
+
+
+def _decode(value, tensors, device):
+    if isinstance(value, dict):
+        if "__tensor__" in value:
+            return tensors[value["__tensor__"]].to(device)
+        if "__ndarray__" in value:
+            return np.array(value["__ndarray__"], dtype=value["dtype"])
+        return {k: _decode(v, tensors, device) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode(v, tensors, device) for v in value]
+    return value
+
+
+def snapshot(agent, include_training_state=True):
+    """
+    Collects the header and a flat {name: tensor} dict for agent without
+    writing anything. Tensors are detached references, callers that hand the
+    snapshot to another thread must copy them first.
+    include_training_state: also store optimizer moments and rng states so
+        that load_checkpoint resumes training exactly.
+    """
+    tensors = {}
+    for mname, module in agent_modules(agent).items():
+        prefix = f"{mname}." if mname else ""
+        for k, v in module.state_dict().items():
+            tensors[f"modules/{prefix}{k}"] = v.detach()
+    attrs = {}
+    for name in _attr_names(agent):
+        if hasattr(agent, name):
+            attrs[name] = _encode(getattr(agent, name), f"attrs/{name}", tensors)
+    header = {
+        "agent": type(agent).__name__,
+        "version": VERSION,
+        "modules": list(agent_modules(agent).keys()),
+        "attrs": attrs,
+    }
+    if include_training_state:
+        state = training_state(agent)
+        del state["counters"]  # already in attrs
+        header["training_state"] = _encode(state, "training_state", tensors)
+    return header, tensors
+
+
+def write_snapshot(f, header, tensors):
+    """Writes a snapshot to the open binary file f"""
+    table = {}
+    offset = 0
+    blobs = []
+    for k, t in tensors.items():
+        t = t.detach().to("cpu").contiguous()
+        nbytes = t.numel() * t.element_size()
+        table[k] = {
+            "dtype": str(t.dtype).replace("torch.", ""),
+            "shape": list(t.shape),
+            "offset": offset,
+            "nbytes": nbytes,
+        }
+        blobs.append((offset, t))
+        offset = _align(offset + nbytes)
+    header = dict(header, tensors=table)
+    hbytes = json.dumps(header).encode("utf-8")
+    f.write(MAGIC)
+    f.write(struct.pack("<Q", len(hbytes)))
+    f.write(hbytes)
+    data_start = _align(16 + len(hbytes))
+    f.write(b"\0" * (data_start - 16 - len(hbytes)))
+    written = 0
+    for off, t in blobs:
+        f.write(b"\0" * (off - written))
+        if t.numel() > 0:
+            f.write(t.reshape(-1).view(torch.uint8).numpy().tobytes())
+        written = off + t.numel() * t.element_size()
+    f.write(b"\0" * (_align(written) - written))
+
+
+def _write_atomic(path, header, tensors):
+    # write + fsync a temp file then rename it over path, so readers only ever
+    # see the old checkpoint or the complete new one, never a torn file
+    tmp = f"{path}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            write_snapshot(f, header, tensors)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        # a failed write (disk full, bad path) leaves no partial file behind
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    if hasattr(os, "O_DIRECTORY"):
+        dfd = os.open(os.path.dirname(os.path.abspath(path)), os.O_DIRECTORY)
+        try:
+            os.fsync(dfd)
+        finally:
+            os.close(dfd)
+    return path
+
+
+def save_checkpoint(agent, path):
+    """Writes every network and attr of agent into the single file path"""
+    header, tensors = snapshot(agent)
+    _write_atomic(path, header, tensors)
+
+
+def _cpu_copy(t):
+    # the background write must not see later optimizer steps, so every
+    # tensor is copied to cpu before save_async returns
+    if t.device.type == "cpu":
+        return t.detach().clone()
+    return t.detach().to("cpu", copy=True)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+_pending = None
+
+
+def save_async(agent, path):
+    """
+    Snapshots agent on the calling thread and writes it to path on a single
+    background thread. Returns a concurrent.futures.Future that resolves to
+    path once the file has been fsynced and renamed into place. If the
+    previous save_async is still writing this call waits for it first, so at
+    most one checkpoint is ever in flight. A failed write is reported once,
+    through the future its own call returned, and does not stop later saves.
+    """
+    global _writer, _pending
+    with _writer_lock:
+        if _writer is None:
+            _writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ckpt")
+        if _pending is not None:
+            try:
+                wait([_pending])
+            finally:
+                _pending = None
+        header, tensors = snapshot(agent)
+        tensors = {k: _cpu_copy(t) for k, t in tensors.items()}
+        _pending = _writer.submit(_write_atomic, path, header, tensors)
+        return _pending
+
+
+def read_checkpoint(path, mmap=True):
+    """
+    Returns (header, {name: cpu tensor}). With mmap the tensors are views into
+    a copy-on-write memory map of the file, so pages are only read when they
+    are touched and writes stay private to this process.
+    """
+    with open(path, "rb") as f:
+        magic = f.read(8)
+        assert magic == MAGIC, f"{path} is not a flexibuddiesrl checkpoint"
+        (hlen,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(hlen).decode("utf-8"))
+        if not mmap:
+            f.seek(0)
+            raw = np.frombuffer(bytearray(f.read()), dtype=np.uint8)
+    if mmap:
+        raw = np.memmap(path, dtype=np.uint8, mode="c")
+    data_start = _align(16 + hlen)
+    tensors = {}
+    for k, info in header["tensors"].items():
+        dtype = getattr(torch, info["dtype"])
+        start = data_start + info["offset"]
+        if info["nbytes"] == 0:
+            tensors[k] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        buf = torch.from_numpy(raw[start : start + info["nbytes"]])
+        tensors[k] = buf.view(dtype).reshape(info["shape"])
+    return header, tensors
+
+
+def _remap_optimizers(agent, id_map):
+    """Points every optimizer on agent at the parameters load_state_dict assigned"""
+    for opt in vars(agent).values():
+        if not isinstance(opt, torch.optim.Optimizer):
+            continue
+        for group in opt.param_groups:
+            group["params"] = [id_map.get(id(p), p) for p in group["params"]]
+        state = {id_map.get(id(p), p): s for p, s in opt.state.items()}
+        opt.state.clear()
+        opt.state.update(state)
+
+
+def load_checkpoint(agent, path, mmap=True, strict=True, restore_rng=True):
+    """
+    Loads a save_checkpoint file into an already constructed agent. On the
+    cpu the memory mapped tensors are assigned straight into the networks, on
+    other devices they are copied into the existing parameters. Optimizer
+    moments are always restored, restore_rng=False leaves the global torch /
+    numpy / random states alone (e.g. when loading an opponent policy).
+    """
+    header, tensors = read_checkpoint(path, mmap=mmap)
+    device = getattr(agent, "device", "cpu")
+    return load_snapshot(
+        agent,
+        header,
+        tensors,
+        assign=mmap and str(device) == "cpu",
+        strict=strict,
+        restore_rng=restore_rng,
+    )
+
+
+def load_snapshot(agent, header, tensors, assign=False, strict=True, restore_rng=True):
+    """Puts a (header, tensors) snapshot back into agent"""
+    device = getattr(agent, "device", "cpu")
+    for mname, module in agent_modules(agent).items():
+        prefix = f"modules/{mname}." if mname else "modules/"
+        state = {
+            k[len(prefix) :]: v for k, v in tensors.items() if k.startswith(prefix)
+        }
+        old = dict(module.named_parameters())
+        module.load_state_dict(state, strict=strict, assign=assign)
+        if assign:
+            new = dict(module.named_parameters())
+            _remap_optimizers(
+                agent, {id(p): new[n] for n, p in old.items() if n in new}
+            )
+    for name, value in header["attrs"].items():
+        if name == "device":
+            continue
+        setattr(agent, name, _decode(value, tensors, device))
+    if "training_state" in header:
+        state = _decode(header["training_state"], tensors, "cpu")
+        load_training_state(agent, state, restore_rng)
+    return header
+
+
+class DeltaCheckpointer:
+    """
+    Frequent, cheap snapshots for self-play pools and rollback. Every
+    rebase_every snapshots a full base checkpoint is written, the snapshots in
+    between only store each floating point tensor's difference from that base,
+    quantized to int8 with one float scale per tensor (tensors that did not
+    change, like a target net between hard updates, store nothing). Deltas are
+    always taken against the base rather than the previous snapshot so the
+    quantization error never accumulates and any snapshot is rebuilt from just
+    two files: base + q * scale.
+
+        ckpt = DeltaCheckpointer("./pool", rebase_every=50, keep=200)
+        sid = ckpt.save(agent)
+        ckpt.load(agent, sid)  # or ckpt.load(agent) for the newest one
+
+    keep: only the newest keep snapshots are retained, older delta files and
+        bases that no kept snapshot needs are deleted. None keeps everything.
+    keep_every: every keep_every'th snapshot is kept forever as well.
+    include_training_state: also snapshot optimizer moments (roughly triples
+        the size of every Adam trained network), off by default because
+        policy pools only need the weights.
+    index.json in directory lists every retained snapshot.
+    """
+
+    def __init__(
+        self,
+        directory,
+        rebase_every=50,
+        keep=200,
+        keep_every=None,
+        include_training_state=False,
+    ):
+        self.directory = directory
+        self.include_training_state = include_training_state
+        self.rebase_every = rebase_every
+        self.keep = keep
+        self.keep_every = keep_every
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, "index.json")
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+        else:
+            self.index = {"next_id": 0, "snapshots": []}
+        self._base_id = None
+        self._base = None  # cpu float copies of the base tensors
+
+    def _path(self, sid, kind):
+        return os.path.join(self.directory, f"{kind}_{sid:08d}.ckpt")
+
+    def _base_tensors(self, base_id):
+        if self._base_id != base_id:
+            _, self._base = read_checkpoint(self._path(base_id, "base"))
+            self._base_id = base_id
+        return self._base
+
+    def save(self, agent):
+        """Writes a base or delta snapshot of agent, returns its snapshot id"""
+        header, tensors = snapshot(agent, self.include_training_state)
+        sid = self.index["next_id"]
+        last = self.index["snapshots"][-1] if self.index["snapshots"] else None
+        if last is None or sid - last["base"] >= self.rebase_every:
+            tensors = {k: t.detach().to("cpu", copy=True) for k, t in tensors.items()}
+            _write_atomic(self._path(sid, "base"), header, tensors)
+            self._base_id, self._base = sid, tensors
+            entry = {"id": sid, "base": sid, "file": self._path(sid, "base")}
+        else:
+            base = self._base_tensors(last["base"])
+            stored, deltas = {}, {}
+            for k, t in tensors.items():
+                t = t.detach().to("cpu")
+                b = base.get(k)
+                # only weights are quantized, optimizer / rng state is exact
+                if (
+                    not k.startswith("modules/")
+                    or not t.is_floating_point()
+                    or b is None
+                    or b.shape != t.shape
+                ):
+                    stored[k] = t.clone()
+                    continue
+                d = t.float() - b.float()
+                scale = float(d.abs().max()) / 127.0
+                if scale == 0.0:
+                    deltas[k] = 0.0
+                    continue
+                stored[k] = torch.round(d / scale).clamp_(-127, 127).to(torch.int8)
+                deltas[k] = scale
+            header = dict(header, base=last["base"], deltas=deltas)
+            _write_atomic(self._path(sid, "delta"), header, stored)
+            entry = {"id": sid, "base": last["base"], "file": self._path(sid, "delta")}
+        self.index["snapshots"].append(entry)
+        self.index["next_id"] = sid + 1
+        self._apply_retention()
+        self._write_index()
+        return sid
+
+    def snapshot_ids(self):
+        return [e["id"] for e in self.index["snapshots"]]
+
+    def reconstruct(self, sid=None):
+        """Returns the (header, tensors) of snapshot sid, the newest if None"""
+        entries = {e["id"]: e for e in self.index["snapshots"]}
+        assert len(entries) > 0, f"No snapshots in {self.directory}"
+        sid = max(entries) if sid is None else sid
+        assert sid in entries, f"Snapshot {sid} is not retained"
+        entry = entries[sid]
+        if entry["base"] == sid:
+            return read_checkpoint(entry["file"])
+        base = self._base_tensors(entry["base"])
+        header, stored = read_checkpoint(entry["file"])
+        tensors = {k: t for k, t in stored.items() if k not in header["deltas"]}
+        for k, scale in header["deltas"].items():
+            b = base[k]
+            if scale == 0.0:
+                tensors[k] = b
+            else:
+                tensors[k] = torch.add(b.float(), stored[k], alpha=scale).to(b.dtype)
+        return header, tensors
+
+    def load(self, agent, sid=None, strict=True, restore_rng=False):
+        header, tensors = self.reconstruct(sid)
+        return load_snapshot(
+            agent, header, tensors, strict=strict, restore_rng=restore_rng
+        )
+
+    def _apply_retention(self):
+        snaps = self.index["snapshots"]
+        if self.keep is None:
+            return
+        keep_ids = {e["id"] for e in snaps[-self.keep :]}
+        if self.keep_every:
+            keep_ids |= {e["id"] for e in snaps if e["id"] % self.keep_every == 0}
+        needed_bases = {e["base"] for e in snaps if e["id"] in keep_ids}
+        retained = []
+        for e in snaps:
+            if e["id"] in keep_ids or e["id"] in needed_bases:
+                retained.append(e)
+            elif os.path.exists(e["file"]):
+                os.remove(e["file"])
+        self.index["snapshots"] = retained
+
+    def _write_index(self):
+        tmp = f"{self.index_path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.index_path)
@@ -0,0 +1,94 @@
+import os
+import tempfile
+import numpy as np
+import torch
+from flexibuddiesrl.DQN import DQN
+from flexibuddiesrl.PG_stabalized import PG
+from flexibuddiesrl.Checkpoint import save_checkpoint, load_checkpoint, save_async
+
+
+def make_agents():
+    common = dict(obs_dim=6, discrete_action_dims=[2, 3], hidden_dims=[32, 32])
+    return {
+        "DQN": lambda: DQN(continuous_action_dims=0, **common),
+        "PG": lambda: PG(continuous_action_dim=0, **common),
+    }
+
+
+def outputs(agent, obs):
+    with torch.no_grad():
+        if isinstance(agent, DQN):
+            _, disc, _ = agent.Q1(obs)
+            return torch.cat(disc, dim=-1)
+        return agent.critic(obs)
+
+
+def round_trip_test(verbose=False):
+    obs = torch.rand(32, 6)
+    passes, total = 0, 0
+    with tempfile.TemporaryDirectory() as d:
+        for name, make in make_agents().items():
+            for mmap in [True, False]:
+                total += 1
+                a, b = make(), make()
+                path = os.path.join(d, f"{name}.ckpt")
+                save_checkpoint(a, path)
+                load_checkpoint(b, path, mmap=mmap)
+                ok = torch.equal(outputs(a, obs), outputs(b, obs))
+                passes += ok
+                if verbose or not ok:
+                    print(f"{name} mmap={mmap} identical outputs: {ok}")
+    print(f"Checkpoint round trip passed {passes}/{total}")
+    return passes == total
+
+
+def save_async_test(verbose=False):
+    agent = make_agents()["DQN"]()
+    obs = torch.rand(32, 6)
+    with tempfile.TemporaryDirectory() as d:
+        # the temp file is written but can't be renamed over a directory
+        bad = os.path.join(d, "is_a_dir")
+        os.makedirs(os.path.join(bad, "child"))
+        failed = save_async(agent, bad).exception()
+        no_tmp = not os.path.exists(f"{bad}.tmp")
+        if verbose:
+            print(f"failed write raised {failed!r}, tmp removed: {no_tmp}")
+
+        # the failed write must not break the saves after it
+        good = os.path.join(d, "agent.ckpt")
+        path = save_async(agent, good).result()
+        again = save_async(agent, good).result()
+        b = make_agents()["DQN"]()
+        load_checkpoint(b, path)
+        same = torch.equal(outputs(agent, obs), outputs(b, obs))
+        leftovers = [f for f in os.listdir(d) if f.endswith(".tmp")]
+    ok = failed is not None and no_tmp and again == good and same
+    ok = ok and len(leftovers) == 0
+    print(f"save_async after a failed write passed: {ok}")
+    return ok
+
+
+def unsupported_attr_test(verbose=False):
+    """An attr that can't round trip raises instead of saving its str()"""
+    agent = make_agents()["DQN"]()
+    agent.attrs = list(agent.attrs) + ["bad_attr"]
+    agent.bad_attr = {"inner": [1, object()]}
+    with tempfile.TemporaryDirectory() as d:
+        try:
+            save_checkpoint(agent, os.path.join(d, "agent.ckpt"))
+            message = ""
+        except TypeError as e:
+            message = str(e)
+    ok = "attrs/bad_attr.inner.1" in message
+    if verbose or not ok:
+        print(f"raised: {message!r}")
+    print(f"Checkpoint unsupported attr raised: {ok}")
+    return ok
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    np.random.seed(0)
+    round_trip_test()
+    save_async_test()
+    unsupported_attr_test()
@@ -0,0 +1,236 @@
+import math
+import time
+import torch
+import torch.nn as nn
+from .Agent import (
+    ffEncoder,
+    MixedActor,
+    StochasticActor,
+    ValueSA,
+    ValueS,
+    QS,
+)
+from .Instrumentation import _networks
+
+# Counting conventions, per input row:
+#   Linear(i, o)        2*i*o flops (multiply + add) and o for the bias
+#   activation / tanh   1 flop per element
+#   backward            BACKWARD_FACTOR x forward (grad wrt inputs + weights)
+#   Adam step           ADAM_FLOPS per trainable parameter
+#   polyak update       POLYAK_FLOPS per target parameter
+# Sampling, softmax and loss arithmetic are a few flops per action and are
+# left out, they vanish next to the matmuls for any real network.
+BACKWARD_FACTOR = 2
+ADAM_FLOPS = 12
+POLYAK_FLOPS = 3
+
+
+def _linear(layer: nn.Linear):
+    return 2 * layer.in_features * layer.out_features + layer.out_features
+
+
+def _ff_encoder(m: ffEncoder):
+    flops = 0
+    for i, layer in enumerate(m.encoder):
+        flops += _linear(layer) + layer.out_features  # activation
+        if i == 0 and m.drop > 0:
+            flops += layer.out_features  # dropout mask
+    return flops
+
+
+def _qs(m: QS):
+    flops = forward_flops(m.encoder) if m.encoder is not None else 0
+    if m.joint_head_layers is not None:
+        for layer in m.joint_head_layers:
+            flops += _linear(layer) + layer.out_features
+    if getattr(m, "advantage_heads", None) is not None:
+        flops += _linear(m.advantage_heads)
+        if m.dueling:
+            flops += 2 * m.advantage_heads.out_features  # mean and subtract
+    if m.value_head is not None:
+        flops += _linear(m.value_head)
+    return flops
+
+
+def _stochastic_actor(m: StochasticActor):
+    flops = forward_flops(m.encoder) if m.encoder is not None else 0
+    for i, layer in enumerate(m.action_layers):
+        flops += _linear(layer)
+        if i != len(m.action_layers) - 1:
+            flops += layer.out_features
+    return flops + 3 * m.log_std_dim  # tanh squash of the log std
+
+
+def _mixed_actor(m: MixedActor):
+    flops = forward_flops(m.encoder) if getattr(m, "encoder", None) else 0
+    if m.continuous_actions_head is not None:
+        flops += _linear(m.continuous_actions_head)
+        flops += 3 * m.continuous_actions_head.out_features  # tanh, scale, bias
+    for head in m.discrete_action_heads:
+        flops += _linear(head) + 3 * head.out_features  # (gumbel) softmax
+    return flops
+
+
+def _value(m):
+    return sum(_linear(l) for l in [m.l1, m.l2, m.l3]) + 2 * m.l2.out_features
+
+
+_walkers = {
+    nn.Linear: _linear,
+    ffEncoder: _ff_encoder,
+    QS: _qs,
+    StochasticActor: _stochastic_actor,
+    MixedActor: _mixed_actor,
+    ValueSA: _value,
+    ValueS: _value,
+}
+
+
+def forward_flops(module: nn.Module):
+    """Flops of one forward pass of module for a single input row"""
+    for cls in type(module).__mro__:
+        if cls in _walkers:
+            return _walkers[cls](module)
+    # unknown module: assume every Linear in it runs once per row
+    return sum(_linear(l) for l in module.modules() if isinstance(l, nn.Linear))
+
+
+def param_count(module: nn.Module, trainable_only=False):
+    return sum(
+        p.numel() for p in module.parameters() if p.requires_grad or not trainable_only
+    )
+
+
+def _train(f):
+    # forward with grad + backward
+    return (1 + BACKWARD_FACTOR) * f
+
+
+def _dqn(agent, F, P, batch_size):
+    # online Q forward + backward, the target is the same Q1 on obs_
+    per_sample = _train(F["Q1"]) + F["Q1"]
+    return F["Q1"], per_sample, ADAM_FLOPS * P["Q1"]
+
+
+def _td3(agent, F, P, batch_size):
+    pf = agent.policy_frequency
+    twin = hasattr(agent, "critic2")
+    critics = ["critic1", "critic2"] if twin else ["critic"]
+    targets = ["actor_target"] + [f"{c}_target" for c in critics]
+    per_sample = sum(F[t] for t in targets)
+    per_sample += sum(_train(F[c]) for c in critics)
+    # the delayed actor loss backpropagates through the first critic
+    per_sample += (_train(F["actor"]) + _train(F[critics[0]])) / pf
+    update = ADAM_FLOPS * sum(P[c] for c in critics)
+    update += (ADAM_FLOPS * P["actor"] + POLYAK_FLOPS * sum(P[t] for t in targets)) / pf
+    return F["actor"], per_sample, update
+
+
+def _pg(agent, F, P, batch_size):
+    bootstraps = agent.advantage_type in ("gae", "a2c", "gv")
+    per_sample = F["critic"] if bootstraps else 0
+    per_sample += agent.n_epochs * (_train(F["actor"]) + _train(F["critic"]))
+    steps = agent.n_epochs * math.ceil(batch_size / agent.mini_batch_size)
+    update = steps * ADAM_FLOPS * (P["actor"] + P["critic"] + P.get("self", 0))
+    return F["actor"], per_sample, update
+
+
+def _agent_kind(agent):
+    if hasattr(agent, "Q1"):
+        return _dqn
+    if hasattr(agent, "actor_target"):
+        return _td3
+    if hasattr(agent, "actor") and hasattr(agent, "critic"):
+        return _pg
+    raise ValueError(f"No cost model for {type(agent).__name__}")
+
+
+def agent_cost(agent, batch_size=256):
+    """
+    Static compute cost of an agent's configuration, read off its networks
+    without running them:
+
+        networks: {name: {"params", "forward_flops"}} per network, targets
+            included
+        params / trainable_params: totals, target nets are not trainable
+        train_actions_flops: per observation row
+        reinforcement_learn_flops: per batch sample, forward + backward of
+            every network the update touches, target forwards included and
+            TD3 / DDPG's delayed actor update spread over policy_frequency
+        optimizer_flops: per reinforcement_learn call of batch_size samples,
+            Adam steps (PPO takes n_epochs * minibatches of them) and polyak
+            target updates
+        reinforcement_learn_call_flops: everything one call costs
+    """
+    F, P, networks = {}, {}, {}
+    targets = set()
+    for name, net in _networks(agent).items():
+        if isinstance(net, list):
+            F[name] = 0
+            P[name] = sum(p.numel() for p in net if isinstance(p, nn.Parameter))
+        else:
+            F[name] = forward_flops(net)
+            P[name] = param_count(net)
+        if name.endswith("_target"):
+            targets.add(name)
+        networks[name] = {"params": P[name], "forward_flops": F[name]}
+    ta, per_sample, update = _agent_kind(agent)(agent, F, P, batch_size)
+    return {
+        "agent": type(agent).__name__,
+        "networks": networks,
+        "params": sum(P.values()),
+        "trainable_params": sum(v for k, v in P.items() if k not in targets),
+        "train_actions_flops": int(ta),
+        "reinforcement_learn_flops": int(per_sample),
+        "batch_size": batch_size,
+        "optimizer_flops": int(update),
+        "reinforcement_learn_call_flops": int(batch_size * per_sample + update),
+    }
+
+
+def cost_table(
+    agents, params=None, batch_size=256, sort_by="reinforcement_learn_flops"
+):
+    """
+    agent_cost for a list of agents (e.g. from models_spec.dqn_agents), most
+    expensive first. params: the matching list of config dicts, kept with
+    each row under "config".
+    """
+    rows = []
+    for i, agent in enumerate(agents):
+        row = agent_cost(agent, batch_size)
+        row["index"] = i
+        if params is not None:
+            row["config"] = params[i]
+        rows.append(row)
+    return sorted(rows, key=lambda r: -r[sort_by])
+
+
+def device_flops_per_s(device="cpu", n=512, repeats=10):
+    """Rough sustained fp32 matmul throughput, to turn flops into seconds"""
+    a = torch.randn(n, n, device=device)
+    b = torch.randn(n, n, device=device)
+    a @ b  # warm up
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+    t = time.perf_counter()
+    for _ in range(repeats):
+        a @ b
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+    return 2 * n**3 * repeats / (time.perf_counter() - t)
+
+
+def predict_throughput(cost, flops_per_s):
+    """
+    Upper bounds from agent_cost and device_flops_per_s. Small networks are
+    dominated by per call overhead, so measured rates (Benchmark.py) come out
+    lower, use this to rank configurations rather than as a promise.
+    """
+    return {
+        "train_actions_rows_per_s": flops_per_s / max(1, cost["train_actions_flops"]),
+        "reinforcement_learn_samples_per_s": flops_per_s
+        / max(1, cost["reinforcement_learn_flops"]),
+        "reinforcement_learn_calls_per_s": flops_per_s
+        / max(1, cost["reinforcement_learn_call_flops"]),
+    }
@@ -0,0 +1,85 @@
+import numpy as np
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+from flexibuddiesrl.Benchmark import benchmark_agents
+from flexibuddiesrl.CostModel import agent_cost
+from flexibuddiesrl.Instrumentation import _networks
+
+
+def forward_flops_test(verbose=False):
+    """
+    Counted flops match torch's matmul flop counter, plus the few percent the
+    cost model adds for biases and activations
+    """
+    obs = torch.rand(1, 6)
+    passes, total = 0, 0
+    for name, make in benchmark_agents(6, 2, [3, 4]).items():
+        agent = make()
+        cost = agent_cost(agent)
+        for k, net in _networks(agent).items():
+            if isinstance(net, list):
+                continue
+            counter = FlopCounterMode(display=False)
+            with counter, torch.no_grad():
+                if k.startswith("critic") and name in ["TD3", "DDPG"]:
+                    net(obs, torch.rand(1, 2 + 3 + 4))  # continuous + one hots
+                else:
+                    net(obs)
+            matmul = counter.get_total_flops()
+            ours = cost["networks"][k]["forward_flops"]
+            ok = matmul <= ours <= 1.05 * matmul
+            passes += ok
+            total += 1
+            if verbose or not ok:
+                print(f"{name} {k}: cost model {ours}, torch {matmul}")
+    print(f"forward_flops passed {passes}/{total}")
+    return passes == total
+
+
+def params_test(verbose=False):
+    """Parameter totals match the networks, targets are not trainable"""
+    passes, total = 0, 0
+    for name, make in benchmark_agents(6, 2, [3, 4]).items():
+        agent = make()
+        cost = agent_cost(agent)
+        counts = {}
+        for k, net in _networks(agent).items():
+            params = net if isinstance(net, list) else net.parameters()
+            counts[k] = sum(p.numel() for p in params)
+        trainable = sum(v for k, v in counts.items() if not k.endswith("_target"))
+        ok = cost["params"] == sum(counts.values())
+        ok = ok and cost["trainable_params"] == trainable
+        ok = ok and all(cost["networks"][k]["params"] == v for k, v in counts.items())
+        passes += ok
+        total += 1
+        if verbose or not ok:
+            print(f"{name}: {cost['params']} / {cost['trainable_params']} {counts}")
+    print(f"agent_cost params passed {passes}/{total}")
+    return passes == total
+
+
+def scaling_test(verbose=False):
+    """PPO's update cost follows n_epochs and the number of minibatches"""
+    make = benchmark_agents(6, 0, [3, 4])["PG-gae"]
+    agent = make()
+    base = agent_cost(agent, batch_size=128)
+    agent.n_epochs *= 2
+    doubled = agent_cost(agent, batch_size=128)
+    agent.n_epochs //= 2
+    more = agent_cost(agent, batch_size=129)  # one more minibatch per epoch
+    ok = doubled["optimizer_flops"] == 2 * base["optimizer_flops"]
+    ok = ok and doubled["reinforcement_learn_flops"] > base["reinforcement_learn_flops"]
+    steps = agent.n_epochs * np.ceil(np.array([128, 129]) / agent.mini_batch_size)
+    ok = ok and more["optimizer_flops"] * steps[0] == base["optimizer_flops"] * steps[1]
+    if verbose or not ok:
+        print(f"base {base}\ndoubled epochs {doubled}\nbatch 129 {more}")
+    print(f"agent_cost PPO scaling passed: {ok}")
+    return ok
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    np.random.seed(0)
+    forward_flops_test()
+    params_test()
+    scaling_test()
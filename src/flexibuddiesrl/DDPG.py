@@ -2,7 +2,9 @@ import torch
 import torch.nn.functional as F
 import numpy as np
 from .Agent import Agent, MixedActor, ValueSA
-from .Util import T, get_multi_discrete_one_hot
+from .Util import T, get_multi_discrete_one_hot, n_step_targets, next_obs
+from .Checkpoint import save_training_state, load_training_state_file
+from .Instrumentation import Diagnostics, total_grad_norm
 from flexibuff import FlexiBatch
 import os
 import pickle
@@ -19,6 +21,7 @@ class DDPG(Agent):
         action_noise=0.1,
         hidden_dims=np.array([256, 256]),
         gamma=0.99,
+        n_step=1,
         policy_frequency=2,
         target_update_percentage=0.01,
         name="Test_ddpg",
@@ -44,6 +47,10 @@ class DDPG(Agent):
             The hidden dimensions of the actor and critic
         gamma: float
             The discount factor
+        n_step: int
+            Steps of reward summed before bootstrapping. When this is more
+            than 1 batches must be time ordered (one env / episode stream) or
+            come from TorchReplayBuffer.for_agent, see Util.n_step_targets
         policy_frequency: int
             The frequency of policy updates
         target_update_percentage: float
@@ -66,6 +73,7 @@ class DDPG(Agent):
         self.target_update_percentage = target_update_percentage
         self.rand_steps = rand_steps
         self.gamma = gamma
+        self.n_step = n_step
         self.policy_frequency = policy_frequency
         self.eval_mode = eval_mode
         self.name = name
@@ -93,6 +101,7 @@ class DDPG(Agent):
             tau=0.3,
             hard=False,
         )
+        self.obs_dim = obs_dim
         self.discrete_action_dims = discrete_action_dims
         self.continuous_action_dim = continuous_action_dim
         self.action_noise = action_noise
@@ -126,18 +135,24 @@ class DDPG(Agent):
             noise = noise.squeeze(0)
         return noise
 
-    def _get_random_actions(self, action_mask=None, debug=False):
+    def _get_random_actions(self, action_mask=None, debug=False, batch_shape=()):
 
         continuous_actions = (
-            torch.rand(size=(self.continuous_action_dim,), device=self.device) * 2 - 1
+            torch.rand(
+                size=(*batch_shape, self.continuous_action_dim), device=self.device
+            )
+            * 2
+            - 1
         ) * self.actor.action_scales - self.actor.action_biases
         discrete_actions = torch.zeros(
-            (len(self.discrete_action_dims)),
+            (*batch_shape, len(self.discrete_action_dims)),
             device=self.device,
             dtype=torch.long,  # used to be (1,len...) but I think this is not needed
         )
         for dim, dim_size in enumerate(self.discrete_action_dims):
-            discrete_actions[dim] = torch.randint(dim_size, (1,))
+            discrete_actions[..., dim] = torch.randint(
+                dim_size, batch_shape, device=self.device
+            )
         return discrete_actions, continuous_actions
 
     def train_actions(self, observations, action_mask=None, step=False, debug=False):
@@ -146,9 +161,11 @@ class DDPG(Agent):
             print("DDPG train_actions Observations: ", observations)
         if step:
             self.step += 1
+            if self.metrics is not None:
+                self.metrics.inc("env_steps", int(np.prod(observations.shape[:-1])))
         if self.step < self.rand_steps:
             discrete_actions, continuous_actions = self._get_random_actions(
-                action_mask, debug=debug
+                action_mask, debug=debug, batch_shape=observations.shape[:-1]
             )
             return (
                 discrete_actions.detach().cpu().numpy(),
@@ -157,6 +174,7 @@ class DDPG(Agent):
                 None,
                 None,
             )
+        self.timer.start("forward")
         with torch.no_grad():
             continuous_actions, discrete_action_activations = self.actor(
                 x=observations, action_mask=action_mask, gumbel=True, debug=debug
@@ -201,7 +219,7 @@ class DDPG(Agent):
             for i, activation in enumerate(discrete_action_activations):
                 if debug:
                     print("DDPG train_actions activation: ", activation)
-                discrete_actions[i] = torch.argmax(activation, dim=-1)
+                discrete_actions[..., i] = torch.argmax(activation, dim=-1)
 
             if debug:
                 print(
@@ -209,8 +227,10 @@ class DDPG(Agent):
                     discrete_actions,
                 )
 
+            self.timer.start("to_numpy")
             discrete_actions = discrete_actions.detach().cpu().numpy()
             continuous_actions = continuous_actions.detach().cpu().numpy()
+            self.timer.stop()
             return (
                 discrete_actions,
                 continuous_actions,
@@ -220,11 +240,18 @@ class DDPG(Agent):
             )
 
     def reinforcement_learn(
-        self, batch: FlexiBatch, agent_num=0, critic_only=False, debug=False
+        self,
+        batch: FlexiBatch,
+        agent_num=0,
+        critic_only=False,
+        debug=False,
+        weights=None,  # per-sample importance weights, e.g. from prioritized replay
+        return_td_errors=False,  # also return |target - Q| per sample, shape [B]
     ):
         aloss_item = 0
         closs_item = 0
         self.rl_step += 1
+        self.timer.start("target")
         with torch.no_grad():
             if batch.action_mask is not None:
                 mask = batch.action_mask[agent_num]
@@ -232,8 +259,18 @@ class DDPG(Agent):
             else:
                 mask = 1.0
                 mask_ = 1.0
+            rewards = batch.global_rewards
+            discount = self.gamma * (1 - batch.terminated)
+            obs_ = next_obs(batch, agent_num)
+            n_step = n_step_targets(batch, self.gamma, self.n_step)
+            if n_step is not None:
+                rewards, discount, last = n_step
+                if last is not None:
+                    obs_ = obs_[last]
+                    if torch.is_tensor(mask_):
+                        mask_ = mask_[last]
             continuous_actions_, discrete_action_activations_ = self.actor_target(
-                batch.obs_[agent_num], mask_, gumbel=True
+                obs_, mask_, gumbel=True
             )
 
             if len(discrete_action_activations_) == 1:
@@ -253,12 +290,11 @@ class DDPG(Agent):
                 print("DDPG reinforcement_learn daa: ", daa_)
                 # input()
             actions_ = torch.cat([continuous_actions_, daa_], dim=-1)
-            qtarget = self.critic_target(batch.obs_[agent_num], actions_).squeeze(-1)
+            qtarget = self.critic_target(obs_, actions_).squeeze(-1)
             # TODO configure reward channel beyong just global_rewards
-            next_q_value = (
-                batch.global_rewards + (1 - batch.terminated) * self.gamma * qtarget
-            )
+            next_q_value = rewards + discount * qtarget
         # for each discrete action, get the one hot coding and concatinate them
+        self.timer.start("forward")
 
         actions = torch.cat(
             [
@@ -272,18 +308,33 @@ class DDPG(Agent):
             dim=-1,
         )
         q_values = self.critic(batch.obs[agent_num], actions).squeeze(-1)
-        qf1_loss = F.mse_loss(q_values, next_q_value)
+        self.timer.start("loss")
+        diag = Diagnostics() if self.diagnostics else None
+        if diag is not None:
+            diag.add_stats("q", q_values)
+            diag.add("target_q_mean", next_q_value.mean())
+        if weights is None:
+            qf1_loss = F.mse_loss(q_values, next_q_value)
+        else:
+            qf1_loss = (weights * (q_values - next_q_value) ** 2).mean()
 
         # optimize the critic
+        self.timer.start("backward")
         self.critic_optimizer.zero_grad()
         qf1_loss.backward()
+        self.timer.start("optimizer")
+        if diag is not None:
+            diag.add("critic_grad_norm", total_grad_norm(self.critic.parameters()))
         self.critic_optimizer.step()
+        self.timer.start("to_numpy")
         closs_item = qf1_loss.item()
 
         if self.rl_step % self.policy_frequency == 0 and not critic_only:
+            self.timer.start("forward")
             c_act, d_act = self.actor(
                 x=batch.obs[agent_num], action_mask=mask, gumbel=True
             )
+            self.timer.start("loss")
             if len(d_act) == 1:
                 d_act = d_act[0]
             else:
@@ -291,11 +342,16 @@ class DDPG(Agent):
             actor_loss = -self.critic(
                 x=batch.obs[agent_num], u=torch.cat([c_act, d_act], dim=-1)
             ).mean()
+            self.timer.start("backward")
             self.actor_optimizer.zero_grad()
             actor_loss.backward()
+            self.timer.start("optimizer")
+            if diag is not None:
+                diag.add("actor_grad_norm", total_grad_norm(self.actor.parameters()))
             self.actor_optimizer.step()
 
             # update the target network
+            self.timer.start("target_update")
             for param, target_param in zip(
                 self.actor.parameters(), self.actor_target.parameters()
             ):
@@ -310,7 +366,18 @@ class DDPG(Agent):
                     self.target_update_percentage * param.data
                     + (1 - self.target_update_percentage) * target_param.data
                 )
+            self.timer.start("to_numpy")
             aloss_item = actor_loss.item()
+            if self.metrics is not None:
+                self.metrics.set("actor_loss", aloss_item)
+        if diag is not None:
+            self._publish_diagnostics(diag)
+        if self.metrics is not None:
+            self.metrics.inc("updates")
+            self.metrics.set("critic_loss", closs_item)
+        self.timer.step()
+        if return_td_errors:
+            return aloss_item, closs_item, (q_values - next_q_value).abs().detach()
         return aloss_item, closs_item
 
     def ego_actions(self, observations, action_mask=None):
@@ -319,23 +386,30 @@ class DDPG(Agent):
                 observations, action_mask, gumbel=False
             )
             discrete_actions = torch.zeros(
-                (observations.shape[0], len(discrete_action_activations)),
+                (*observations.shape[:-1], len(discrete_action_activations)),
                 device=self.device,
                 dtype=torch.float32,
             )
             for i, activation in enumerate(discrete_action_activations):
-                discrete_actions[:, i] = torch.argmax(activation, dim=1)
+                discrete_actions[..., i] = torch.argmax(activation, dim=-1)
             return discrete_actions, continuous_actions
 
-    def imitation_learn(self, observations, continuous_actions, discrete_actions):
-        con_a, disc_a = self.actor.forward(observations, gumbel=False)
-        loss = F.mse_loss(con_a, continuous_actions) + F.cross_entropy(
-            disc_a, discrete_actions
+    def imitation_loss(
+        self,
+        observations,
+        continuous_actions=None,
+        discrete_actions=None,
+        action_mask=None,
+    ):
+        return self.actor.imitation_loss(
+            observations, continuous_actions, discrete_actions, action_mask
         )
-        self.actor_optimizer.zero_grad()
-        loss.backward()
-        self.actor_optimizer.step()
 
+    def _imitation_optimizer(self):
+        return self.actor_optimizer
+
+    def _imitation_step(self):
+        self.actor_optimizer.step()
         # update the target network
         for param, target_param in zip(
             self.actor.parameters(), self.actor_target.parameters()
@@ -345,7 +419,27 @@ class DDPG(Agent):
                 + (1 - self.target_update_percentage) * target_param.data
             )
 
-        return loss
+    def imitation_learn(
+        self,
+        observations,
+        continuous_actions=None,
+        discrete_actions=None,
+        action_mask=None,
+        debug=False,
+    ):
+        dloss, closs = self.imitation_loss(
+            observations, continuous_actions, discrete_actions, action_mask
+        )
+        loss = dloss + closs
+        if torch.is_tensor(loss):  # no demonstrated actions leaves it at 0
+            self.actor_optimizer.zero_grad()
+            loss.backward()
+            self._imitation_step()
+        if torch.is_tensor(dloss):
+            dloss = dloss.item()
+        if torch.is_tensor(closs):
+            closs = closs.item()
+        return dloss, closs
 
     def utility_function(self, observations, actions=None):
         return 0  # Returns the single-agent critic for a single action.
@@ -403,6 +497,7 @@ class DDPG(Agent):
         torch.save(self.actor.state_dict(), checkpoint_path + "/actor")
         torch.save(self.actor_target.state_dict(), checkpoint_path + "/actor_target")
         self._dump_attr(self.step, checkpoint_path + "/step")
+        save_training_state(self, checkpoint_path)
 
     def load(self, checkpoint_path):
         if checkpoint_path is None:
@@ -422,3 +517,4 @@ class DDPG(Agent):
         f = open(checkpoint_path + "/step", "rb")
         self.step = pickle.load(f)
         f.close()
+        load_training_state_file(self, checkpoint_path)
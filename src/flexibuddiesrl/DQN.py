@@ -5,6 +5,9 @@ import torch
 from torch.distributions import Categorical
 from .Agent import Agent
 from .Agent import QS
+from .Util import n_step_targets, next_obs
+from .Checkpoint import save_training_state, load_training_state_file
+from .Instrumentation import Diagnostics, total_grad_norm
 from flexibuff import FlexiBatch
 import os
 import pickle
@@ -33,6 +36,7 @@ class DQN(nn.Module, Agent):
         hidden_dims=[64, 64],  # first is obs dim if encoder provded
         head_hidden_dim=0,  # if None then no head hidden layer
         gamma=0.99,
+        n_step=1,  # n-step targets, see Util.n_step_targets for the batches
         lr=3e-5,
         imitation_lr=1e-5,
         dueling=False,
@@ -54,6 +58,7 @@ class DQN(nn.Module, Agent):
     ):
         super(DQN, self).__init__()
         self.clip_grad = clip_grad
+        self.n_step = n_step
         if load_from_checkpoint_path is not None:
             self.load(load_from_checkpoint_path)
             return
@@ -111,7 +116,9 @@ class DQN(nn.Module, Agent):
             n_c_action_bins=n_c_action_bins,
             device=device,
             encoder=encoder,  # pass encoder if using one for observations (like in visual DQN)
-            head_hidden_dim=head_hidden_dim,  # if None then no head hidden layer
+            head_hidden_dims=(
+                [head_hidden_dim] if head_hidden_dim else None
+            ),  # if None then no head hidden layer
         )
 
         self.Q1.to(device)
@@ -167,52 +174,54 @@ class DQN(nn.Module, Agent):
     def _e_greedy_train_action(
         self, observations, action_mask=None, step=False, debug=False
     ):
+        # observations are [n_envs, obs_dim], each row explores independently
         disc_act, cont_act = None, None
         if self.init_eps > 0.0:
             self.eps = self.init_eps * (
                 1 - self.step / (self.step + self.eps_decay_half_life)
             )
-        value = 0
-        if self.init_eps > 0.0 and np.random.rand() < self.eps:
-            if (
-                self.discrete_action_dims is not None
-                and len(self.discrete_action_dims) > 0
-            ):
-                disc_act = np.zeros(
-                    shape=len(self.discrete_action_dims), dtype=np.int32
-                )
-                for i in range(len(self.discrete_action_dims)):
-                    disc_act[i] = np.random.randint(0, self.discrete_action_dims[i])
+        n = observations.shape[0]
+        explore = np.zeros(n, dtype=bool)
+        if self.init_eps > 0.0:
+            explore = np.random.rand(n) < self.eps
+        has_disc = (
+            self.discrete_action_dims is not None and len(self.discrete_action_dims) > 0
+        )
+        if has_disc:
+            disc_act = np.zeros((n, len(self.discrete_action_dims)), dtype=np.int32)
+        if self.continuous_action_dims > 0:
+            cont_act = np.zeros((n, self.continuous_action_dims), dtype=np.float32)
 
-            if self.continuous_action_dims > 0:
-                cont_act = (
-                    np.random.rand(self.continuous_action_dims) - 0.5
-                ) * self.np_action_ranges + self.np_action_means
-            # print(disc_act)
-        else:
+        if not explore.all():
+            self.timer.start("forward")
             with torch.no_grad():
-                # print("Getting value from Q1 for soft action selection")
-                value, disc_act, cont_act = self.Q1(observations, action_mask)
-                # print("done with that")
+                value, dac, cac = self.Q1(observations, action_mask)
+                self.timer.start("to_numpy")
                 # select actions from q function
-                # print(value, disc_act, cont_act)
-                if (
-                    self.discrete_action_dims is not None
-                    and len(self.discrete_action_dims) > 0
-                ):
-                    d_act = np.zeros(len(disc_act), dtype=np.int32)
-                    for i, da in enumerate(disc_act):
-                        d_act[i] = torch.argmax(da).detach().cpu().item()
-                    disc_act = d_act
+                if has_disc:
+                    for i, da in enumerate(dac):
+                        disc_act[:, i] = torch.argmax(da, dim=-1).cpu().numpy()
                 if self.continuous_action_dims > 0:
                     if debug:
                         print(
-                            f"  cont act {cont_act}, argmax: {torch.argmax(cont_act,dim=-1).detach().cpu()}"
+                            f"  cont act {cac}, argmax: {torch.argmax(cac,dim=-1).detach().cpu()}"
                         )
                         print(
-                            f"  Trying to store this in actions {((torch.argmax(cont_act,dim=-1)/ (self.n_c_action_bins - 1) -0.5)* self.action_ranges+ self.action_means)} calculated from da: {cont_act} with ranges: {self.action_ranges} and means: {self.action_means}"
+                            f"  Trying to store this in actions {((torch.argmax(cac,dim=-1)/ (self.n_c_action_bins - 1) -0.5)* self.action_ranges+ self.action_means)} calculated from da: {cac} with ranges: {self.action_ranges} and means: {self.action_means}"
                         )
-                    cont_act = self._cont_from_q(cont_act).cpu().numpy()
+                    cont_act[:] = self._cont_from_q(cac).cpu().numpy()
+            self.timer.stop()
+        if explore.any():
+            n_exp = int(explore.sum())
+            if has_disc:
+                for i in range(len(self.discrete_action_dims)):
+                    disc_act[explore, i] = np.random.randint(
+                        0, self.discrete_action_dims[i], size=n_exp
+                    )
+            if self.continuous_action_dims > 0:
+                cont_act[explore] = (
+                    np.random.rand(n_exp, self.continuous_action_dims) - 0.5
+                ) * self.np_action_ranges + self.np_action_means
         return disc_act, cont_act
 
     def _soft_train_action(self, observations, action_mask, step, debug):
@@ -238,12 +247,22 @@ class DQN(nn.Module, Agent):
         return disc_act, cont_act
 
     def train_actions(self, observations, action_mask=None, step=False, debug=False):
-        if len(observations.shape) == 1:
-            observations = np.expand_dims(observations, axis=0)
+        single = len(observations.shape) == 1
+        if single:
+            observations = observations[None]
+            if action_mask is not None:
+                action_mask = action_mask[None]
         disc_act, cont_act = self._e_greedy_train_action(
             observations, action_mask, step, debug
         )
+        if single:
+            disc_act = disc_act[0] if disc_act is not None else None
+            cont_act = cont_act[0] if cont_act is not None else None
         self.step += int(step)
+        if self.metrics is not None:
+            if step:
+                self.metrics.inc("env_steps", observations.shape[0])
+            self.metrics.set("eps", self.eps)
         return disc_act, cont_act, 0.0, 0.0, 0.0
 
     def ego_actions(self, observations, action_mask=None):
@@ -263,7 +282,7 @@ class DQN(nn.Module, Agent):
             # print(continuous_actions)
             for i in range(self.continuous_action_dims):
                 continuous_loss += nn.CrossEntropyLoss()(
-                    cont_adv[i], continuous_actions[:, i]
+                    cont_adv[:, i], continuous_actions[:, i]
                 )
 
         return discrete_loss, continuous_loss
@@ -282,14 +301,40 @@ class DQN(nn.Module, Agent):
         if self.continuous_action_dims is not None and self.continuous_action_dims > 0:
             continuous_actions = self._discretize_actions(cont_act)
             # print(continuous_actions)
-            for i in range(len(self.continuous_action_dims)):
-                best_q, best_a = torch.max(cont_adv[i], -1)
+            for i in range(self.continuous_action_dims):
+                best_q, best_a = torch.max(cont_adv[:, i], -1)
                 mask = best_a != continuous_actions[:, i]
                 continuous_loss += nn.MSELoss(reduction="none")(
                     best_q + mask, best_q.detach()
                 ).mean()
         return discrete_loss, continuous_loss
 
+    def imitation_loss(
+        self,
+        observations,
+        continuous_actions=None,
+        discrete_actions=None,
+        action_mask=None,
+    ):
+        values, disc_adv, cont_adv = self.Q1(observations)
+        if self.imitation_type == "cross_entropy":
+            return self._bc_cross_entropy_loss(
+                disc_adv, cont_adv, discrete_actions, continuous_actions
+            )
+        return self._reward_imitation_loss(
+            disc_adv, cont_adv, discrete_actions, continuous_actions
+        )
+
+    def _imitation_step(self):
+        if self.clip_grad is not None and self.clip_grad > 0:
+            torch.nn.utils.clip_grad_norm_(
+                self.parameters(),
+                self.clip_grad,
+                error_if_nonfinite=True,
+                foreach=True,
+            )
+        self.optimizer.step()
+
     def imitation_learn(
         self,
         observations,
@@ -298,38 +343,25 @@ class DQN(nn.Module, Agent):
         action_mask=None,
         debug=False,
     ):
-        values, disc_adv, cont_adv = self.Q1(observations)
         if self.eval_mode:
             return 0, 0
-        else:
-            dloss, closs = 0, 0
-            if self.imitation_type == "cross_entropy":
-                dloss, closs = self._bc_cross_entropy_loss(
-                    disc_adv, cont_adv, discrete_actions, continuous_actions
-                )
-            else:
-                dloss, closs = self._reward_imitation_loss()
-            loss = dloss + closs
-            if loss == 0:
-                warnings.warn(
-                    "Loss is 0, not updating. Most likely due to continuous and discrete actions being None,0 respectively"
-                )
-                return 0, 0
-            self.optimizer.zero_grad()
-            loss.backward()
-            if self.clip_grad is not None and self.clip_grad > 0:
-                torch.nn.utils.clip_grad_norm_(
-                    self.parameters(),
-                    self.clip_grad,
-                    error_if_nonfinite=True,
-                    foreach=True,
-                )
-            self.optimizer.step()
-            if dloss != 0:
-                dloss = dloss.item()
-            if closs != 0:
-                closs = closs.item()
-            return dloss, closs
+        dloss, closs = self.imitation_loss(
+            observations, continuous_actions, discrete_actions, action_mask
+        )
+        loss = dloss + closs
+        if loss == 0:
+            warnings.warn(
+                "Loss is 0, not updating. Most likely due to continuous and discrete actions being None,0 respectively"
+            )
+            return 0, 0
+        self.optimizer.zero_grad()
+        loss.backward()
+        self._imitation_step()
+        if dloss != 0:
+            dloss = dloss.item()
+        if closs != 0:
+            closs = closs.item()
+        return dloss, closs
 
     def utility_function(self, observations, actions=None):
         return 0  # Returns the single-agent critic for a single action.
@@ -421,7 +453,9 @@ class DQN(nn.Module, Agent):
         with torch.no_grad():
             dQ_ = 0
             cQ_ = 0
-            next_values, next_disc_adv, next_cont_adv = self.Q1(batch.obs_[agent_num])
+            next_values, next_disc_adv, next_cont_adv = self.Q1(
+                next_obs(batch, agent_num)
+            )
             print(next_cont_adv.shape)
             # print(next_values)
             dnv_ = 0
@@ -658,9 +692,11 @@ class DQN(nn.Module, Agent):
         action_dim=None,
         jagged=True,
         debug=True,
+        discount=None,  # per-sample bootstrap discount, replaces gamma*(1-term)
     ):
         if jagged:  # discrete action bins are jagget
-            vals = values.squeeze(-1) if self.dueling else 0  # make it a column vector
+            # one value per head when dueling, discrete heads come first
+            head_vals = values if self.dueling else None
             # action_dim = len(self.discrete_action_dims)
             Q_ = torch.zeros(
                 size=(advantages[0].shape[0], len(action_dim)),
@@ -669,12 +705,13 @@ class DQN(nn.Module, Agent):
             )
             if debug:
                 print("Jagged target() q shape, adv shape, and value shape")
-                print(Q_.shape, vals)
+                print(Q_.shape, head_vals)
                 for i in range(len(action_dim)):
                     print("  " + str(advantages[i].shape))
                 # print(advantages)
 
             for i in range(len(action_dim)):
+                vals = head_vals[:, i] if head_vals is not None else 0
                 # Treat actions as probabalistic if using soft Q or m-dqn
                 if self.dqn_type == dqntype.Munchausen or self.dqn_type == dqntype.Soft:
                     lprobs = torch.log_softmax(
@@ -687,7 +724,9 @@ class DQN(nn.Module, Agent):
                             f"  M-DQN or Soft DQN: adv(max_a): {torch.max(advantages[i], dim=-1).values.shape}, vals: {vals.shape if self.dueling else values}"
                         )
 
-                    q_vals = vals + advantages[i]
+                    q_vals = (
+                        vals.unsqueeze(-1) if head_vals is not None else 0
+                    ) + advantages[i]
 
                     Q_[:, i] = torch.sum(
                         probs * (q_vals - self.entropy_loss_coef * lprobs), dim=-1
@@ -702,7 +741,6 @@ class DQN(nn.Module, Agent):
         else:  # continuous bins are not jagged
             if debug:
                 print(f"  Not Jagget target advantages: {advantages.shape}")
-            advantages = advantages.transpose(0, 1)
             # Treat actions as probabalistic if using soft Q or m-dqn
             if self.dqn_type == dqntype.Munchausen or self.dqn_type == dqntype.Soft:
                 lprobs = torch.log_softmax(advantages / self.entropy_loss_coef, dim=-1)
@@ -712,8 +750,10 @@ class DQN(nn.Module, Agent):
                         f"  M-DQN or Soft DQN: adv(max_a): {torch.max(advantages, dim=-1).values.shape}, vals: {values.shape if self.dueling else values}"
                     )
                 if self.dueling:
-                    vals = values.unsqueeze(-1).expand(
-                        advantages.shape
+                    vals = (
+                        values[:, -self.continuous_action_dims :]
+                        .unsqueeze(-1)
+                        .expand(advantages.shape)
                     )  # make it a column vector
                 else:
                     vals = 0
@@ -727,7 +767,7 @@ class DQN(nn.Module, Agent):
                     )
             else:
                 if self.dueling:
-                    vals = values
+                    vals = values[:, -self.continuous_action_dims :]
                 else:
                     vals = 0
                 if debug:
@@ -741,38 +781,55 @@ class DQN(nn.Module, Agent):
                 f"  Q_: {Q_.shape}, rewards: {rewards.unsqueeze(-1).shape}, terminated: {terminated.unsqueeze(-1).shape}"
             )
 
-        targets = (
-            rewards.unsqueeze(-1) + (self.gamma * (1 - terminated)).unsqueeze(-1) * Q_
-        )
+        if discount is None:
+            discount = self.gamma * (1 - terminated)
+        targets = rewards.unsqueeze(-1) + discount.unsqueeze(-1) * Q_
         if debug:
             print(f"  targets: {targets.shape}")
         return targets
 
     def reinforcement_learn(
-        self, batch: FlexiBatch, agent_num=0, critic_only=False, debug=False
+        self,
+        batch: FlexiBatch,
+        agent_num=0,
+        critic_only=False,
+        debug=False,
+        weights=None,  # per-sample importance weights, e.g. from prioritized replay
+        return_td_errors=False,  # also return |target - Q| per sample, shape [B]
     ):
         if self.eval_mode:
+            if return_td_errors:
+                return float(0.0), float(0.0), None
             return float(0.0), float(0.0)
 
         dqloss, cqloss = 0, 0
         discrete_actions = batch.discrete_actions[agent_num]  # type: ignore
-        continuous_actions = self._discretize_actions(
-            batch.continuous_actions[agent_num]  # type: ignore
-        )
+        continuous_actions = None
+        if self.continuous_action_dims > 0:
+            continuous_actions = self._discretize_actions(
+                batch.continuous_actions[agent_num]  # type: ignore
+            )
         if debug:
             print(
-                f"Discrete actions: {discrete_actions.shape}, Continuous actions: {continuous_actions.shape}"
+                f"Discrete actions: {discrete_actions.shape}, Continuous actions: {None if continuous_actions is None else continuous_actions.shape}"
             )
             print(
-                f"Batch obs: {batch.obs[agent_num].shape}, Batch obs_: {batch.obs_[agent_num].shape}"
+                f"Batch obs: {batch.obs[agent_num].shape}, Batch obs_: {next_obs(batch, agent_num).shape}"
             )
         discrete_target = 0
         continuous_target = 0
+        self.timer.start("forward")
         values, disc_adv, cont_adv = self.Q1(batch.obs[agent_num])
-        if cont_adv is not None:
-            cont_adv = cont_adv.transpose(0, 1)
+        self.timer.start("target")
         with torch.no_grad():
-            next_values, next_disc_adv, next_cont_adv = self.Q1(batch.obs_[agent_num])
+            rewards, discount = batch.global_rewards, None
+            obs_ = next_obs(batch, agent_num)
+            n_step = n_step_targets(batch, self.gamma, self.n_step)
+            if n_step is not None:
+                rewards, discount, last = n_step
+                if last is not None:
+                    obs_ = obs_[last]
+            next_values, next_disc_adv, next_cont_adv = self.Q1(obs_)
             if (
                 self.discrete_action_dims is not None
                 and len(self.discrete_action_dims) > 0
@@ -782,8 +839,9 @@ class DQN(nn.Module, Agent):
                 discrete_target = self._target(
                     values=next_values,
                     advantages=next_disc_adv,
-                    rewards=batch.global_rewards,
+                    rewards=rewards,
                     terminated=batch.terminated,
+                    discount=discount,
                     action_dim=self.discrete_action_dims,
                     jagged=True,
                     debug=debug,
@@ -808,8 +866,9 @@ class DQN(nn.Module, Agent):
                 continuous_target = self._target(
                     values=next_values,
                     advantages=next_cont_adv,
-                    rewards=batch.global_rewards,
+                    rewards=rewards,
                     terminated=batch.terminated,
+                    discount=discount,
                     jagged=False,
                     debug=debug,
                 )
@@ -827,6 +886,7 @@ class DQN(nn.Module, Agent):
                         .squeeze(-1)
                     )
 
+        self.timer.start("loss")
         if self.continuous_action_dims is not None and self.continuous_action_dims > 0:
             if debug:
                 print(
@@ -836,7 +896,9 @@ class DQN(nn.Module, Agent):
                 input=cont_adv,
                 dim=-1,
                 index=continuous_actions.unsqueeze(-1),
-            ).squeeze(-1) + (values if self.dueling else 0)
+            ).squeeze(-1) + (
+                values[:, -self.continuous_action_dims :] if self.dueling else 0
+            )
 
             if debug:
                 print(f"cQ: {cQ.shape}, continuous_target: {continuous_target.shape}")
@@ -859,40 +921,78 @@ class DQN(nn.Module, Agent):
                         dim=-1,
                         index=discrete_actions[:, d].unsqueeze(-1),
                     )
-                    + values
+                    + (values[:, d : d + 1] if self.dueling else 0)
                 ).squeeze(-1)
 
         dqloss, cqloss = 0, 0
         trainable = False
+        td_errors = []
+        grad_norm = None
+        diag = Diagnostics() if self.diagnostics else None
         if self.discrete_action_dims is not None and len(self.discrete_action_dims) > 0:
-            dqloss = (dQ - discrete_target) ** 2
+            if diag is not None:
+                diag.add_stats("discrete_q", dQ)
+                diag.add("discrete_target_mean", discrete_target.mean())
+            d_err = dQ - discrete_target
+            td_errors.append(d_err.detach().abs())
+            dqloss = d_err**2
+            if weights is not None:
+                dqloss = dqloss * weights.unsqueeze(-1)
             dqloss = dqloss.mean()
             trainable = True
 
         if self.continuous_action_dims is not None and self.continuous_action_dims > 0:
-            cqloss = (cQ - continuous_target) ** 2
+            if diag is not None:
+                diag.add_stats("continuous_q", cQ)
+                diag.add("continuous_target_mean", continuous_target.mean())
+            c_err = cQ - continuous_target
+            td_errors.append(c_err.detach().abs())
+            cqloss = c_err**2
+            if weights is not None:
+                cqloss = cqloss * weights.unsqueeze(-1)
             cqloss = cqloss.mean()
             trainable = True
         if trainable:
             loss = dqloss + cqloss
+            self.timer.start("backward")
             self.optimizer.zero_grad()
             loss.backward()
+            self.timer.start("optimizer")
             if self.clip_grad is not None and self.clip_grad > 0:
-                torch.nn.utils.clip_grad_norm_(
+                grad_norm = torch.nn.utils.clip_grad_norm_(
                     self.parameters(),
                     self.clip_grad,
                     error_if_nonfinite=True,
                     foreach=True,
                 )
+            if diag is not None:
+                if grad_norm is None:
+                    grad_norm = total_grad_norm(self.parameters())
+                diag.add("grad_norm", grad_norm)
             self.optimizer.step()
         else:
             warnings.warn(
                 "Action dims both zero so there is nothing to train. Not updating the model."
             )
+        self.timer.start("to_numpy")
         if dqloss != 0:
             dqloss = dqloss.item()
         if cqloss != 0:
             cqloss = cqloss.item()
+        if diag is not None:
+            self._publish_diagnostics(diag)
+        if self.metrics is not None:
+            self.metrics.inc("updates")
+            self.metrics.set("discrete_q_loss", float(dqloss))
+            self.metrics.set("continuous_q_loss", float(cqloss))
+            self.metrics.set("lr", self.optimizer.param_groups[0]["lr"])
+            if grad_norm is not None:
+                self.metrics.set("grad_norm", grad_norm)
+        self.timer.step()
+        if return_td_errors:
+            # mean over the discrete and continuous heads of each sample
+            td = torch.cat(td_errors, dim=-1).mean(-1) if len(td_errors) > 0 else None
+            return float(dqloss), float(cqloss), td
         return float(dqloss), float(cqloss)  # actor loss, critic loss
 
     def _dump_attr(self, attr, path):
@@ -919,6 +1019,7 @@ class DQN(nn.Module, Agent):
             self._dump_attr(
                 self.__dict__[self.attrs[i]], checkpoint_path + f"/{self.attrs[i]}"
             )
+        save_training_state(self, checkpoint_path)
 
     def load(self, checkpoint_path):
         if checkpoint_path is None:
@@ -941,7 +1042,7 @@ class DQN(nn.Module, Agent):
             self.np_action_means = (self.max_actions + self.min_actions) / 2
             self.action_means = torch.from_numpy(self.np_action_means).to(self.device)
 
-        if self.Q1 is None:
+        if getattr(self, "Q1", None) is None:
             self.Q1 = QS(
                 obs_dim=self.obs_dim,
                 continuous_action_dim=self.continuous_action_dims,
@@ -958,6 +1059,8 @@ class DQN(nn.Module, Agent):
 
         self.optimizer = torch.optim.Adam(self.Q1.parameters(), lr=self.lr)
         self.to(self.device)
+        # optimizer moments, eps / step counters and rng, if the save has them
+        load_training_state_file(self, checkpoint_path)
 
     def __str__(self):
         st = ""
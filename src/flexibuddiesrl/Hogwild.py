@@ -0,0 +1,161 @@
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from flexibuff import FlexiBatch
+from .PG_stabalized import PG
+
+
+class SharedAdam(torch.optim.Adam):
+    """
+    Adam whose moment estimates live in shared memory so that every hogwild
+    worker updates the same optimizer state. The state is created eagerly
+    because torch would otherwise allocate it lazily (and privately) inside
+    each worker on the first step.
+    """
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0):
+        super(SharedAdam, self).__init__(
+            params, lr=lr, betas=betas, eps=eps, weight_decay=weight_decay
+        )
+        for group in self.param_groups:
+            for p in group["params"]:
+                state = self.state[p]
+                state["step"] = torch.zeros((), dtype=torch.float32)
+                state["exp_avg"] = torch.zeros_like(p.data)
+                state["exp_avg_sq"] = torch.zeros_like(p.data)
+                if group["amsgrad"]:
+                    state["max_exp_avg_sq"] = torch.zeros_like(p.data)
+
+    def share_memory(self):
+        for group in self.param_groups:
+            for p in group["params"]:
+                for v in self.state[p].values():
+                    if torch.is_tensor(v):
+                        v.share_memory_()
+        return self
+
+
+def make_hogwild(agent: PG, shared_optimizer=True):
+    """
+    Moves the actor, critic and actor_logstd of a PG agent into shared memory
+    so that several processes can apply reinforcement_learn gradients to the
+    same weights without locking.
+    shared_optimizer: if True the Adam moments are shared between workers too,
+        otherwise every worker builds its own optimizer when it starts.
+    """
+    assert str(agent.device) == "cpu", "Hogwild training needs the agent on the cpu"
+    agent.share_memory()
+    if shared_optimizer:
+        agent.optimizer = SharedAdam(agent.parameters(), lr=agent.lr).share_memory()
+    return agent
+
+
+def _hogwild_entry(rank, agent, worker_fn, shared_optimizer, worker_args):
+    # one thread per worker, otherwise the workers fight over the cores
+    torch.set_num_threads(1)
+    torch.manual_seed(torch.initial_seed() + rank)
+    np.random.seed((np.random.randint(0, 2**31 - 1) + rank) % (2**31 - 1))
+    if not shared_optimizer:
+        agent.optimizer = torch.optim.Adam(agent.parameters(), lr=agent.lr)
+    worker_fn(agent, rank, *worker_args)
+
+
+def train_hogwild(
+    agent: PG,
+    worker_fn,
+    n_workers=4,
+    shared_optimizer=True,
+    worker_args=(),
+    start_method="spawn",
+):
+    """
+    Runs worker_fn(agent, rank, *worker_args) in n_workers processes which all
+    train the same shared-memory agent lock free. worker_fn must be a top level
+    function so it can be pickled, pg_rollout_worker is a ready made one.
+    Returns the (shared) agent once all of the workers have finished.
+    """
+    make_hogwild(agent, shared_optimizer)
+    ctx = mp.get_context(start_method)
+    processes = []
+    for rank in range(n_workers):
+        p = ctx.Process(
+            target=_hogwild_entry,
+            args=(rank, agent, worker_fn, shared_optimizer, worker_args),
+        )
+        p.start()
+        processes.append(p)
+    for p in processes:
+        p.join()
+    for rank, p in enumerate(processes):
+        if p.exitcode != 0:
+            raise RuntimeError(f"Hogwild worker {rank} exited with code {p.exitcode}")
+    return agent
+
+
+def pg_rollout_worker(agent: PG, rank, env_fn, n_steps=10000, rollout_len=256):
+    """
+    Default hogwild worker: steps its own env built by env_fn(), collects
+    rollout_len transitions and then calls reinforcement_learn on them.
+    Discrete envs use the first discrete head and continuous envs use the
+    continuous actions.
+    """
+    env = env_fn()
+    discrete = agent.discrete_action_dims is not None
+    obs, _ = env.reset(seed=rank)
+    rollout = {
+        "obs": [],
+        "obs_": [],
+        "global_rewards": [],
+        "discrete_actions": [],
+        "discrete_log_probs": [],
+        "continuous_actions": [],
+        "continuous_log_probs": [],
+    }
+    terminated_list = []
+    truncated_list = []
+    for step in range(n_steps):
+        dact, cact, dlp, clp, _ = agent.train_actions(obs, step=True)
+        action = int(dact[0]) if discrete else cact
+        obs_, reward, terminated, truncated, _ = env.step(action)
+
+        rollout["obs"].append(obs)
+        rollout["obs_"].append(obs_)
+        rollout["global_rewards"].append(reward)
+        rollout["discrete_actions"].append(dact if dact is not None else [0])
+        rollout["discrete_log_probs"].append(dlp if dlp is not None else [0.0])
+        rollout["continuous_actions"].append(cact if cact is not None else [0.0])
+        rollout["continuous_log_probs"].append(clp if clp is not None else 0.0)
+        terminated_list.append(terminated)
+        truncated_list.append(truncated)
+
+        obs = obs_
+        if terminated or truncated:
+            obs, _ = env.reset()
+
+        if len(terminated_list) >= rollout_len:
+            batch = FlexiBatch(
+                registered_vals={
+                    k: (
+                        np.array(
+                            [v],
+                            dtype=np.int64 if k == "discrete_actions" else np.float32,
+                        )
+                        if k != "global_rewards"
+                        else np.array(v, dtype=np.float32)
+                    )
+                    for k, v in rollout.items()
+                },
+                # folded like RolloutCollector.env_batches so GAE stops at
+                # the reset, truncated is kept for agents that bootstrap
+                terminated=np.logical_or(terminated_list, truncated_list).astype(
+                    np.float32
+                ),
+                truncated=np.array(truncated_list, dtype=np.float32),
+            )
+            batch.to_torch("cpu")
+            agent.reinforcement_learn(batch, 0)
+            for v in rollout.values():
+                v.clear()
+            terminated_list.clear()
+            truncated_list.clear()
+    env.close()
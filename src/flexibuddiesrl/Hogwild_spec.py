@@ -0,0 +1,38 @@
+import numpy as np
+import torch
+import gymnasium as gym
+from flexibuddiesrl.PG_stabalized import PG
+from flexibuddiesrl.Hogwild import train_hogwild, pg_rollout_worker
+
+
+def make_env():
+    return gym.make("CartPole-v1")
+
+
+def train_hogwild_test(verbose=False):
+    """Two workers training the shared agent both end up changing its weights"""
+    agent = PG(
+        obs_dim=4,
+        discrete_action_dims=[2],
+        continuous_action_dim=0,
+        hidden_dims=[32, 32],
+    )
+    before = [p.detach().clone() for p in agent.parameters()]
+    # 4 rollouts of 64 steps and so 4 updates per worker
+    train_hogwild(
+        agent, pg_rollout_worker, n_workers=2, worker_args=(make_env, 256, 64)
+    )
+    changed = [not torch.equal(b, p) for b, p in zip(before, agent.parameters())]
+    finite = all(torch.isfinite(p).all() for p in agent.parameters())
+    stepped = int(agent.optimizer.state[next(agent.actor.parameters())]["step"])
+    ok = any(changed) and finite and stepped > 0
+    if verbose or not ok:
+        print(f"{sum(changed)}/{len(changed)} tensors changed, adam steps {stepped}")
+    print(f"train_hogwild shared weights updated: {ok}")
+    return ok
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    np.random.seed(0)
+    train_hogwild_test()
@@ -0,0 +1,224 @@
+import time
+import numpy as np
+import torch
+
+
+def _to(x, device, dtype=None):
+    if x is None:
+        return None
+    if isinstance(x, (list, tuple)):
+        # one action mask per discrete head
+        return [_to(v, device, dtype) for v in x]
+    if not torch.is_tensor(x):
+        x = torch.as_tensor(np.asarray(x))
+    return x.to(device=device, dtype=dtype, non_blocking=True)
+
+
+def _rows(x, idx):
+    if x is None:
+        return None
+    if isinstance(x, list):
+        return [v[idx] for v in x]
+    return x[idx]
+
+
+def _scalar(x, device):
+    return torch.as_tensor(x, device=device).detach().float().reshape(())
+
+
+def _is_dataset(data):
+    # a single dataset rather than a stream of chunks
+    return isinstance(data, (tuple, dict)) or hasattr(data, "terminated")
+
+
+def demonstrations(data, agent_num=0):
+    """
+    (obs, continuous_actions, discrete_actions, action_mask) from a
+    (obs, cont, disc) or (obs, cont, disc, mask) tuple, a dict with those keys
+    or a FlexiBatch (agent agent_num's slice). Missing entries are None.
+    """
+    if isinstance(data, tuple):
+        obs, cont, disc = data[:3]
+        return obs, cont, disc, data[3] if len(data) > 3 else None
+    if isinstance(data, dict):
+        return (
+            data["obs"],
+            data.get("continuous_actions"),
+            data.get("discrete_actions"),
+            data.get("action_mask"),
+        )
+    out = []
+    for name in ["obs", "continuous_actions", "discrete_actions", "action_mask"]:
+        v = getattr(data, name, None)
+        out.append(None if v is None else v[agent_num])
+    return tuple(out)
+
+
+class ImitationTrainer:
+    """
+    Multi epoch behaviour cloning for any agent with imitation_loss (DQN, PG,
+    PPO, TD3, DDPG):
+
+        trainer = ImitationTrainer(agent, batch_size=512, accumulate=4)
+        stats = trainer.fit((obs, continuous_actions, discrete_actions), epochs=10)
+        stats["samples_per_s"], stats["discrete_loss"]
+
+    fit takes either one dataset (a tuple, dict or FlexiBatch, see
+    demonstrations) that is moved to the device once, or a stream of such
+    chunks: an iterable, or a callable returning one so that it can be
+    restarted every epoch. Each chunk is shuffled on device with randperm and
+    cut into minibatches, nothing goes back through the host.
+
+    batch_size: samples per forward / backward, bounds activation memory
+    accumulate: minibatches whose gradients are summed into one optimizer
+        step, the effective batch is batch_size * accumulate
+    drop_last: skip a chunk's trailing minibatch smaller than batch_size
+    seed: seed for the on device shuffle generator
+    """
+
+    def __init__(
+        self,
+        agent,
+        batch_size=256,
+        accumulate=1,
+        shuffle=True,
+        drop_last=False,
+        device=None,
+        agent_num=0,
+        seed=None,
+    ):
+        assert accumulate >= 1, "accumulate has to be at least 1"
+        self.agent = agent
+        self.batch_size = batch_size
+        self.accumulate = accumulate
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.device = torch.device(device or agent.device)
+        self.agent_num = agent_num
+        self.generator = None
+        if seed is not None:
+            self.generator = torch.Generator(device=self.device)
+            self.generator.manual_seed(seed)
+        self.steps = 0
+        self.samples = 0
+        self.history = []
+
+    def _chunks(self, data):
+        if callable(data):
+            data = data()
+        if _is_dataset(data):
+            return [data]
+        return data
+
+    def _step(self, optimizer, pending):
+        self.agent.timer.start("optimizer")
+        if pending < self.accumulate:
+            # a short trailing group was divided by accumulate, not its size
+            for group in optimizer.param_groups:
+                for p in group["params"]:
+                    if p.grad is not None:
+                        p.grad.mul_(self.accumulate / pending)
+        self.agent._imitation_step()
+        optimizer.zero_grad()
+        self.agent.timer.step()
+        self.steps += 1
+
+    def _epoch(self, data, cached):
+        agent = self.agent
+        optimizer = agent._imitation_optimizer()
+        sums = torch.zeros(2, device=self.device)
+        n_samples = 0
+        pending = 0
+        for chunk in cached if cached is not None else self._chunks(data):
+            if cached is None:
+                chunk = self._load(chunk)
+            obs, cont, disc, mask = chunk
+            n = obs.shape[0]
+            if self.shuffle:
+                order = torch.randperm(n, device=self.device, generator=self.generator)
+            else:
+                order = torch.arange(n, device=self.device)
+            for start in range(0, n, self.batch_size):
+                mb = order[start : start + self.batch_size]
+                if self.drop_last and mb.shape[0] < self.batch_size:
+                    break
+                agent.timer.start("loss")
+                dloss, closs = agent.imitation_loss(
+                    obs[mb], _rows(cont, mb), _rows(disc, mb), _rows(mask, mb)
+                )
+                loss = dloss + closs
+                if not torch.is_tensor(loss):
+                    continue  # no action kind this agent can learn from
+                agent.timer.start("backward")
+                (loss / self.accumulate).backward()
+                sums += mb.shape[0] * torch.stack(
+                    [_scalar(dloss, self.device), _scalar(closs, self.device)]
+                )
+                n_samples += mb.shape[0]
+                pending += 1
+                if pending == self.accumulate:
+                    self._step(optimizer, pending)
+                    pending = 0
+        if pending > 0:
+            self._step(optimizer, pending)
+        return sums, n_samples
+
+    def _load(self, chunk):
+        obs, cont, disc, mask = demonstrations(chunk, self.agent_num)
+        return (
+            _to(obs, self.device, torch.float32),
+            _to(cont, self.device, torch.float32),
+            _to(disc, self.device, torch.long),
+            _to(mask, self.device, torch.float32),
+        )
+
+    def fit(self, data, epochs=1, verbose=False):
+        """
+        Train for epochs passes over data. Losses are summed on device and
+        read back once per epoch, which is also where the timing syncs.
+        Returns the totals with the last epoch's mean losses, per epoch rows
+        are appended to self.history.
+        """
+        agent = self.agent
+        # a single dataset is moved to the device once, not every epoch
+        cached = [self._load(data)] if _is_dataset(data) else None
+        agent._imitation_optimizer().zero_grad()
+        start_steps, start_samples = self.steps, self.samples
+        start = time.perf_counter()
+        row = {"discrete_loss": 0.0, "continuous_loss": 0.0}
+        for epoch in range(epochs):
+            t = time.perf_counter()
+            sums, n = self._epoch(data, cached)
+            dloss, closs = (sums / max(1, n)).tolist()
+            seconds = time.perf_counter() - t
+            self.samples += n
+            row = {
+                "epoch": len(self.history),
+                "samples": n,
+                "seconds": seconds,
+                "samples_per_s": n / seconds if seconds > 0 else 0.0,
+                "discrete_loss": dloss,
+                "continuous_loss": closs,
+            }
+            self.history.append(row)
+            if agent.metrics is not None:
+                agent.metrics.inc("imitation_samples", n)
+                agent.metrics.set("imitation_samples_per_s", row["samples_per_s"])
+                agent.metrics.set("imitation_discrete_loss", dloss)
+                agent.metrics.set("imitation_continuous_loss", closs)
+            if verbose:
+                print(
+                    f"epoch {row['epoch']}: dloss {dloss:.5f} closs {closs:.5f} "
+                    f"{row['samples_per_s']:.0f} samples/s"
+                )
+        seconds = time.perf_counter() - start
+        samples = self.samples - start_samples
+        return {
+            "epochs": epochs,
+            "steps": self.steps - start_steps,
+            "samples": samples,
+            "seconds": seconds,
+            "samples_per_s": samples / seconds if seconds > 0 else 0.0,
+            "discrete_loss": row["discrete_loss"],
+            "continuous_loss": row["continuous_loss"],
+        }
@@ -0,0 +1,473 @@
+import os
+import time
+from collections import defaultdict
+import numpy as np
+import torch
+import torch.nn as nn
+from .Checkpoint import (
+    agent_modules,
+    agent_optimizers,
+    snapshot,
+    load_snapshot,
+    _cpu_copy,
+)
+
+# Phase names used by the agents, any other string works as well
+PHASES = [
+    "forward",
+    "to_numpy",
+    "advantage",
+    "target",
+    "loss",
+    "backward",
+    "optimizer",
+    "target_update",
+]
+
+
+class PhaseTimer:
+    """
+    Accumulates wall time per named phase of an agent's acting / learning code.
+    Phases are sequential, starting one ends the previous one:
+
+        t = agent.timer
+        t.start("forward")
+        ...
+        t.start("backward")
+        loss.backward()
+        t.stop()
+        t.step()  # once per reinforcement_learn call
+
+    A disabled timer that is not profiling returns from start / stop / step
+    after a single attribute check, so agents can always call it.
+
+    enabled: accumulate wall time per phase, see report()
+    cuda_sync: synchronize cuda at every phase boundary so gpu work is
+        charged to the phase that launched it (slows training down)
+    """
+
+    def __init__(self, enabled=False, cuda_sync=False):
+        self.enabled = enabled
+        self.cuda_sync = cuda_sync
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.n_steps = 0
+        self._active = enabled
+        self._phase = None
+        self._t0 = 0.0
+        self._range = None
+        self._profiler = None
+        self._profile_at = None
+        self._profile_steps = 0
+        self._profile_path = None
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        self._active = enabled or self._profile_at is not None
+        return self
+
+    def start(self, name):
+        if not self._active:
+            return
+        if self._phase is not None:
+            self.stop()
+        if self.cuda_sync and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        if self._profiler is not None:
+            self._range = torch.autograd.profiler.record_function(name)
+            self._range.__enter__()
+        self._phase = name
+        self._t0 = time.perf_counter()
+
+    def stop(self):
+        if not self._active or self._phase is None:
+            return
+        if self.cuda_sync and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        if self.enabled:
+            self.totals[self._phase] += time.perf_counter() - self._t0
+            self.counts[self._phase] += 1
+        if self._range is not None:
+            self._range.__exit__(None, None, None)
+            self._range = None
+        self._phase = None
+
+    def step(self):
+        """Marks the end of one update, drives profile()"""
+        if not self._active:
+            return
+        self.stop()
+        self.n_steps += 1
+        self._update_profiler()
+
+    def _update_profiler(self):
+        if self._profile_at is None:
+            return
+        if self._profiler is None and self.n_steps >= self._profile_at:
+            self._profiler = torch.profiler.profile(
+                activities=[torch.profiler.ProfilerActivity.CPU]
+                + (
+                    [torch.profiler.ProfilerActivity.CUDA]
+                    if torch.cuda.is_available()
+                    else []
+                ),
+                record_shapes=True,
+            )
+            self._profiler.__enter__()
+        elif self._profiler is not None:
+            if self.n_steps >= self._profile_at + self._profile_steps:
+                self._finish_profile()
+
+    def profile(self, path, n_steps=3, start_after=0):
+        """
+        Records a torch.profiler trace of n_steps updates, starting once
+        start_after more updates have finished, and writes it to path as a
+        Chrome trace (chrome://tracing or https://ui.perfetto.dev). Phases
+        show up as named ranges in the trace.
+        """
+        self._profile_at = self.n_steps + start_after
+        self._profile_steps = n_steps
+        self._profile_path = path
+        self._active = True
+        self._update_profiler()
+        return self
+
+    def _finish_profile(self):
+        self._profiler.__exit__(None, None, None)
+        d = os.path.dirname(os.path.abspath(self._profile_path))
+        os.makedirs(d, exist_ok=True)
+        self._profiler.export_chrome_trace(self._profile_path)
+        self._profiler = None
+        self._profile_at = None
+        self._active = self.enabled
+
+    def report(self):
+        """{phase: {"total_s", "count", "mean_ms", "fraction"}}, largest first"""
+        total = sum(self.totals.values())
+        rep = {}
+        for k in sorted(self.totals, key=lambda k: -self.totals[k]):
+            rep[k] = {
+                "total_s": self.totals[k],
+                "count": self.counts[k],
+                "mean_ms": self.totals[k] * 1000 / max(1, self.counts[k]),
+                "fraction": self.totals[k] / total if total > 0 else 0.0,
+            }
+        return rep
+
+    def reset(self):
+        self.totals.clear()
+        self.counts.clear()
+        self.n_steps = 0
+
+    def __str__(self):
+        return "\n".join(
+            f"{k}: {v['total_s']:.4f}s {v['fraction'] * 100:.1f}% ({v['count']} x {v['mean_ms']:.3f}ms)"
+            for k, v in self.report().items()
+        )
+
+    def __getstate__(self):
+        # a running profiler can not cross process boundaries
+        state = self.__dict__.copy()
+        state["_profiler"] = None
+        state["_range"] = None
+        return state
+
+
+class Diagnostics:
+    """
+    Collects training diagnostics as device tensors during an update so
+    nothing syncs until fetch(), which reads every value back with a single
+    .tolist(). Values added under the same name more than once (e.g. once per
+    minibatch) are averaged.
+
+        diag = Diagnostics()
+        diag.add("grad_norm", torch.nn.utils.clip_grad_norm_(...))
+        diag.fetch()  # {"grad_norm": 0.73}
+    """
+
+    def __init__(self):
+        self._sums = {}
+        self._counts = {}
+
+    def add(self, name, value):
+        value = torch.as_tensor(value).detach().float().reshape(())
+        if name in self._sums:
+            self._sums[name] = self._sums[name] + value
+            self._counts[name] += 1
+        else:
+            self._sums[name] = value
+            self._counts[name] = 1
+
+    def add_stats(self, name, values):
+        """mean / min / max of a tensor, e.g. the Q values of a batch"""
+        values = values.detach().float()
+        self.add(f"{name}_mean", values.mean())
+        self.add(f"{name}_min", values.min())
+        self.add(f"{name}_max", values.max())
+
+    def add_ratio(self, logratio, clip):
+        """PPO's approximate kl(old || new) and the fraction of clipped ratios"""
+        logratio = logratio.detach()
+        ratio = logratio.exp()
+        self.add("approx_kl", ((ratio - 1) - logratio).mean())
+        self.add("clip_fraction", ((ratio - 1).abs() > clip).float().mean())
+
+    def fetch(self):
+        if len(self._sums) == 0:
+            return {}
+        names = list(self._sums.keys())
+        device = self._sums[names[0]].device
+        means = torch.stack([self._sums[n].to(device) / self._counts[n] for n in names])
+        return dict(zip(names, means.tolist()))
+
+
+def total_grad_norm(parameters):
+    """Total L2 norm of the gradients as a device tensor, no host sync"""
+    grads = [p.grad for p in parameters if p.grad is not None]
+    if len(grads) == 0:
+        return torch.zeros(())
+    return torch.linalg.vector_norm(
+        torch.stack([torch.linalg.vector_norm(g) for g in grads])
+    )
+
+
+def explained_variance(values, returns):
+    """1 - Var(returns - values) / Var(returns), 1 is a perfect critic"""
+    values = values.detach().reshape(-1).float()
+    returns = returns.detach().reshape(-1).float()
+    var = returns.var()
+    return torch.where(
+        var > 0, 1 - (returns - values).var() / var, torch.zeros_like(var)
+    )
+
+
+def _nbytes(t):
+    return t.numel() * t.element_size()
+
+
+def _networks(agent):
+    """
+    {name: module} one level down, so a DQN reports Q1 and a PG reports
+    actor and critic instead of one lump. Parameters registered directly on
+    an nn.Module agent (PG's actor_logstd) are reported under "self".
+    """
+    nets = {}
+    for k, m in agent_modules(agent).items():
+        if k == "":
+            nets.update(dict(m.named_children()))
+            own = list(m.parameters(recurse=False)) + list(m.buffers(recurse=False))
+            if len(own) > 0:
+                nets["self"] = own
+        else:
+            nets[k] = m
+    return nets
+
+
+def _tensors_of(net, kind):
+    if isinstance(net, list):
+        if kind == "parameters":
+            return [t for t in net if isinstance(t, nn.Parameter)]
+        if kind == "buffers":
+            return [t for t in net if not isinstance(t, nn.Parameter)]
+        return [t.grad for t in net if t.grad is not None]
+    if kind == "parameters":
+        return list(net.parameters())
+    if kind == "buffers":
+        return list(net.buffers())
+    return [p.grad for p in net.parameters() if p.grad is not None]
+
+
+class _Saved:
+    # stands in for a tensor autograd saved for backward, the graph holds on to
+    # it until backward frees it, which is when __del__ gives the bytes back
+    __slots__ = ["tracker", "key", "t", "__weakref__"]
+
+    def __init__(self, tracker, key, t):
+        self.tracker = tracker
+        self.key = key
+        self.t = t
+
+    def __del__(self):
+        self.tracker._release(self.key)
+
+
+class ActivationTracker:
+    """
+    Context manager that records how many bytes autograd keeps alive for
+    backward, i.e. activation memory. Tensors that share a storage are counted
+    once and parameters are skipped since memory_report counts them already.
+
+        with ActivationTracker(exclude=agent_params) as t:
+            agent.reinforcement_learn(batch)
+        t.peak_bytes
+
+    On cuda the peak allocator growth over the block is recorded as well.
+    """
+
+    def __init__(self, exclude=()):
+        self.exclude = {t.untyped_storage().data_ptr() for t in exclude}
+        self.live_bytes = 0
+        self.peak_bytes = 0
+        self.cuda_peak_bytes = None
+        self._refs = {}
+        self._hooks = None
+        self._cuda_start = 0
+
+    def _pack(self, t):
+        try:
+            storage = t.untyped_storage()
+        except (RuntimeError, NotImplementedError):
+            return t
+        key = (storage.device.type, storage.data_ptr())
+        if storage.data_ptr() in self.exclude or storage.nbytes() == 0:
+            return t
+        ref = self._refs.get(key)
+        if ref is None:
+            self._refs[key] = [1, storage.nbytes()]
+            self.live_bytes += storage.nbytes()
+            self.peak_bytes = max(self.peak_bytes, self.live_bytes)
+        else:
+            ref[0] += 1
+        return _Saved(self, key, t)
+
+    def _unpack(self, saved):
+        return saved.t if isinstance(saved, _Saved) else saved
+
+    def _release(self, key):
+        ref = self._refs.get(key)
+        if ref is None:
+            return
+        ref[0] -= 1
+        if ref[0] == 0:
+            self.live_bytes -= ref[1]
+            del self._refs[key]
+
+    def __enter__(self):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            self._cuda_start = torch.cuda.memory_allocated()
+        self._hooks = torch.autograd.graph.saved_tensors_hooks(self._pack, self._unpack)
+        self._hooks.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self._hooks.__exit__(*exc)
+        self._hooks = None
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+            self.cuda_peak_bytes = torch.cuda.max_memory_allocated() - self._cuda_start
+        return False
+
+
+def _optimizer_state(opt):
+    return [
+        v for state in opt.state.values() for v in state.values() if torch.is_tensor(v)
+    ]
+
+
+def memory_report(agent, batch=None, agent_num=0, inplace=False):
+    """
+    Bytes held by an agent, broken down into
+
+        parameters:      {network: bytes}, targets show up as their own networks
+        gradients:       {network: bytes}, .grad tensors currently allocated
+        optimizer_state: {optimizer: bytes}, e.g. adam moments. Adam only
+                         allocates its moments on the first step, so an
+                         unstepped Adam family optimizer is estimated as 2x
+                         the bytes of its parameters and named in
+                         report["estimated"]
+        buffers:         {name: bytes}, module buffers and tensors / arrays the
+                         agent caches as attributes (action ranges, means ...)
+        total:           all of the above with shared storage counted once
+
+    If a batch is given one reinforcement_learn call is made on it and
+    report["update"] holds the peak bytes saved for backward during that call
+    (activation memory, scales with the batch size), plus the cuda allocator
+    peak when on gpu. optimizer_state is then read right after the update,
+    so every optimizer that stepped is measured rather than estimated.
+    Unless inplace=True the agent's weights, gradients, optimizer state,
+    counters and rng state are snapshotted before the update and put back
+    afterwards.
+    """
+    nets = _networks(agent)
+    seen = {}
+
+    def count(tensors):
+        n = 0
+        for t in tensors:
+            n += _nbytes(t)
+            seen[(t.device.type, t.data_ptr())] = _nbytes(t)
+        return n
+
+    report = {
+        "parameters": {k: count(_tensors_of(m, "parameters")) for k, m in nets.items()},
+        "gradients": {k: count(_tensors_of(m, "gradients")) for k, m in nets.items()},
+        "optimizer_state": {},
+        "buffers": {},
+        "estimated": [],
+    }
+    optimizers = agent_optimizers(agent)
+    for k, opt in optimizers.items():
+        report["optimizer_state"][k] = count(_optimizer_state(opt))
+        if report["optimizer_state"][k] == 0 and "betas" in opt.defaults:
+            # exp_avg and exp_avg_sq, one of each per parameter
+            estimate = 2 * sum(
+                _nbytes(p) for group in opt.param_groups for p in group["params"]
+            )
+            report["optimizer_state"][k] = estimate
+            report["estimated"].append(k)
+            seen[("estimate", k)] = estimate
+    for k, m in nets.items():
+        b = count(_tensors_of(m, "buffers"))
+        if b > 0:
+            report["buffers"][k] = b
+    params = {
+        (t.device.type, t.data_ptr())
+        for m in nets.values()
+        for t in _tensors_of(m, "parameters")
+    }
+    for k, v in vars(agent).items():
+        if torch.is_tensor(v) and (v.device.type, v.data_ptr()) not in params:
+            report["buffers"][k] = count([v])
+        elif isinstance(v, np.ndarray):
+            report["buffers"][k] = v.nbytes
+            seen[("numpy", id(v))] = v.nbytes
+    report["total"] = sum(seen.values())
+
+    if batch is not None:
+        if not inplace:
+            header, tensors = snapshot(agent)
+            tensors = {k: _cpu_copy(t) for k, t in tensors.items()}
+            grads = {
+                p: p.grad for m in nets.values() for p in _tensors_of(m, "parameters")
+            }
+            timer = agent.timer
+            agent.timer = PhaseTimer()
+        exclude = [t for m in nets.values() for t in _tensors_of(m, "parameters")]
+        try:
+            with ActivationTracker(exclude=exclude) as tracker:
+                agent.reinforcement_learn(batch, agent_num)
+            stepped = {
+                k: sum(_nbytes(t) for t in _optimizer_state(opt))
+                for k, opt in optimizers.items()
+            }
+        finally:
+            if not inplace:
+                load_snapshot(agent, header, tensors)
+                for p, g in grads.items():
+                    p.grad = g
+                agent.timer = timer
+        for k, n in stepped.items():
+            # e.g. TD3's actor is not stepped on every update
+            if n > 0:
+                report["total"] += n - report["optimizer_state"][k]
+                report["optimizer_state"][k] = n
+                if k in report["estimated"]:
+                    report["estimated"].remove(k)
+        report["update"] = {
+            "batch_size": len(batch.global_rewards),
+            "activation_peak_bytes": tracker.peak_bytes,
+            "cuda_peak_bytes": tracker.cuda_peak_bytes,
+        }
+    return report
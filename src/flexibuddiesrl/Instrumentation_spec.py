@@ -0,0 +1,172 @@
+import os
+import tempfile
+import numpy as np
+import torch
+from flexibuddiesrl.Benchmark import benchmark_agents, synthetic_batch
+from flexibuddiesrl.Instrumentation import (
+    PHASES,
+    Diagnostics,
+    total_grad_norm,
+    explained_variance,
+)
+
+
+def spec_agents():
+    """(name, constructor, continuous dims) for one agent of each kind"""
+    discrete = benchmark_agents(obs_dim=6, continuous_action_dim=0)
+    mixed = benchmark_agents(obs_dim=6, continuous_action_dim=2)
+    return [
+        ("DQN", discrete["DQN-egreedy"], 0),
+        ("PPO", discrete["PG-gae"], 0),
+        ("TD3", mixed["TD3"], 2),
+        ("DDPG", mixed["DDPG"], 2),
+    ]
+
+
+def phase_timer_test(verbose=False):
+    """Enabled timers see every update's phases, disabled ones record nothing"""
+    passes, total = 0, 0
+    for name, make, cdim in spec_agents():
+        batch = synthetic_batch(64, 6, cdim, [3, 4])
+        agent = make()
+        agent.reinforcement_learn(batch)
+        silent = agent.timer.n_steps == 0 and len(agent.timer.totals) == 0
+        agent.timer.enable()
+        for _ in range(3):
+            agent.reinforcement_learn(batch)
+        rep = agent.timer.report()
+        fractions = sum(v["fraction"] for v in rep.values())
+        ok = silent and agent.timer.n_steps == 3
+        ok = ok and {"backward", "optimizer"} <= set(rep) <= set(PHASES)
+        ok = ok and np.isclose(fractions, 1.0)
+        passes += ok
+        total += 1
+        if verbose or not ok:
+            print(f"{name}: {agent.timer.n_steps} steps\n{agent.timer}")
+    print(f"PhaseTimer phases passed {passes}/{total}")
+    return passes == total
+
+
+def profile_test(verbose=False):
+    """profile writes a chrome trace after its n_steps updates and stops"""
+    name, make, cdim = spec_agents()[0]
+    agent = make()
+    batch = synthetic_batch(64, 6, cdim, [3, 4])
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "trace", f"{name}.json")
+        agent.timer.profile(path, n_steps=2, start_after=1)
+        written = []
+        for _ in range(4):
+            agent.reinforcement_learn(batch)
+            written.append(os.path.exists(path))
+    # the trace is written once the first update plus 2 profiled ones are done
+    ok = written == [False, False, True, True] and not agent.timer._active
+    if verbose or not ok:
+        print(f"trace written after each update: {written}")
+    print(f"PhaseTimer profile passed: {ok}")
+    return ok
+
+
+def diagnostics_test(verbose=False):
+    """Repeated names are averaged and the helpers match their definitions"""
+    diag = Diagnostics()
+    for v in [1.0, 2.0, 6.0]:
+        diag.add("grad_norm", torch.tensor(v))
+    diag.add_stats("q", torch.tensor([1.0, -2.0, 4.0]))
+    logratio = torch.tensor([0.0, 0.1, -0.5, 0.3])
+    diag.add_ratio(logratio, clip=0.2)
+    got = diag.fetch()
+    ratio = logratio.exp()
+    expected = {
+        "grad_norm": 3.0,
+        "q_mean": 1.0,
+        "q_min": -2.0,
+        "q_max": 4.0,
+        "approx_kl": ((ratio - 1) - logratio).mean().item(),
+        "clip_fraction": 0.5,
+    }
+    ok = got.keys() == expected.keys()
+    ok = ok and all(np.isclose(got[k], v, atol=1e-6) for k, v in expected.items())
+
+    net = torch.nn.Linear(4, 3)
+    net(torch.rand(8, 4)).pow(2).sum().backward()
+    norm = total_grad_norm(net.parameters())
+    clipped = torch.nn.utils.clip_grad_norm_(net.parameters(), 1e9)
+    ok = ok and torch.isclose(norm, clipped)
+    returns = torch.rand(32)
+    ok = ok and explained_variance(returns, returns).item() == 1.0
+    ok = ok and np.isclose(explained_variance(torch.zeros(32), returns - 0.5), 0.0)
+    ok = ok and explained_variance(returns, torch.ones(32)).item() == 0.0
+    if verbose or not ok:
+        print(f"fetched {got}")
+    print(f"Diagnostics passed: {ok}")
+    return ok
+
+
+def agent_diagnostics_test(verbose=False):
+    """Agents fill last_diagnostics only when diagnostics is on"""
+    expected = {
+        "DQN": ["grad_norm", "discrete_q_mean", "discrete_target_mean"],
+        "PPO": ["grad_norm", "approx_kl", "clip_fraction", "explained_variance"],
+        "TD3": ["q_mean", "target_q_mean"],
+        "DDPG": ["q_mean", "critic_grad_norm", "actor_grad_norm"],
+    }
+    passes, total = 0, 0
+    for name, make, cdim in spec_agents():
+        batch = synthetic_batch(64, 6, cdim, [3, 4])
+        agent = make()
+        agent.reinforcement_learn(batch)
+        off = agent.last_diagnostics is None
+        agent.diagnostics = True
+        agent.reinforcement_learn(batch)
+        got = agent.last_diagnostics or {}
+        ok = off and all(k in got and np.isfinite(got[k]) for k in expected[name])
+        passes += ok
+        total += 1
+        if verbose or not ok:
+            print(f"{name}: {got}")
+    print(f"Agent diagnostics passed {passes}/{total}")
+    return passes == total
+
+
+def memory_report_test(verbose=False):
+    """Unstepped Adam state is estimated, a tracked update measures it"""
+    agents = benchmark_agents(obs_dim=6, continuous_action_dim=2)
+    passes, total = 0, 0
+    for name in ["DQN-egreedy", "TD3"]:
+        agent = agents[name]()
+        before = agent.memory_report()
+        params = sum(before["parameters"].values())
+        opt = before["optimizer_state"]
+        estimated = set(before["estimated"]) == set(opt)
+        sized = all(n > 0 for n in opt.values())
+        batch = synthetic_batch(64, 6, 2, [3, 4])
+        after = agent.memory_report(batch)
+        # adam's moments are two parameter sized tensors plus a step counter
+        measured = [k for k in opt if k not in after["estimated"]]
+        close = all(
+            abs(after["optimizer_state"][k] - opt[k]) < 0.01 * opt[k]
+            for k in measured
+        )
+        restored = agent.memory_report()["estimated"] == before["estimated"]
+        ok = estimated and sized and len(measured) > 0 and close and restored
+        passes += ok
+        total += 1
+        if verbose or not ok:
+            print(
+                f"{name}: {params} parameter bytes, before {opt} "
+                f"{before['estimated']}, after {after['optimizer_state']} "
+                f"{after['estimated']}"
+            )
+    print(f"memory_report optimizer state passed {passes}/{total}")
+    return passes == total
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    np.random.seed(0)
+    phase_timer_test()
+    profile_test()
+    diagnostics_test()
+    agent_diagnostics_test()
+    memory_report_test()
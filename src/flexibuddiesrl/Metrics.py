@@ -0,0 +1,183 @@
+import os
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import torch
+
+
+def _value(v):
+    # gauges may hold 0-d tensors (grad norms) so the learner never has to
+    # sync with the device, they are only read back here on the flush thread
+    return float(v.item()) if torch.is_tensor(v) else float(v)
+
+
+def _escape(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """
+    Training telemetry that agents publish into when agent.metrics is set:
+
+        agent.metrics = Metrics(labels={"agent": "dqn0"})
+        MetricsExporter(agent.metrics, path="./metrics.prom").start()
+
+    Counters (updates, env_steps) only go up, gauges (losses, eps, lr,
+    grad_norm) hold the last value. Every record is also appended to a ring
+    buffer of the last `capacity` samples for history(). Recording is a dict
+    store plus a deque append, both atomic under the GIL, so the learner never
+    takes a lock. Only the owning learner thread should record into a given
+    Metrics, readers on other threads just copy.
+    """
+
+    def __init__(self, capacity=4096, prefix="flexibuddiesrl", labels=None):
+        self.prefix = prefix
+        self.labels = dict(labels or {})
+        self.counters = {}
+        self.gauges = {}
+        self.ring = deque(maxlen=capacity)
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+        self.ring.append((time.time(), name, self.counters[name]))
+
+    def set(self, name, value):
+        self.gauges[name] = value
+        self.ring.append((time.time(), name, value))
+
+    def history(self, name):
+        """[(unix time, value)] of the samples of name still in the ring"""
+        return [(t, _value(v)) for t, n, v in list(self.ring) if n == name]
+
+    def values(self):
+        """{name: float} of every counter and gauge"""
+        out = {k: float(v) for k, v in dict(self.counters).items()}
+        out.update({k: _value(v) for k, v in dict(self.gauges).items()})
+        return out
+
+    def _labels(self):
+        if len(self.labels) == 0:
+            return ""
+        inner = ",".join(f'{k}="{_escape(v)}"' for k, v in self.labels.items())
+        return "{" + inner + "}"
+
+    def samples(self):
+        """[(metric name, "counter" | "gauge", sample line)]"""
+        labels = self._labels()
+        out = []
+        for k, v in sorted(dict(self.counters).items()):
+            name = f"{self.prefix}_{k}_total"
+            out.append((name, "counter", f"{name}{labels} {float(v)}"))
+        for k, v in sorted(dict(self.gauges).items()):
+            name = f"{self.prefix}_{k}"
+            out.append((name, "gauge", f"{name}{labels} {_value(v)}"))
+        return out
+
+    def render(self):
+        """Prometheus text exposition format"""
+        return render([self])
+
+
+def render(metrics):
+    """
+    Prometheus text for one or more Metrics. Samples of the same metric from
+    different Metrics (agents) are grouped under a single # TYPE line.
+    """
+    if isinstance(metrics, Metrics):
+        metrics = [metrics]
+    families = {}
+    for m in metrics:
+        for name, kind, line in m.samples():
+            families.setdefault((name, kind), []).append(line)
+    lines = []
+    for (name, kind), samples in families.items():
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """
+    Background thread that exposes one or more Metrics to prometheus.
+
+    path: rewrite this file every interval seconds (atomically, so a
+        node_exporter textfile collector never sees half a file)
+    port: serve GET /metrics on host:port, rendered on request
+    Either or both can be given. The learner thread is never touched, all
+    formatting and tensor reads happen on the exporter's threads.
+    """
+
+    def __init__(self, metrics, path=None, port=None, host="127.0.0.1", interval=10.0):
+        assert path is not None or port is not None, "give a path and/or a port"
+        self.metrics = [metrics] if isinstance(metrics, Metrics) else list(metrics)
+        self.path = path
+        self.port = port
+        self.host = host
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+
+    def flush(self):
+        if self.path is None:
+            return
+        d = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(d, exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(render(self.metrics))
+        os.replace(tmp, self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+        self.flush()
+
+    def start(self):
+        if self.port is not None:
+            exporter = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split("?")[0] not in ("/", "/metrics"):
+                        self.send_error(404)
+                        return
+                    body = render(exporter.metrics).encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+            self.port = self._server.server_address[1]  # port=0 picks a free one
+            threading.Thread(
+                target=self._server.serve_forever, name="metrics-http", daemon=True
+            ).start()
+        if self.path is not None:
+            self._thread = threading.Thread(
+                target=self._run, name="metrics-flush", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
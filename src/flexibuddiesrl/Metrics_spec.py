@@ -0,0 +1,86 @@
+import os
+import tempfile
+import urllib.request
+import numpy as np
+import torch
+from flexibuddiesrl.Benchmark import benchmark_agents, synthetic_batch
+from flexibuddiesrl.Metrics import Metrics, MetricsExporter, render
+
+
+def agent_metrics_test(verbose=False):
+    """Acting and learning publish counters and gauges when metrics is set"""
+    agents = benchmark_agents(obs_dim=6, continuous_action_dim=2)
+    discrete = benchmark_agents(obs_dim=6, continuous_action_dim=0)
+    cases = [
+        ("DQN", agents["DQN-egreedy"](), 2, ["eps", "discrete_q_loss"]),
+        ("PPO", discrete["PG-gae"](), 0, ["lr", "actor_loss", "critic_loss"]),
+        ("TD3", agents["TD3"](), 2, ["critic_loss"]),
+        ("DDPG", agents["DDPG"](), 2, ["actor_loss", "critic_loss"]),
+    ]
+    passes = 0
+    for name, agent, cdim, gauges in cases:
+        agent.metrics = Metrics(labels={"agent": name})
+        agent.train_actions(np.random.rand(5, 6).astype(np.float32), step=True)
+        for _ in range(2):
+            agent.reinforcement_learn(synthetic_batch(32, 6, cdim, [3, 4]))
+        values = agent.metrics.values()
+        ok = values.get("updates") == 2 and values.get("env_steps") == 5
+        ok = ok and all(np.isfinite(values.get(g, np.nan)) for g in gauges)
+        passes += ok
+        if verbose or not ok:
+            print(f"{name}: {values}")
+    print(f"Agent metrics passed {passes}/{len(cases)}")
+    return passes == len(cases)
+
+
+def render_test(verbose=False):
+    """Two Metrics share one # TYPE line per metric and keep their labels"""
+    a, b = Metrics(labels={"agent": "a"}), Metrics(labels={"agent": 'b"1'})
+    for m in [a, b]:
+        m.inc("updates", 3)
+        m.set("grad_norm", torch.tensor(0.5))
+    text = render([a, b])
+    expected = (
+        "# TYPE flexibuddiesrl_updates_total counter\n"
+        'flexibuddiesrl_updates_total{agent="a"} 3.0\n'
+        'flexibuddiesrl_updates_total{agent="b\\"1"} 3.0\n'
+        "# TYPE flexibuddiesrl_grad_norm gauge\n"
+        'flexibuddiesrl_grad_norm{agent="a"} 0.5\n'
+        'flexibuddiesrl_grad_norm{agent="b\\"1"} 0.5\n'
+    )
+    history = [v for _, v in a.history("updates")] == [3.0]
+    ok = text == expected and history
+    if verbose or not ok:
+        print(text)
+    print(f"Metrics render passed: {ok}")
+    return ok
+
+
+def exporter_test(verbose=False):
+    """The textfile and the http endpoint both serve the rendered metrics"""
+    m = Metrics()
+    m.inc("updates")
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "metrics", "agent.prom")
+        with MetricsExporter(m, path=path, port=0, interval=0.05) as exporter:
+            url = f"http://127.0.0.1:{exporter.port}/metrics"
+            served = urllib.request.urlopen(url).read().decode()
+            m.inc("updates")
+        # stop flushes once more, so the file has the last value
+        with open(path) as f:
+            written = f.read()
+        leftovers = [f for f in os.listdir(os.path.dirname(path)) if f.endswith(".tmp")]
+    ok = "flexibuddiesrl_updates_total 1.0" in served
+    ok = ok and "flexibuddiesrl_updates_total 2.0" in written and len(leftovers) == 0
+    if verbose or not ok:
+        print(f"served:\n{served}written:\n{written}")
+    print(f"MetricsExporter passed: {ok}")
+    return ok
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    np.random.seed(0)
+    agent_metrics_test()
+    render_test()
+    exporter_test()
@@ -0,0 +1,264 @@
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
+import torch
+from flexibuff import FlexiBatch
+
+# Fields a FlexiBatch holds with a leading agent dimension. On disk they are
+# stored for a single agent, without it, and get it back when loaded.
+AGENT_FIELDS = [
+    "obs",
+    "obs_",
+    "discrete_actions",
+    "continuous_actions",
+    "discrete_log_probs",
+    "continuous_log_probs",
+]
+# one value per transition
+STEP_FIELDS = ["global_rewards", "terminated", "truncated"]
+FIELDS = AGENT_FIELDS + STEP_FIELDS
+_META = "meta.json"
+
+
+def _numpy(x):
+    if torch.is_tensor(x):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+def _fields_of(batch, agent_num=0):
+    """{field: [n, ...] array} from a FlexiBatch or a dict of per step arrays"""
+    if isinstance(batch, dict):
+        return {k: _numpy(v) for k, v in batch.items() if v is not None}
+    out = {}
+    for name in AGENT_FIELDS:
+        v = getattr(batch, name, None)
+        if v is not None:
+            out[name] = _numpy(v[agent_num])
+    for name in STEP_FIELDS:
+        v = getattr(batch, name, None)
+        if v is not None:
+            out[name] = _numpy(v)
+    return out
+
+
+class OfflineDatasetWriter:
+    """
+    Appends transitions to an on disk dataset directory, one .npy file per
+    field (see FIELDS) plus meta.json with the number of rows written:
+
+        with OfflineDatasetWriter("./demos", capacity=10_000_000) as w:
+            for batch in collector_batches:
+                w.add(batch)
+
+    The files are preallocated for capacity rows with open_memmap and filled
+    in place, so writing never holds more than the added batch in memory.
+    Unwritten rows at the end stay sparse on filesystems that support it.
+    """
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.capacity = capacity
+        self.size = 0
+        self.arrays = {}
+        os.makedirs(path, exist_ok=True)
+
+    def _open(self, name, a):
+        self.arrays[name] = np.lib.format.open_memmap(
+            os.path.join(self.path, f"{name}.npy"),
+            mode="w+",
+            dtype=a.dtype,
+            shape=(self.capacity, *a.shape[1:]),
+        )
+
+    def add(self, batch, agent_num=0):
+        """Append a FlexiBatch (agent agent_num's rows) or a dict of arrays"""
+        fields = _fields_of(batch, agent_num)
+        n = len(next(iter(fields.values())))
+        assert self.size + n <= self.capacity, "OfflineDatasetWriter is full"
+        if len(self.arrays) == 0:
+            for name, a in fields.items():
+                self._open(name, a)
+        assert set(fields) == set(self.arrays), (
+            f"every batch needs the same fields, got {sorted(fields)} "
+            f"after {sorted(self.arrays)}"
+        )
+        for name, a in fields.items():
+            assert len(a) == n, f"{name} has {len(a)} rows, expected {n}"
+            self.arrays[name][self.size : self.size + n] = a
+        self.size += n
+
+    def close(self):
+        meta = {"size": self.size, "fields": {}}
+        for name, a in self.arrays.items():
+            a.flush()
+            meta["fields"][name] = {"dtype": str(a.dtype), "shape": list(a.shape[1:])}
+        with open(os.path.join(self.path, _META), "w") as f:
+            json.dump(meta, f)
+        self.arrays = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def write_dataset(path, batch, agent_num=0):
+    """Write one FlexiBatch or dict of arrays as a complete dataset"""
+    fields = _fields_of(batch, agent_num)
+    with OfflineDatasetWriter(path, len(next(iter(fields.values())))) as w:
+        w.add(fields)
+
+
+class Prefetcher:
+    """
+    Runs make_iter() on a background thread and keeps up to depth of its
+    items ready, so building the next batch (disk reads, gathers, the host to
+    device copy) overlaps with training on the current one. Every iteration
+    starts a fresh pass, so a Prefetcher can be handed to anything that loops
+    over its data more than once (e.g. ImitationTrainer.fit). Exceptions on
+    the thread are re-raised in the consumer. wait_time is the total time the
+    consumer spent blocked waiting for an item.
+    """
+
+    _done = object()
+
+    def __init__(self, make_iter, depth=2):
+        self.make_iter = make_iter
+        self.depth = depth
+        self.wait_time = 0.0
+
+    def __iter__(self):
+        q = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def run():
+            try:
+                for item in self.make_iter():
+                    if not put(item):
+                        return
+                put(Prefetcher._done)
+            except BaseException as e:
+                put(e)
+
+        thread = threading.Thread(target=run, name="prefetch", daemon=True)
+        thread.start()
+        try:
+            while True:
+                t = time.perf_counter()
+                item = q.get()
+                self.wait_time += time.perf_counter() - t
+                if item is Prefetcher._done:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # also reached when the consumer stops early
+            stop.set()
+            thread.join()
+
+
+class OfflineDataset:
+    """
+    Read side of OfflineDatasetWriter. Every field is opened with
+    np.load(mmap_mode="r"), so only the rows a batch touches are read from
+    disk and the page cache decides what stays in memory. Batches come out as
+    torch FlexiBatches on device, ready for reinforcement_learn, and work as
+    ImitationTrainer chunks:
+
+        ds = OfflineDataset("./transitions", device="cuda")
+        for batch in ds.sampler(256, n_batches=100_000):
+            dqn.reinforcement_learn(batch)  # DQN(conservative=True)
+        ImitationTrainer(agent, batch_size=512).fit(ds.iterate(1 << 16), epochs=5)
+
+    fields: subset of fields to load, all of them by default
+    """
+
+    def __init__(self, path, device="cpu", fields=None):
+        self.path = path
+        self.device = torch.device(device)
+        with open(os.path.join(path, _META)) as f:
+            self.meta = json.load(f)
+        self.size = self.meta["size"]
+        names = fields if fields is not None else list(self.meta["fields"])
+        self.arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")[: self.size]
+            for name in names
+        }
+        # pinned host memory makes the copy asynchronous to the gpu
+        self.pin = self.device.type == "cuda"
+
+    def __len__(self):
+        return self.size
+
+    def _tensor(self, a):
+        if not a.flags.writeable:
+            a = np.array(a)  # a slice is still a view of the read only map
+        t = torch.from_numpy(np.ascontiguousarray(a))
+        if self.pin:
+            t = t.pin_memory()
+        return t.to(self.device, non_blocking=True)
+
+    def batch(self, idx):
+        """FlexiBatch of the rows idx, an index array or a slice"""
+        rv = {}
+        for name in AGENT_FIELDS:
+            if name in self.arrays:
+                rv[name] = self._tensor(self.arrays[name][idx])[None]
+        if "global_rewards" in self.arrays:
+            rv["global_rewards"] = self._tensor(self.arrays["global_rewards"][idx])
+        step = {}
+        for name in ["terminated", "truncated"]:
+            if name in self.arrays:
+                step[name] = self._tensor(self.arrays[name][idx]).float()
+        return FlexiBatch(registered_vals=rv, **step)
+
+    def sample(self, batch_size, rng=None):
+        """batch_size uniformly sampled rows"""
+        rng = np.random.default_rng() if rng is None else rng
+        # sorted rows walk each file forward instead of seeking around it
+        return self.batch(np.sort(rng.integers(0, self.size, batch_size)))
+
+    def chunks(self, chunk_size, shuffle=True, rng=None):
+        """One pass over contiguous chunk_size row blocks, in random order"""
+        starts = np.arange(0, self.size, chunk_size)
+        if shuffle:
+            rng = np.random.default_rng() if rng is None else rng
+            starts = rng.permutation(starts)
+        for s in starts:
+            yield self.batch(slice(s, s + chunk_size))
+
+    def sampler(self, batch_size, n_batches=None, prefetch=2, seed=None):
+        """
+        Prefetched random batches, n_batches of them per pass or endless if
+        None
+        """
+
+        def make_iter():
+            rng = np.random.default_rng(seed)
+            i = 0
+            while n_batches is None or i < n_batches:
+                yield self.sample(batch_size, rng)
+                i += 1
+
+        return Prefetcher(make_iter, prefetch)
+
+    def iterate(self, chunk_size, shuffle=True, prefetch=2, seed=None):
+        """Prefetched chunks, every iteration is one pass over the dataset"""
+        rng = np.random.default_rng(seed)
+        return Prefetcher(lambda: self.chunks(chunk_size, shuffle, rng), prefetch)
@@ -0,0 +1,122 @@
+import tempfile
+import threading
+import numpy as np
+import torch
+from flexibuddiesrl.Benchmark import synthetic_batch
+from flexibuddiesrl.DQN import DQN
+from flexibuddiesrl.OfflineDataset import (
+    OfflineDataset,
+    OfflineDatasetWriter,
+    Prefetcher,
+)
+
+
+def prefetch_threads():
+    return [t for t in threading.enumerate() if t.name == "prefetch" and t.is_alive()]
+
+
+def round_trip_test(verbose=False):
+    """Rows written in several adds read back identically from the mmap"""
+    parts = [synthetic_batch(n, 6, 2, [3, 4]) for n in [50, 1, 77]]
+    with tempfile.TemporaryDirectory() as d:
+        with OfflineDatasetWriter(d, capacity=200) as w:
+            for b in parts:
+                w.add(b)
+        ds = OfflineDataset(d)
+        whole = ds.batch(slice(0, len(ds)))
+        ok = len(ds) == 128
+        for name in ["obs", "obs_", "discrete_actions", "continuous_actions"]:
+            src = torch.cat([getattr(b, name)[0] for b in parts])
+            ok = ok and torch.equal(getattr(whole, name)[0], src)
+        for name in ["global_rewards", "terminated"]:
+            src = torch.cat([getattr(b, name) for b in parts])
+            ok = ok and torch.equal(getattr(whole, name), src.float())
+        idx = np.array([3, 60, 127])
+        picked = ds.batch(idx)
+        ok = ok and torch.equal(picked.obs[0], whole.obs[0][idx])
+        del ds, whole, picked  # release the maps before the directory goes
+    if verbose or not ok:
+        print(f"round trip of {[len(b.global_rewards) for b in parts]} rows: {ok}")
+    print(f"OfflineDataset round trip passed: {ok}")
+    return ok
+
+
+def sampler_test(verbose=False):
+    """sampler gives n_batches per pass and its batches train DQN"""
+    agent = DQN(
+        obs_dim=6,
+        discrete_action_dims=[3, 4],
+        continuous_action_dims=2,
+        max_actions=np.ones(2, dtype=np.float32),
+        min_actions=-np.ones(2, dtype=np.float32),
+        hidden_dims=[32, 32],
+    )
+    with tempfile.TemporaryDirectory() as d:
+        with OfflineDatasetWriter(d, capacity=500) as w:
+            w.add(synthetic_batch(500, 6, 2, [3, 4]))
+        ds = OfflineDataset(d)
+        sampler = ds.sampler(32, n_batches=5, seed=0)
+        passes = []
+        for _ in range(2):
+            sizes = [len(b.global_rewards) for b in sampler]
+            passes.append(sizes == [32] * 5)
+        losses = agent.reinforcement_learn(next(iter(sampler)))
+        idle = len(prefetch_threads()) == 0
+        del ds, sampler
+    ok = all(passes) and all(np.isfinite(losses)) and idle
+    if verbose or not ok:
+        print(f"passes {passes}, losses {losses}, threads left {not idle}")
+    print(f"OfflineDataset sampler passed: {ok}")
+    return ok
+
+
+def iterate_test(verbose=False):
+    """iterate covers every row once per pass and an early break stops it"""
+    with tempfile.TemporaryDirectory() as d:
+        with OfflineDatasetWriter(d, capacity=1000) as w:
+            w.add({"obs": np.arange(1000, dtype=np.float32)[:, None]})
+        ds = OfflineDataset(d)
+        chunks = ds.iterate(96, seed=0, prefetch=1)
+        seen = [sorted(torch.cat([c.obs[0, :, 0] for c in chunks]).tolist())]
+        seen.append(sorted(torch.cat([c.obs[0, :, 0] for c in chunks]).tolist()))
+        full = all(s == list(range(1000)) for s in seen)
+        for i, _ in enumerate(chunks):
+            if i == 1:
+                break  # leaves the producer blocked on a full queue
+        stopped = len(prefetch_threads()) == 0
+        del ds, chunks
+    ok = full and stopped
+    if verbose or not ok:
+        print(f"every row every pass {full}, thread stopped after break {stopped}")
+    print(f"OfflineDataset iterate passed: {ok}")
+    return ok
+
+
+def prefetch_error_test(verbose=False):
+    """An exception on the prefetch thread is raised in the consumer"""
+
+    def broken():
+        yield 1
+        raise KeyError("missing field")
+
+    got = []
+    try:
+        for item in Prefetcher(broken):
+            got.append(item)
+        raised = None
+    except KeyError as e:
+        raised = e
+    ok = got == [1] and raised is not None and len(prefetch_threads()) == 0
+    if verbose or not ok:
+        print(f"items {got}, raised {raised!r}")
+    print(f"Prefetcher error passed: {ok}")
+    return ok
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    np.random.seed(0)
+    round_trip_test()
+    sampler_test()
+    iterate_test()
+    prefetch_error_test()
@@ -1,5 +1,7 @@
 from .Agent import ValueS, MixedActor, Agent
-from .Util import T
+from .Util import T, next_obs
+from .Checkpoint import save_training_state, load_training_state_file
+from .Instrumentation import Diagnostics, total_grad_norm, explained_variance
 import torch
 from flexibuff import FlexiBatch
 from torch.distributions import Categorical
@@ -195,7 +197,12 @@ class PG(nn.Module, Agent):
             frac = max(1.0 - (self.steps - 1.0) / self.anneal_lr, 0.0001)
             lrnow = frac * self.lr
             self.optimizer.param_groups[0]["lr"] = lrnow
+        if self.metrics is not None:
+            if step:
+                self.metrics.inc("env_steps", int(np.prod(observations.shape[:-1])))
+            self.metrics.set("lr", self.optimizer.param_groups[0]["lr"])
 
+        self.timer.start("forward")
         with torch.no_grad():
             continuous_logits, discrete_logits = self.actor(
                 x=observations, action_mask=action_mask, gumbel=False, debug=False
@@ -243,6 +250,7 @@ class PG(nn.Module, Agent):
             # print(torch.log(discrete_logits[0][discrete_actions[0]]))
             discrete_actions = discrete_actions.detach().cpu().numpy()
             discrete_log_probs = discrete_log_probs.detach().cpu().numpy()
+        self.timer.stop()
 
         return (
             discrete_actions,
@@ -270,6 +278,17 @@ class PG(nn.Module, Agent):
                 discrete_actions[:, i] = torch.argmax(activation, dim=1)
             return discrete_actions, continuous_actions
 
+    def imitation_loss(
+        self,
+        observations,
+        continuous_actions=None,
+        discrete_actions=None,
+        action_mask=None,
+    ):
+        return self.actor.imitation_loss(
+            observations, continuous_actions, discrete_actions, action_mask
+        )
+
     def imitation_learn(
         self,
         observations,
@@ -278,25 +297,19 @@ class PG(nn.Module, Agent):
         action_mask=None,
         debug=False,
     ):
-        # print("not implemented yet")
-        return 0, 0
-        dact, cact = self.actor(
-            observations, action_mask=action_mask, gumbel=False, debug=False
+        dloss, closs = self.imitation_loss(
+            observations, continuous_actions, discrete_actions, action_mask
         )
-        loss = 0
-        if self.continuous_action_dim > 0:
-            loss += ((cact - continuous_actions) ** 2).mean()
-        if self.discrete_action_dims is not None:
-            for head in range(len(self.discrete_action_dims)):
-                loss += nn.CrossEntropyLoss()(
-                    dact[head], discrete_actions[:, head].long()
-                )
-        loss = torch.nn.functional.cross_entropy(probs, oh_actions, reduction="mean")
-        self.actor_optimizer.zero_grad()
-        loss.backward()
-        self.actor_optimizer.step()
-
-        return loss.item()  # loss
+        loss = dloss + closs
+        if torch.is_tensor(loss):  # no demonstrated actions leaves it at 0
+            self.optimizer.zero_grad()
+            loss.backward()
+            self._imitation_step()
+        if torch.is_tensor(dloss):
+            dloss = dloss.item()
+        if torch.is_tensor(closs):
+            closs = closs.item()
+        return dloss, closs
 
     def utility_function(self, observations, actions=None):
         if not torch.is_tensor(observations):
@@ -370,7 +383,9 @@ class PG(nn.Module, Agent):
             if self.advantage_type == "constant":
                 G[-1] += self.gamma * self.g_mean
             else:
-                G[-1] += self.gamma * self.critic(batch.obs_[agent_num][-1]).squeeze(-1)
+                G[-1] += self.gamma * self.critic(
+                    next_obs(batch, agent_num, -1)
+                ).squeeze(-1)
 
         for i in range(len(batch.global_rewards) - 2, -1, -1):
             G[i] = batch.global_rewards[i] + self.gamma * G[i + 1] * (
@@ -383,7 +398,7 @@ class PG(nn.Module, Agent):
         with torch.no_grad():
             advantages = torch.zeros_like(batch.global_rewards).to(self.device)
             num_steps = batch.global_rewards.shape[0]
-            last_values = self.critic(batch.obs_[agent_num, -1]).squeeze(-1)
+            last_values = self.critic(next_obs(batch, agent_num, -1)).squeeze(-1)
             values = self.critic(batch.obs[agent_num]).squeeze(-1)
 
             last_gae_lam = 0
@@ -421,7 +436,7 @@ class PG(nn.Module, Agent):
             old_values = self.critic(batch.obs[agent_num]).squeeze(-1)
             td[-1] = (
                 self.gamma
-                * self.critic(batch.obs_[agent_num, -1]).squeeze(-1)
+                * self.critic(next_obs(batch, agent_num, -1)).squeeze(-1)
                 * batch.terminated[-1]
                 - old_values[-1]
             )
@@ -437,14 +452,7 @@ class PG(nn.Module, Agent):
         return G.unsqueeze(-1), td.unsqueeze(-1)
 
     def _print_grad_norm(self):
-        total_norm = 0
-        for p in self.parameters():
-            if p is None or p.grad is None:
-                continue
-            param_norm = p.grad.data.norm(2)
-            total_norm += param_norm.item() ** 2
-        total_norm = total_norm ** (1.0 / 2)
-        print(total_norm)
+        print(total_grad_norm(self.parameters()).item())
 
     def reinforcement_learn(
         self,
@@ -462,6 +470,7 @@ class PG(nn.Module, Agent):
         if debug:
             print(f"Starting Reinforcement Learn for agent {agent_num}")
         # # G = G / 100
+        self.timer.start("advantage")
         with torch.no_grad():
             if self.advantage_type == "gv":
                 G = self._G(batch, agent_num)
@@ -490,6 +499,8 @@ class PG(nn.Module, Agent):
         if self.norm_advantages:
             advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
         avg_actor_loss = 0
+        grad_norm = None
+        diag = Diagnostics() if self.diagnostics else None
         avg_critic_loss = 0
         # Update the actor
         action_mask = None
@@ -527,6 +538,7 @@ class PG(nn.Module, Agent):
                         f"    Mini batch: {bstart}:{bend}, Indices: {indices}, {len(indices)}"
                     )
 
+                self.timer.start("loss")
                 V_current = self.critic(batch.obs[agent_num, indices])
                 if debug:
                     print(
@@ -538,16 +550,22 @@ class PG(nn.Module, Agent):
                 # print(V_current - G[indices])
                 # input()
                 critic_loss = 0.5 * ((V_current - G[indices]) ** 2).mean()
+                if diag is not None:
+                    diag.add(
+                        "explained_variance", explained_variance(V_current, G[indices])
+                    )
                 # print(torch.abs(V_current - G[indices]).mean())
                 if not critic_only:
                     mb_adv = advantages[indices]
 
                     actor_loss = 0
+                    self.timer.start("forward")
                     cont_probs, disc_probs = self.actor(
                         batch.obs[agent_num, indices],
                         action_mask=action_mask,  # TODO fix action mask by indices
                         gumbel=False,
                     )
+                    self.timer.start("loss")
                     if self.continuous_action_dim > 0:
                         if debug:
                             print(f"    cont probs: {cont_probs.shape}")
@@ -572,6 +590,8 @@ class PG(nn.Module, Agent):
                             )
 
                             ratio = logratio.exp()
+                            if diag is not None:
+                                diag.add_ratio(logratio, self.ppo_clip)
 
                             pg_loss1 = mb_adv * ratio
                             pg_loss2 = mb_adv * torch.clamp(
@@ -627,6 +647,8 @@ class PG(nn.Module, Agent):
                                     - batch.discrete_log_probs[agent_num, indices, head]
                                 )
                                 ratio = logratio.exp()
+                                if diag is not None:
+                                    diag.add_ratio(logratio, self.ppo_clip)
                                 pg_loss1 = mb_adv.squeeze(-1) * ratio
                                 pg_loss2 = mb_adv.squeeze(-1) * torch.clamp(
                                     ratio, 1 - self.ppo_clip, 1 + self.ppo_clip
@@ -648,6 +670,7 @@ class PG(nn.Module, Agent):
                     # loss.backward()
                     # self._print_grad_norm()
                     # print("critic")
+                    self.timer.start("backward")
                     self.optimizer.zero_grad()
                     loss = actor_loss + critic_loss * self.critic_loss_coef
                     loss.backward()
@@ -656,16 +679,22 @@ class PG(nn.Module, Agent):
                     # print(self.actor_logstd.grad)
                     # self._print_grad_norm()
 
+                    self.timer.start("optimizer")
                     if self.clip_grad:
-                        torch.nn.utils.clip_grad_norm_(
+                        grad_norm = torch.nn.utils.clip_grad_norm_(
                             self.parameters(),
                             0.5,
                             error_if_nonfinite=True,
                             foreach=True,
                         )
+                    if diag is not None:
+                        if not self.clip_grad:
+                            grad_norm = total_grad_norm(self.parameters())
+                        diag.add("grad_norm", grad_norm)
 
                     self.optimizer.step()
 
+                    self.timer.start("to_numpy")
                     avg_actor_loss += actor_loss.item()
                     avg_critic_loss += critic_loss.item()
             avg_actor_loss /= nbatch
@@ -674,6 +703,15 @@ class PG(nn.Module, Agent):
 
         avg_actor_loss /= self.n_epochs
         avg_critic_loss /= self.n_epochs
+        if diag is not None:
+            self._publish_diagnostics(diag)
+        if self.metrics is not None:
+            self.metrics.inc("updates")
+            self.metrics.set("actor_loss", avg_actor_loss)
+            self.metrics.set("critic_loss", avg_critic_loss)
+            if grad_norm is not None:
+                self.metrics.set("grad_norm", grad_norm)
+        self.timer.step()
         # print(avg_actor_loss, critic_loss.item())
         return avg_actor_loss, avg_critic_loss
 
@@ -703,6 +741,7 @@ class PG(nn.Module, Agent):
             self._dump_attr(
                 self.__dict__[self.attrs[i]], checkpoint_path + f"/{self.attrs[i]}"
             )
+        save_training_state(self, checkpoint_path)
 
     def load(self, checkpoint_path):
         if checkpoint_path is None:
@@ -716,7 +755,12 @@ class PG(nn.Module, Agent):
         self.policy_loss = 5.0
         self.actor.load_state_dict(torch.load(checkpoint_path + "/PI"))
         self.critic.load_state_dict(torch.load(checkpoint_path + "/V"))
-        self.actor_logstd = torch.load(checkpoint_path + "/actor_logstd")
+        # copy in place so the optimizer keeps pointing at actor_logstd
+        with torch.no_grad():
+            self.actor_logstd.copy_(
+                torch.load(checkpoint_path + "/actor_logstd").to(self.device)
+            )
+        load_training_state_file(self, checkpoint_path)
 
     def __str__(self):
         st = ""
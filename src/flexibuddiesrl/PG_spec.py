@@ -2,6 +2,7 @@ import numpy as np
 import torch
 from flexibuddiesrl.PG_stabalized import PG
 from flexibuddiesrl.Agent import ffEncoder
+from flexibuddiesrl.Instrumentation import PhaseTimer
 from itertools import product
 import time
 from flexibuff import FlexibleBuffer, FlexiBatch
@@ -18,15 +19,8 @@ def PG_test():
         "immitation_learn": 0.0,
         "reinforcement_learn": 0.0,
     }
-    rl_times = {
-        "advantage": 0.0,
-        "critic_loss": 0.0,
-        "act": 0.0,
-        "dloss": 0.0,
-        "closs": 0.0,
-        "backward": 0.0,
-        "tot": 0.0,
-    }
+    # shared by every model so the phase breakdown covers the whole grid
+    rl_timer = PhaseTimer(enabled=True)
     obs_dim = 3
     continuous_action_dim = 5
     discrete_action_dims = [3, 5]
@@ -135,14 +129,8 @@ def PG_test():
             for k in run_times.keys():
                 print(f"  {k}: {run_times[k] / tot_t *100:.2f}%")
 
-            rl_tot = 0.0
-            for k in rl_times:
-                if k != "tot":
-                    rl_tot += rl_times[k]
-            print(f"     Captured: {rl_tot/rl_times['tot'] *100:.3f}%")
-            for k in rl_times:
-                if k != "tot":
-                    print(f"     {k}: {rl_times[k] / rl_times['tot'] *100:.2f}%")
+            for k, v in rl_timer.report().items():
+                print(f"     {k}: {v['fraction'] *100:.2f}%")
 
             current_time = t
         current_iter += 1
@@ -177,6 +165,7 @@ def PG_test():
             n_epochs=1,
         )
         run_times["create_model"] += time.time() - _s
+        model.timer = rl_timer
 
         _s = time.time()
         d_acts, c_acts, d_log, c_log, _ = model.train_actions(
@@ -231,15 +220,12 @@ def PG_test():
 
         _s = time.time()
         try:
-            aloss, closs = model.reinforcement_learn_perf(mb, 0)
+            aloss, closs = model.reinforcement_learn(mb, 0)
         except Exception as e:
             print(h)
             raise e
         run_times["reinforcement_learn"] += time.time() - _s
 
-        for k in rl_times:
-            rl_times[k] += model.run_times[k]
-
     print(tot)
 
 
@@ -390,6 +376,54 @@ def PG_integration():
                 mem_buff.reset()
 
 
+def PG_minibatch_test(verbose=False):
+    """
+    Batches shorter than, or not a multiple of, mini_batch_size and the
+    target_kl early stop all give finite losses averaged over the
+    minibatches that actually ran
+    """
+    from flexibuddiesrl.Benchmark import synthetic_batch
+
+    def make(target_kl=None):
+        torch.manual_seed(0)
+        return PG(
+            obs_dim=4,
+            discrete_action_dims=[2, 3],
+            continuous_action_dim=0,
+            hidden_dims=[32, 32],
+            mini_batch_size=64,
+            n_epochs=3,
+            target_kl=target_kl,
+        )
+
+    passes, total = 0, 0
+    for n in [1, 2, 20, 64, 100, 129]:
+        batch = synthetic_batch(n, 4, 0, [2, 3])
+        results = []
+        for target_kl in [None, 1e9]:
+            agent = make(target_kl)
+            np.random.seed(0)
+            results.append(agent.reinforcement_learn(batch, 0))
+        ok = bool(np.all(np.isfinite(results[0])))
+        # a target_kl that is never reached changes nothing
+        ok = ok and np.allclose(results[0], results[1])
+        # a target_kl that is always exceeded applies no minibatch at all
+        agent = make(-1.0)
+        before = [p.detach().clone() for p in agent.parameters()]
+        aloss, closs, stats = agent.reinforcement_learn(batch, 0, return_td_errors=True)
+        unchanged = all(torch.equal(a, b) for a, b in zip(before, agent.parameters()))
+        n_minibatches = -(-n // 64)
+        ok = ok and unchanged and (aloss, closs) == (0.0, 0.0)
+        ok = ok and stats["skipped_minibatches"] == 3 * n_minibatches
+        passes += ok
+        total += 1
+        if verbose or not ok:
+            print(f"batch of {n}: {results}, skipped {stats['skipped_minibatches']}")
+    print(f"PG minibatch averaging / target_kl passed {passes}/{total}")
+    return passes == total
+
+
 if __name__ == "__main__":
     PG_integration()
     PG_test()
+    PG_minibatch_test()
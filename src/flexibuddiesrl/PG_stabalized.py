@@ -1,5 +1,7 @@
 from .Agent import ValueS, StochasticActor, Agent
-from .Util import T, minmaxnorm
+from .Util import T, minmaxnorm, next_obs
+from .Checkpoint import save_training_state, load_training_state_file
+from .Instrumentation import Diagnostics, total_grad_norm, explained_variance
 import torch
 from flexibuff import FlexiBatch, FlexibleBuffer
 from torch.distributions import Categorical
@@ -7,7 +9,6 @@ import numpy as np
 import torch.nn as nn
 import pickle
 import os
-import time
 from torch.distributions import TransformedDistribution, TanhTransform
 import torch.nn.functional as F
 from typing import Any, cast
@@ -46,6 +47,7 @@ class PG(nn.Module, Agent):
         std_type="stateless",  # ['full' 'diagonal' or 'stateless']
         naive_immitation=False,  # if true, do MSE instead of MLE
         action_clamp_type="tanh",
+        target_kl=None,  # stop the update early once approx KL exceeds this
         batch_name_map={
             "discrete_actions": "discrete_actions",
             "continuous_actions": "continuous_actions",
@@ -89,15 +91,6 @@ class PG(nn.Module, Agent):
             "naive_immitation",
             "action_clamp_type",
         ]
-        self.run_times = {
-            "advantage": 0.0,
-            "critic_loss": 0.0,
-            "act": 0.0,
-            "dloss": 0.0,
-            "closs": 0.0,
-            "backward": 0.0,
-            "tot": 0.0,
-        }
         assert (
             continuous_action_dim > 0 or discrete_action_dims is not None
         ), "At least one action dim should be provided"
@@ -121,6 +114,8 @@ class PG(nn.Module, Agent):
         self.encoder = encoder
         self.action_clamp_type = action_clamp_type
         self.naive_immitation = naive_immitation
+        self.target_kl = target_kl
+        self.last_skipped_minibatches = 0
         if load_from_checkpoint is not None:
             self.load(load_from_checkpoint)
             return
@@ -157,6 +152,7 @@ class PG(nn.Module, Agent):
         self.orthogonal = orthogonal
 
         self.std_type = std_type
+        self.action_head_hidden_dims = action_head_hidden_dims
         self.g_mean = 0
         self.steps = 0
         self.anneal_lr = anneal_lr
@@ -252,7 +248,12 @@ class PG(nn.Module, Agent):
             frac = max(1.0 - (self.steps - 1.0) / self.anneal_lr, 0.0001)
             lrnow = frac * self.lr
             self.optimizer.param_groups[0]["lr"] = lrnow
+        if self.metrics is not None:
+            if step:
+                self.metrics.inc("env_steps", int(np.prod(observations.shape[:-1])))
+            self.metrics.set("lr", self.optimizer.param_groups[0]["lr"])
 
+        self.timer.start("forward")
         with torch.no_grad():
             continuous_logits, continuous_log_std_logits, discrete_action_logits = (
                 self.actor(x=observations, action_mask=action_mask, debug=debug)
@@ -292,13 +293,16 @@ class PG(nn.Module, Agent):
                 print(self.actor.device)
                 print(e)
                 raise (e)
-        return (
+        self.timer.start("to_numpy")
+        actions = (
             self._to_numpy(discrete_actions),
             self._to_numpy(continuous_actions),
             self._to_numpy(discrete_log_probs),
             self._to_numpy(continuous_log_probs),
             0,  # vals.detach().cpu().numpy(), TODO: re-enable this when flexibuff is done
         )
+        self.timer.stop()
+        return actions
 
     # takes the observations and returns the action with the highest probability
     def ego_actions(self, observations, action_mask=None):
@@ -488,13 +492,12 @@ class PG(nn.Module, Agent):
 
         return total_loss
 
-    def imitation_learn(
+    def imitation_loss(
         self,
         observations,
         continuous_actions=None,
         discrete_actions=None,
         action_mask=None,
-        debug=False,
     ):
         continuous_mean_logits, continuous_log_std_logits, discrete_logits = self.actor(
             x=observations, action_mask=action_mask, debug=False
@@ -520,11 +523,24 @@ class PG(nn.Module, Agent):
             discrete_immitation_loss = self._discrete_imitation_loss(
                 discrete_logits, discrete_actions
             )
+        return discrete_immitation_loss, continuous_immitation_loss
+
+    def imitation_learn(
+        self,
+        observations,
+        continuous_actions=None,
+        discrete_actions=None,
+        action_mask=None,
+        debug=False,
+    ):
+        discrete_immitation_loss, continuous_immitation_loss = self.imitation_loss(
+            observations, continuous_actions, discrete_actions, action_mask
+        )
 
         loss = discrete_immitation_loss + continuous_immitation_loss
         self.optimizer.zero_grad()
         loss.backward()  # type:ignore  started as a float
-        self.optimizer.step()
+        self._imitation_step()
 
         if isinstance(discrete_immitation_loss, torch.Tensor):
             discrete_immitation_loss = discrete_immitation_loss.to("cpu").item()
@@ -651,14 +667,7 @@ class PG(nn.Module, Agent):
         )
 
     def _print_grad_norm(self):
-        total_norm = 0
-        for p in self.parameters():
-            if p is None or p.grad is None:
-                continue
-            param_norm = p.grad.data.norm(2)
-            total_norm += param_norm.item() ** 2
-        total_norm = total_norm ** (1.0 / 2)
-        print(total_norm)
+        print(total_grad_norm(self.parameters()).item())
 
     def _critic_loss(
         self, batch: FlexiBatch, indices, G, agent_num=0, debug=False
@@ -678,9 +687,14 @@ class PG(nn.Module, Agent):
 
         values = None
         rewards = batch.__getattr__(self.batch_name_map["rewards"])
-        last_val = self.expected_V(
-            batch.__getattr__(self.batch_name_map["obs_"])[agent_num, -1], None
+        last_obs_ = next_obs(
+            batch,
+            agent_num,
+            -1,
+            self.batch_name_map["obs_"],
+            self.batch_name_map["obs"],
         )
+        last_val = self.expected_V(last_obs_, None)
         if self.advantage_type == "gv":
             G = FlexibleBuffer.G(
                 rewards,
@@ -761,44 +775,49 @@ class PG(nn.Module, Agent):
     def _continuous_actor_loss(
         self, action_means, action_log_std, old_log_probs, advantages, actions
     ):
-
+        """Returns the clipped actor loss and the per-sample log ratio [mb]"""
         cont_log_probs, cont_entropy = self._get_cont_log_probs_entropy(
             logits=action_means,
             actions=actions,
             lstd_logits=action_log_std,
         )
+        if cont_log_probs.dim() > old_log_probs.dim():
+            # train_actions stores the joint log prob summed over action dims
+            cont_log_probs = cont_log_probs.sum(-1)
+        adv = advantages.reshape(-1, *([1] * (cont_log_probs.dim() - 1)))
+        logratio = (
+            cont_log_probs
+            - old_log_probs  # batch.continuous_log_probs[agent_num, indices]
+        )
         if self.ppo_clip > 0:
-            logratio = (
-                cont_log_probs
-                - old_log_probs  # batch.continuous_log_probs[agent_num, indices]
-            )
             ratio = logratio.exp()
-            pg_loss1 = advantages * ratio
-            pg_loss2 = advantages * torch.clamp(
-                ratio, 1 - self.ppo_clip, 1 + self.ppo_clip
-            )
+            pg_loss1 = adv * ratio
+            pg_loss2 = adv * torch.clamp(ratio, 1 - self.ppo_clip, 1 + self.ppo_clip)
             continuous_policy_gradient = torch.min(pg_loss1, pg_loss2)
         else:
-            continuous_policy_gradient = cont_log_probs * advantages
+            continuous_policy_gradient = cont_log_probs * adv
         actor_loss = (
             -self.policy_loss * continuous_policy_gradient.mean()
             - self.entropy_loss * cont_entropy
         )
-        return actor_loss
+        if logratio.dim() > 1:
+            logratio = logratio.sum(-1)
+        return actor_loss, logratio.detach()
 
     def _discrete_actor_loss(self, actions, log_probs, logits, advantages):
+        """Returns the clipped actor loss and the per-sample log ratio [mb]"""
         actor_loss = torch.zeros(1, device=self.device)
+        total_logratio = torch.zeros(actions.shape[0], device=self.device)
         for head in range(actions.shape[-1]):
             dist = Categorical(logits=logits[head])  # TODO: th
             entropy = dist.entropy().mean()
             selected_log_probs = dist.log_prob(actions[:, head])
+            logratio = (
+                selected_log_probs
+                - log_probs[:, head]  # batch.discrete_log_probs[agent_num, indices, head]
+            )
+            total_logratio += logratio.detach()
             if self.ppo_clip > 0:
-                logratio = (
-                    selected_log_probs
-                    - log_probs[
-                        :, head
-                    ]  # batch.discrete_log_probs[agent_num, indices, head]
-                )
                 ratio = logratio.exp()
                 pg_loss1 = advantages.squeeze(-1) * ratio
                 pg_loss2 = advantages.squeeze(-1) * torch.clamp(
@@ -812,7 +831,7 @@ class PG(nn.Module, Agent):
                 -self.policy_loss * discrete_policy_gradient.mean()
                 - self.entropy_loss * entropy
             )
-        return actor_loss
+        return actor_loss, total_logratio
 
     def reinforcement_learn(
         self,
@@ -820,20 +839,35 @@ class PG(nn.Module, Agent):
         agent_num=0,
         critic_only=False,
         debug=False,
+        return_td_errors=False,  # also return a dict of per-sample stats
     ):
         if self.eval_mode:
+            if return_td_errors:
+                return 0, 0, None
             return 0, 0
         if debug:
             print(f"Starting PG Reinforcement Learn for agent {agent_num}")
+        self.timer.start("advantage")
         with torch.no_grad():
             G, advantages, values = self._calculate_advantages(batch, agent_num, debug)
+            diag = Diagnostics() if self.diagnostics else None
+            if diag is not None:
+                v = values
+                if v is None:
+                    v = self.critic(
+                        batch.__getattr__(self.batch_name_map["obs"])[agent_num]
+                    )
+                diag.add("explained_variance", explained_variance(v, G))
         assert isinstance(
             advantages, torch.Tensor
         ), "Advantages has to be a tensor but it isn't, maybe batch was not called with as_torch=True?"
-        if self.norm_advantages:
+        raw_advantages = advantages
+        if self.norm_advantages and advantages.numel() > 1:
+            # a single sample has no std to normalize by
             advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
-        avg_actor_loss = 0
-        avg_critic_loss = 0
+        # per epoch means summed on device, read back once after the update
+        loss_sums = torch.zeros(2, device=self.device)
+        grad_norm = None
         # Update the actor
         action_mask = None
         if batch.action_mask is not None:
@@ -845,24 +879,31 @@ class PG(nn.Module, Agent):
             batch.terminated, torch.Tensor
         ), "need to send batch to torch first"
         bsize = len(batch.terminated)
-        nbatch = bsize // self.mini_batch_size
+        n_minibatches = -(-bsize // self.mini_batch_size)  # loop runs ceil times
+        skipped_minibatches = 0
+        epochs_run = 0
         mini_batch_indices = np.arange(len(batch.terminated))
         np.random.shuffle(mini_batch_indices)
+        ratios = None
+        if return_td_errors:
+            ratios = torch.ones(bsize, device=self.device)
 
         if debug:
             print(
-                f"  bsize: {bsize}, Mini batch indices: {mini_batch_indices}, nbatch: {nbatch}"
+                f"  bsize: {bsize}, Mini batch indices: {mini_batch_indices}, n_minibatches: {n_minibatches}"
             )
 
         for epoch in range(self.n_epochs):
             if debug:
                 print("  Starting epoch", epoch)
             bnum = 0
+            kl_stop = False
+            epoch_sums = torch.zeros(2, device=self.device)
 
             while self.mini_batch_size * bnum < bsize:
                 # Get Critic Loss
                 bstart = self.mini_batch_size * bnum
-                bend = min(bstart + self.mini_batch_size, bsize - 1)
+                bend = min(bstart + self.mini_batch_size, bsize)
                 indices = mini_batch_indices[bstart:bend]
                 bnum += 1
                 if debug:
@@ -870,11 +911,14 @@ class PG(nn.Module, Agent):
                         f"    Mini batch: {bstart}:{bend}, Indices: {indices}, {len(indices)}"
                     )
 
+                self.timer.start("loss")
                 critic_loss = self._critic_loss(batch, indices, G, agent_num, debug)
                 actor_loss = torch.zeros(1, device=self.device)
                 # print(torch.abs(V_current - G[indices]).mean())
                 if not critic_only:
                     mb_adv = advantages[torch.from_numpy(indices).to(self.device)]
+                    mb_logratio = 0
+                    self.timer.start("forward")
                     continuous_means, continuous_log_std_logits, discrete_logits = (
                         self.actor(
                             x=batch.__getattr__(self.batch_name_map["obs"])[
@@ -882,6 +926,7 @@ class PG(nn.Module, Agent):
                             ],
                         )
                     )
+                    self.timer.start("loss")
                     if self.continuous_action_dim > 0:
                         clp = batch.__getattr__(
                             self.batch_name_map["continuous_log_probs"]
@@ -889,13 +934,15 @@ class PG(nn.Module, Agent):
                         cact = batch.__getattr__(
                             self.batch_name_map["continuous_actions"]
                         )[agent_num, indices]
-                        actor_loss += self._continuous_actor_loss(
+                        c_loss, c_logratio = self._continuous_actor_loss(
                             continuous_means,
                             continuous_log_std_logits,
                             clp,
                             mb_adv,
                             cact,
                         )
+                        actor_loss += c_loss
+                        mb_logratio = mb_logratio + c_logratio
                     if self.discrete_action_dims is not None:
                         dact = batch.__getattr__(
                             self.batch_name_map["discrete_actions"]
@@ -910,9 +957,30 @@ class PG(nn.Module, Agent):
                         dlp = batch.__getattr__(
                             self.batch_name_map["discrete_log_probs"]
                         )[agent_num, indices]
-                        actor_loss += self._discrete_actor_loss(
+                        d_loss, d_logratio = self._discrete_actor_loss(
                             dact, dlp, discrete_logits, mb_adv
                         )
+                        actor_loss += d_loss
+                        mb_logratio = mb_logratio + d_logratio
+                    if diag is not None:
+                        diag.add_ratio(mb_logratio, self.ppo_clip)
+                    if ratios is not None:
+                        # the last epoch's ratio is the one that gets reported
+                        ratios[torch.from_numpy(indices).to(self.device)] = (
+                            mb_logratio.exp()
+                        )
+                    if self.target_kl is not None:
+                        # k3 estimate of KL(old || new) from the log ratios we
+                        # already have, checked before the step so a minibatch
+                        # that overshoots is not applied. The only per
+                        # minibatch sync, and only when target_kl is set
+                        self.timer.start("to_numpy")
+                        approx_kl = (
+                            ((mb_logratio.exp() - 1) - mb_logratio).mean().item()
+                        )
+                        if approx_kl > self.target_kl:
+                            kl_stop = True
+                            break
 
                     # print("actor")
                     # self.optimizer.zero_grad()
@@ -920,6 +988,7 @@ class PG(nn.Module, Agent):
                     # loss.backward()
                     # self._print_grad_norm()
                     # print("critic")
+                self.timer.start("backward")
                 self.optimizer.zero_grad()
                 loss = actor_loss + critic_loss * self.critic_loss_coef
                 loss.backward()
@@ -928,25 +997,67 @@ class PG(nn.Module, Agent):
                 # print(self.actor_logstd.grad)
                 # self._print_grad_norm()
 
+                self.timer.start("optimizer")
                 if self.clip_grad:
-                    torch.nn.utils.clip_grad_norm_(
+                    grad_norm = torch.nn.utils.clip_grad_norm_(
                         self.parameters(),
                         0.5,
                         error_if_nonfinite=True,
                         foreach=True,
                     )
+                if diag is not None:
+                    if not self.clip_grad:
+                        grad_norm = total_grad_norm(self.parameters())
+                    diag.add("grad_norm", grad_norm)
 
                 self.optimizer.step()
 
-                avg_actor_loss += actor_loss.to("cpu").item()
-                avg_critic_loss += critic_loss.to("cpu").item()
-            avg_actor_loss /= nbatch
-            avg_critic_loss /= nbatch
-            # print(f"actor_loss: {actor_loss.item()}")
-
-        avg_actor_loss /= self.n_epochs
-        avg_critic_loss /= self.n_epochs
+                epoch_sums += torch.stack(
+                    [actor_loss.detach().reshape(()), critic_loss.detach().reshape(())]
+                )
+            # minibatches applied this epoch, the one that hit target_kl is not
+            done = bnum - 1 if kl_stop else bnum
+            if done > 0:
+                loss_sums += epoch_sums / done
+                epochs_run += 1
+            if kl_stop:
+                skipped_minibatches = (self.n_epochs - epoch) * n_minibatches - done
+                if debug:
+                    print(
+                        f"  approx kl {approx_kl} > {self.target_kl}, skipping {skipped_minibatches} mini batches"
+                    )
+                break
+
+        self.timer.start("to_numpy")
+        avg_actor_loss, avg_critic_loss = (loss_sums / max(1, epochs_run)).tolist()
+        self.last_skipped_minibatches = skipped_minibatches
+        if diag is not None:
+            diag.add("skipped_minibatches", skipped_minibatches)
+            self._publish_diagnostics(diag)
+        if self.metrics is not None:
+            self.metrics.inc("updates")
+            if self.target_kl is not None:
+                self.metrics.set("skipped_minibatches", skipped_minibatches)
+            self.metrics.set("actor_loss", avg_actor_loss)
+            self.metrics.set("critic_loss", avg_critic_loss)
+            if grad_norm is not None:
+                self.metrics.set("grad_norm", grad_norm)
+        self.timer.step()
         # print(avg_actor_loss, critic_loss.item())
+        if return_td_errors:
+            td_errors = None
+            if values is not None:
+                td_errors = (G.reshape(-1) - values.reshape(-1)).abs()
+            elif self.advantage_type == "gv":
+                td_errors = raw_advantages.reshape(-1).abs()
+            stats = {
+                "advantages": raw_advantages.reshape(-1),
+                "returns": G.reshape(-1),
+                "ratios": ratios,
+                "td_errors": td_errors,
+                "skipped_minibatches": skipped_minibatches,
+            }
+            return avg_actor_loss, avg_critic_loss, stats
         return avg_actor_loss, avg_critic_loss
 
     def _dump_attr(self, attr, path):
@@ -975,6 +1086,7 @@ class PG(nn.Module, Agent):
             self._dump_attr(
                 self.__dict__[self.attrs[i]], checkpoint_path + f"/{self.attrs[i]}"
             )
+        save_training_state(self, checkpoint_path)
 
     def load(self, checkpoint_path):
         if checkpoint_path is None:
@@ -984,161 +1096,27 @@ class PG(nn.Module, Agent):
             self.__dict__[self.attrs[i]] = self._load_attr(
                 checkpoint_path + f"/{self.attrs[i]}"
             )
-        self._get_torch_params(self.starting_actorlogstd)
-        self.policy_loss = 5.0
+        if isinstance(self.max_actions, torch.Tensor):
+            # saved as tensors, the actor wants numpy and the agent torch
+            self.min_actions = self.min_actions.cpu().numpy()
+            self.max_actions = self.max_actions.cpu().numpy()
+        self._get_torch_params(self.encoder, self.action_head_hidden_dims)
+        if isinstance(self.max_actions, np.ndarray):
+            self.min_actions = torch.from_numpy(self.min_actions).to(self.device)
+            self.max_actions = torch.from_numpy(self.max_actions).to(self.device)
+        self.policy_loss = 1.0
         self.actor.load_state_dict(torch.load(checkpoint_path + "/PI"))
         self.critic.load_state_dict(torch.load(checkpoint_path + "/V"))
-        self.actor_logstd = torch.load(checkpoint_path + "/actor_logstd")
+        if self.actor_logstd is not None:
+            # copy in place so the optimizer keeps pointing at the parameter
+            with torch.no_grad():
+                self.actor_logstd.copy_(
+                    torch.load(checkpoint_path + "/actor_logstd").to(self.device)
+                )
+        load_training_state_file(self, checkpoint_path)
 
     def __str__(self):
         st = ""
         for d in self.__dict__.keys():
             st += f"{d}: {self.__dict__[d]}"
         return st
-
-    def reinforcement_learn_perf(
-        self,
-        batch: FlexiBatch,
-        agent_num=0,
-        critic_only=False,
-        debug=False,
-    ):
-        __s = time.time()
-        if self.eval_mode:
-            return 0, 0
-        if debug:
-            print(f"Starting PG Reinforcement Learn for agent {agent_num}")
-        # self.run_times = {"advantage":0.0,"aloss":0.0,"closs":0.0,"backward":0.0,"total_time"}
-        _s = time.time()
-        with torch.no_grad():
-            G, advantages, values = self._calculate_advantages(batch, agent_num, debug)
-
-        # print(G.shape)
-        # input("hmm rl")
-        assert isinstance(
-            advantages, torch.Tensor
-        ), "Advantages has to be a tensor but it isn't, maybe batch was not called with as_torch=True?"
-        if self.norm_advantages:
-            advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-8)
-        self.run_times["advantage"] += time.time() - _s
-
-        avg_actor_loss = 0
-        avg_critic_loss = 0
-        # Update the actor
-        action_mask = None
-        if batch.action_mask is not None:
-            action_mask = batch.action_mask[agent_num]  # TODO: Unit test this later
-            if action_mask is not None:
-                print("Action mask Not implemented yet")
-
-        assert isinstance(
-            batch.terminated, torch.Tensor
-        ), "need to send batch to torch first"
-        bsize = len(batch.terminated)
-        nbatch = bsize // self.mini_batch_size
-        mini_batch_indices = np.arange(len(batch.terminated))
-        np.random.shuffle(mini_batch_indices)
-
-        if debug:
-            print(
-                f"  bsize: {bsize}, Mini batch indices: {mini_batch_indices}, nbatch: {nbatch}"
-            )
-
-        for epoch in range(self.n_epochs):
-            if debug:
-                print("  Starting epoch", epoch)
-            bnum = 0
-
-            while self.mini_batch_size * bnum < bsize:
-                # Get Critic Loss
-                bstart = self.mini_batch_size * bnum
-                bend = min(bstart + self.mini_batch_size, bsize - 1)
-                indices = mini_batch_indices[bstart:bend]
-                bnum += 1
-                if debug:
-                    print(
-                        f"    Mini batch: {bstart}:{bend}, Indices: {indices}, {len(indices)}"
-                    )
-                _s = time.time()
-                critic_loss = self._critic_loss(batch, indices, G, agent_num, debug)
-                self.run_times["critic_loss"] += time.time() - _s
-
-                actor_loss = torch.zeros(1, device=self.device)
-                # print(torch.abs(V_current - G[indices]).mean())
-                if not critic_only:
-                    mb_adv = advantages[torch.from_numpy(indices).to(self.device)]
-                    _s = time.time()
-                    continuous_means, continuous_log_std_logits, discrete_logits = (
-                        self.actor(
-                            x=batch.__getattr__(self.batch_name_map["obs"])[
-                                agent_num, indices
-                            ],
-                        )
-                    )
-                    self.run_times["act"] += time.time() - _s
-
-                    if self.continuous_action_dim > 0:
-                        _s = time.time()
-                        clp = batch.__getattr__(
-                            self.batch_name_map["continuous_log_probs"]
-                        )[agent_num, indices]
-                        cact = batch.__getattr__(
-                            self.batch_name_map["continuous_actions"]
-                        )[agent_num, indices]
-                        actor_loss += self._continuous_actor_loss(
-                            continuous_means,
-                            continuous_log_std_logits,
-                            clp,
-                            mb_adv,
-                            cact,
-                        )
-                        self.run_times["closs"] += time.time() - _s
-
-                    if self.discrete_action_dims is not None:
-                        _s = time.time()
-                        dact = batch.__getattr__(
-                            self.batch_name_map["discrete_actions"]
-                        )[agent_num, indices]
-                        dlp = batch.__getattr__(
-                            self.batch_name_map["discrete_log_probs"]
-                        )[agent_num, indices]
-                        actor_loss += self._discrete_actor_loss(
-                            dact, dlp, discrete_logits, mb_adv
-                        )
-                        self.run_times["dloss"] = time.time() - _s
-                    # print("actor")
-                    # self.optimizer.zero_grad()
-                    # loss = actor_loss
-                    # loss.backward()
-                    # self._print_grad_norm()
-                    # print("critic")
-                _s = time.time()
-                self.optimizer.zero_grad()
-                loss = actor_loss + critic_loss * self.critic_loss_coef
-                loss.backward()
-                # self._print_grad_norm()
-                # print(self.actor_logstd)
-                # print(self.actor_logstd.grad)
-                # self._print_grad_norm()
-
-                if self.clip_grad:
-                    torch.nn.utils.clip_grad_norm_(
-                        self.parameters(),
-                        0.5,
-                        error_if_nonfinite=True,
-                        foreach=False,
-                    )
-
-                self.optimizer.step()
-
-                self.run_times["backward"] += time.time() - _s
-
-                avg_actor_loss += actor_loss.to("cpu").item()
-                avg_critic_loss += critic_loss.to("cpu").item()
-            avg_actor_loss /= nbatch
-            avg_critic_loss /= nbatch
-        avg_actor_loss /= self.n_epochs
-        avg_critic_loss /= self.n_epochs
-
-        self.run_times["tot"] += time.time() - __s
-        return avg_actor_loss, avg_critic_loss
@@ -0,0 +1,449 @@
+import numpy as np
+import torch
+from flexibuff import FlexibleBuffer, FlexiBatch
+from .Util import n_step_window
+
+
+class SumTree:
+    """
+    Array backed binary sum tree. Leaves live in tree[size:2*size] and every
+    internal node holds the sum of its two children, so the root tree[1] is
+    the total priority. update and sample work on whole index / value batches
+    at a time, one vectorized numpy op per tree level (O(batch * log n)).
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 1
+        while self.size < capacity:
+            self.size *= 2
+        self.depth = int(np.log2(self.size))
+        self.tree = np.zeros(2 * self.size, dtype=np.float64)
+        self.last = 0  # highest leaf ever written
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def get(self, idx):
+        return self.tree[np.asarray(idx) + self.size]
+
+    def update(self, idx, priorities):
+        nodes = np.asarray(idx, dtype=np.int64) + self.size
+        self.tree[nodes] = priorities
+        if nodes.size > 0:
+            self.last = max(self.last, int(nodes.max()) - self.size)
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """Returns the leaf index whose prefix sum interval contains each value"""
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(values.shape[0], dtype=np.int64)
+        for _ in range(self.depth):
+            left = self.tree[2 * nodes]
+            go_right = values > left
+            values -= left * go_right
+            nodes = 2 * nodes + go_right
+        # float round off can walk into an empty leaf past the last written one
+        return np.minimum(nodes - self.size, self.last)
+
+
+class PrioritizedSampler:
+    """
+    Proportional prioritized experience replay (Schaul et al. 2015) for a
+    flexibuff FlexibleBuffer. The sampler only keeps the priorities, the
+    transitions stay in the buffer:
+
+        sampler.sync(buffer)  # new transitions get the current max priority
+        batch, idx, weights = sampler.sample(buffer, 256, device=device)
+        aloss, closs, td_errors = agent.reinforcement_learn(
+            batch, weights=weights, return_td_errors=True
+        )
+        sampler.update_priorities(idx, td_errors)
+
+    alpha: how strongly priorities skew sampling, 0 is uniform
+    beta: importance sampling correction, annealed linearly to 1 over
+        beta_steps calls to sample. weights are normalized by the batch max.
+    """
+
+    def __init__(self, capacity, alpha=0.6, beta=0.4, beta_steps=100000, eps=1e-6):
+        self.capacity = capacity
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_start = beta
+        self.beta_steps = beta_steps
+        self.eps = eps
+        self.tree = SumTree(capacity)
+        self.max_priority = 1.0
+        self.n_stored = 0
+        self.n_sampled = 0
+        self._seen = 0
+
+    def add(self, idx):
+        idx = np.atleast_1d(np.asarray(idx, dtype=np.int64))
+        self.tree.update(idx, np.full(idx.shape[0], self.max_priority**self.alpha))
+        self.n_stored = min(self.capacity, self.n_stored + idx.shape[0])
+
+    def sync(self, buffer: FlexibleBuffer):
+        """Gives every transition written since the last sync max priority"""
+        assert buffer.mem_size == self.capacity, "Sampler and buffer sizes differ"
+        n_new = min(buffer.steps_recorded - self._seen, self.capacity)
+        if n_new > 0:
+            end = buffer.idx % self.capacity
+            self.add((end - n_new + np.arange(n_new)) % self.capacity)
+            self.n_stored = min(buffer.steps_recorded, self.capacity)
+        self._seen = buffer.steps_recorded
+
+    def sample_indices(self, batch_size):
+        """Stratified proportional sampling, returns (idx, is_weights) in numpy"""
+        assert self.n_stored > 0, "Nothing to sample, call add or sync first"
+        total = self.tree.total
+        seg = total / batch_size
+        values = (np.arange(batch_size) + np.random.rand(batch_size)) * seg
+        idx = self.tree.find(values)
+        probs = np.maximum(self.tree.get(idx) / total, 1e-12)
+
+        frac = min(1.0, self.n_sampled / max(1, self.beta_steps))
+        self.beta = self.beta_start + frac * (1.0 - self.beta_start)
+        self.n_sampled += 1
+        weights = (self.n_stored * probs) ** (-self.beta)
+        weights /= weights.max()
+        return idx, weights.astype(np.float32)
+
+    def sample(
+        self, buffer: FlexibleBuffer, batch_size=256, as_torch=True, device="cpu"
+    ):
+        idx, weights = self.sample_indices(batch_size)
+        batch = buffer.sample_transitions(idx=idx, as_torch=as_torch, device=device)
+        if as_torch:
+            weights = torch.from_numpy(weights).to(device)
+        return batch, idx, weights
+
+    def update_priorities(self, idx, td_errors):
+        """Writes |td_error| back for the sampled rows, O(batch)"""
+        if torch.is_tensor(td_errors):
+            td_errors = td_errors.detach().cpu().numpy()
+        p = np.abs(np.asarray(td_errors, dtype=np.float64)).reshape(-1) + self.eps
+        self.max_priority = max(self.max_priority, float(p.max()))
+        self.tree.update(idx, p**self.alpha)
+
+
+class TorchReplayBuffer:
+    """
+    Replay ring buffer kept in preallocated torch tensors on the training
+    device, for DQN / TD3 / DDPG:
+
+        rb = TorchReplayBuffer.for_agent(agent, capacity=1_000_000)
+        rb.add(obs, obs_, rewards, terminated, discrete_actions=d, continuous_actions=c)
+        agent.reinforcement_learn(rb.sample(256))
+
+    add writes [N_env] rows with at most two slice copies (one when the ring
+    wraps), so nothing is allocated per step. sample draws indices with
+    torch.randint on device and gathers every field once, the batch is a
+    FlexiBatch of [1, B, ...] views of those gathers with the field names
+    reinforcement_learn reads. Fields for an action kind the agent does not
+    have are None.
+
+    dedup_next_obs: do not store obs_, which halves observation memory. Each
+    add has to be one vector step of the same n_envs envs (in the same
+    order), so the next observation of row i is obs of row i + n_envs. Only
+    rows whose episode ended (terminated or truncated) keep their obs_, in a
+    side table that starts with terminal_capacity rows (capacity // 16 by
+    default) and doubles when more episode ends are stored, up to capacity
+    rows, and the latest step's obs_ is held until the next add. sample
+    gathers obs_ back from those, so agents see a normal batch.
+
+    n_step: build n-step targets from the buffer itself. Each add has to be
+    one vector step of the same envs, so the steps after row i are rows
+    i + n_envs, i + 2 * n_envs, ... Windows stop at episode ends and at the
+    newest row, see Util.n_step_window. Batches then carry n_step_rewards and
+    n_step_discount (gamma**m, 0 after a termination) and their obs_ is the
+    state to bootstrap from, which DQN / TD3 / DDPG use whatever their own
+    n_step is. for_agent takes n_step and gamma from the agent.
+    """
+
+    def __init__(
+        self,
+        capacity,
+        obs_dim,
+        continuous_action_dim=0,
+        n_discrete_actions=0,
+        device="cpu",
+        obs_dtype=torch.float32,
+        seed=None,
+        dedup_next_obs=False,
+        terminal_capacity=None,
+        n_step=1,
+        gamma=0.99,
+    ):
+        self.capacity = capacity
+        self.n_step = n_step
+        self.gamma = gamma
+        # rows per add, 0 once adds of different sizes were mixed
+        self.n_envs = None
+        self.device = torch.device(device)
+        self.size = 0
+        self.ptr = 0
+        self.steps_recorded = 0
+        dev = self.device
+        self.fields = {
+            "obs": torch.zeros(capacity, obs_dim, dtype=obs_dtype, device=dev),
+            "global_rewards": torch.zeros(capacity, device=dev),
+            "terminated": torch.zeros(capacity, device=dev),
+            "truncated": torch.zeros(capacity, device=dev),
+        }
+        if n_discrete_actions > 0:
+            self.fields["discrete_actions"] = torch.zeros(
+                capacity, n_discrete_actions, dtype=torch.long, device=dev
+            )
+        if continuous_action_dim > 0:
+            self.fields["continuous_actions"] = torch.zeros(
+                capacity, continuous_action_dim, device=dev
+            )
+        self.dedup_next_obs = dedup_next_obs
+        if dedup_next_obs:
+            if terminal_capacity is None:
+                terminal_capacity = max(1, capacity // 16)
+            self.terminal_capacity = terminal_capacity
+            self.terminal_obs = torch.zeros(
+                terminal_capacity, obs_dim, dtype=obs_dtype, device=dev
+            )
+            # side table slot of each row (-1 if none) and its host mirror,
+            # plus the row owning each slot, so a slot still in use is
+            # never handed out again
+            self.terminal_slot = torch.full(
+                (capacity,), -1, dtype=torch.long, device=dev
+            )
+            self._row_slot = np.full(capacity, -1, dtype=np.int64)
+            self._slot_row = np.full(terminal_capacity, -1, dtype=np.int64)
+            self._next_slot = 0
+            self.pending_obs_ = None
+            self.latest = 0
+        else:
+            self.fields["obs_"] = torch.zeros(
+                capacity, obs_dim, dtype=obs_dtype, device=dev
+            )
+        self.generator = None
+        if seed is not None:
+            self.generator = torch.Generator(device=dev)
+            self.generator.manual_seed(seed)
+
+    @classmethod
+    def for_agent(cls, agent, capacity, device=None, **kwargs):
+        """
+        Sized from the agent's obs_dim and action dims, on its device, storing
+        observations in the agent's obs_codec dtype if it has one and
+        sampling with the agent's n_step and gamma
+        """
+        cdim = getattr(agent, "continuous_action_dim", None)
+        if cdim is None:
+            cdim = getattr(agent, "continuous_action_dims", 0)  # DQN
+        ddims = getattr(agent, "discrete_action_dims", None)
+        codec = getattr(agent, "obs_codec", None)
+        if codec is not None:
+            kwargs.setdefault("obs_dtype", codec.dtype)
+        kwargs.setdefault("n_step", getattr(agent, "n_step", 1))
+        kwargs.setdefault("gamma", getattr(agent, "gamma", 0.99))
+        return cls(
+            capacity,
+            agent.obs_dim,
+            continuous_action_dim=cdim or 0,
+            n_discrete_actions=0 if ddims is None else len(ddims),
+            device=device if device is not None else agent.device,
+            **kwargs,
+        )
+
+    def __len__(self):
+        return self.size
+
+    def _write(self, name, start, end, value, offset):
+        dst = self.fields[name][start:end]
+        src = value[offset : offset + end - start]
+        dst.copy_(src.reshape(dst.shape), non_blocking=True)
+
+    def add(
+        self,
+        obs,
+        obs_,
+        global_rewards,
+        terminated,
+        discrete_actions=None,
+        continuous_actions=None,
+        truncated=None,
+    ):
+        """
+        Append a [N_env] batch of transitions (numpy or torch, any device).
+        Returns the ring indices written, e.g. for PrioritizedSampler.add.
+        """
+        n = len(global_rewards)
+        assert n <= self.capacity, "more rows than the buffer holds"
+        if truncated is None:
+            truncated = torch.zeros(n)
+        values = {
+            "obs": obs,
+            "obs_": obs_,
+            "global_rewards": global_rewards,
+            "terminated": terminated,
+            "truncated": truncated,
+            "discrete_actions": discrete_actions,
+            "continuous_actions": continuous_actions,
+        }
+        start = self.ptr
+        first = min(n, self.capacity - start)
+        if self.dedup_next_obs:
+            self._add_next_obs(obs_, terminated, truncated, start, n)
+        elif self.n_envs is None:
+            self.n_envs = n
+        elif n != self.n_envs:
+            self.n_envs = 0
+        for name, v in values.items():
+            if v is None or name not in self.fields:
+                continue
+            if not torch.is_tensor(v):
+                v = torch.from_numpy(np.asarray(v))
+            self._write(name, start, start + first, v, 0)
+            if first < n:  # wrapped around the end of the ring
+                self._write(name, 0, n - first, v, first)
+        self.ptr = (start + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+        self.steps_recorded += n
+        return (start + np.arange(n)) % self.capacity
+
+    def _add_next_obs(self, obs_, terminated, truncated, start, n):
+        if self.n_envs is None:
+            assert (
+                self.capacity % n == 0
+            ), f"capacity {self.capacity} has to be a multiple of n_envs {n}"
+            self.n_envs = n
+            self.pending_obs_ = self.terminal_obs.new_zeros(
+                (n, *self.terminal_obs.shape[1:])
+            )
+        assert n == self.n_envs, "dedup_next_obs needs every add to hold n_envs rows"
+        rows = start + np.arange(n)  # blocks never wrap, capacity % n == 0
+        # rows being overwritten give their side table slots back
+        old = self._row_slot[rows]
+        self._slot_row[old[old >= 0]] = -1
+        self._row_slot[rows] = -1
+        done = np.zeros(n, dtype=bool)
+        for flags in [terminated, truncated]:
+            if torch.is_tensor(flags):
+                flags = flags.detach().cpu().numpy()
+            done |= np.asarray(flags).reshape(-1) > 0.5
+        done_rows = np.nonzero(done)[0]
+        k = done_rows.shape[0]
+        slots = (self._next_slot + np.arange(k)) % self.terminal_capacity
+        if k > 0:
+            # more new ends than slots would hand out a slot twice
+            if k > self.terminal_capacity or (self._slot_row[slots] >= 0).any():
+                self._grow_terminal(k)
+                slots = self._next_slot + np.arange(k)
+            self._next_slot = int(slots[-1] + 1) % self.terminal_capacity
+            self._slot_row[slots] = rows[done_rows]
+            self._row_slot[rows[done_rows]] = slots
+        if not torch.is_tensor(obs_):
+            obs_ = torch.from_numpy(np.asarray(obs_))
+        obs_ = obs_.to(self.device).reshape(n, -1)
+        self.pending_obs_.copy_(obs_)
+        self.latest = start
+        slot_t = torch.from_numpy(self._row_slot[rows]).to(self.device)
+        self.terminal_slot[start : start + n] = slot_t
+        if k > 0:
+            self.terminal_obs[torch.from_numpy(slots).to(self.device)] = obs_[
+                torch.from_numpy(done_rows).to(self.device)
+            ]
+
+    def _grow_terminal(self, k):
+        # Slots are handed out and freed in ring order, so the live ones are
+        # copied oldest first to the front of a larger table. Every live slot
+        # belongs to a different row, so capacity rows are always enough.
+        old = self.terminal_capacity
+        order = (self._next_slot + np.arange(old)) % old
+        live = order[self._slot_row[order] >= 0]
+        n_live = live.shape[0]
+        new = min(self.capacity, max(2 * old, n_live + k))
+        table = self.terminal_obs.new_zeros((new, *self.terminal_obs.shape[1:]))
+        table[:n_live] = self.terminal_obs[torch.from_numpy(live).to(self.device)]
+        owners = self._slot_row[live]
+        self._slot_row = np.full(new, -1, dtype=np.int64)
+        self._slot_row[:n_live] = owners
+        self._row_slot[owners] = np.arange(n_live)
+        self.terminal_slot[torch.from_numpy(owners).to(self.device)] = torch.arange(
+            n_live, device=self.device
+        )
+        self.terminal_obs = table
+        self.terminal_capacity = new
+        self._next_slot = n_live
+
+    def _next_obs(self, idx):
+        # obs_ of rows idx from the row n_envs later, the pending last step
+        # and the terminal side table
+        obs_ = self.fields["obs"][(idx + self.n_envs) % self.capacity]
+        offset = idx - self.latest
+        latest = ((offset >= 0) & (offset < self.n_envs)).unsqueeze(-1)
+        pending = self.pending_obs_[offset.clamp(0, self.n_envs - 1)]
+        obs_ = torch.where(latest, pending, obs_)
+        slot = self.terminal_slot[idx]
+        terminal = self.terminal_obs[slot.clamp(min=0)]
+        return torch.where((slot >= 0).unsqueeze(-1), terminal, obs_)
+
+    def _n_step_window(self, idx, n):
+        # rows of the next n steps of each row's env, valid up to the newest
+        assert self.n_envs, (
+            "n-step batches need every add to be one vector step of the same "
+            "n_envs envs"
+        )
+        steps = torch.arange(n, device=self.device) * self.n_envs
+        rows = (idx.unsqueeze(-1) + steps) % self.capacity  # [B, n]
+        age = (self.ptr - 1 - idx) % self.capacity  # rows written after idx
+        returns, discount, m = n_step_window(
+            self.fields["global_rewards"][rows],
+            self.fields["terminated"][rows],
+            self.gamma,
+            self.fields["truncated"][rows],
+            steps.unsqueeze(0) <= age.unsqueeze(-1),
+        )
+        last = rows.gather(1, (m - 1).unsqueeze(-1)).squeeze(-1)
+        return returns, discount, last
+
+    def batch(self, idx, n_step=None):
+        """
+        FlexiBatch of the rows idx (numpy or torch indices), with n-step
+        targets if n_step (self.n_step by default) is more than 1
+        """
+        if not torch.is_tensor(idx):
+            idx = torch.from_numpy(np.asarray(idx, dtype=np.int64))
+        idx = idx.to(self.device, non_blocking=True)
+        n_step = self.n_step if n_step is None else n_step
+        rv = {
+            name: self.fields[name][idx][None] if name in self.fields else None
+            for name in ["obs", "discrete_actions", "continuous_actions"]
+        }
+        last = idx
+        if n_step > 1:
+            returns, discount, last = self._n_step_window(idx, n_step)
+            rv["n_step_rewards"] = returns
+            rv["n_step_discount"] = discount
+        if self.dedup_next_obs:
+            rv["obs_"] = self._next_obs(last)[None]
+        else:
+            rv["obs_"] = self.fields["obs_"][last][None]
+        rv["global_rewards"] = self.fields["global_rewards"][idx]
+        return FlexiBatch(
+            registered_vals=rv,
+            terminated=self.fields["terminated"][idx],
+            truncated=self.fields["truncated"][idx],
+        )
+
+    def sample(self, batch_size=256, n_step=None):
+        """batch_size uniformly drawn transitions, indices drawn on device"""
+        assert self.size > 0, "Nothing to sample, call add first"
+        idx = torch.randint(
+            0,
+            self.size,
+            (batch_size,),
+            device=self.device,
+            generator=self.generator,
+        )
+        return self.batch(idx, n_step)
@@ -0,0 +1,215 @@
+import numpy as np
+import torch
+from flexibuddiesrl.Replay import SumTree, PrioritizedSampler, TorchReplayBuffer
+
+
+def vector_steps(n_steps, n_envs, obs_dim, done_prob, rng):
+    """Transitions of n_envs envs as a vector env with autoreset yields them"""
+    obs = rng.normal(size=(n_envs, obs_dim)).astype(np.float32)
+    for _ in range(n_steps):
+        obs_ = rng.normal(size=(n_envs, obs_dim)).astype(np.float32)
+        terminated = (rng.random(n_envs) < done_prob / 2).astype(np.float32)
+        truncated = (rng.random(n_envs) < done_prob / 2).astype(np.float32)
+        yield {
+            "obs": obs,
+            "obs_": obs_,
+            "global_rewards": rng.normal(size=n_envs).astype(np.float32),
+            "terminated": terminated,
+            "truncated": truncated,
+            "discrete_actions": rng.integers(0, 3, size=(n_envs, 1)),
+        }
+        done = (terminated + truncated) > 0
+        reset = rng.normal(size=(n_envs, obs_dim)).astype(np.float32)
+        obs = np.where(done[:, None], reset, obs_)
+
+
+def sum_tree_test(verbose=False):
+    """Leaves are drawn in proportion to their priority"""
+    rng = np.random.default_rng(0)
+    tree = SumTree(10)  # not a power of two, so the last leaves stay empty
+    p = rng.random(10) + 0.01
+    tree.update(np.arange(10), p)
+    sums_ok = np.isclose(tree.total, p.sum())
+    # every prefix sum boundary lands in the right leaf
+    edges = np.cumsum(p)
+    find_ok = np.array_equal(tree.find(edges - 1e-9), np.arange(10))
+    find_ok = find_ok and np.array_equal(tree.find(edges[:-1] + 1e-9), np.arange(1, 10))
+    counts = np.bincount(tree.find(rng.random(200_000) * tree.total), minlength=10)
+    freq = counts / counts.sum()
+    dist_ok = np.abs(freq - p / p.sum()).max() < 0.01
+    if verbose:
+        print(f"sampled {np.round(freq, 3)}\nexpected {np.round(p / p.sum(), 3)}")
+    ok = sums_ok and find_ok and dist_ok
+    print(f"SumTree totals {sums_ok}, find {find_ok}, distribution {dist_ok}")
+    return ok
+
+
+def partial_tree_test(verbose=False):
+    """A partly filled tree never hands out a leaf that was not written"""
+    rng = np.random.default_rng(0)
+    passes, total = 0, 0
+    for n in [1, 3, 10, 33]:
+        sampler = PrioritizedSampler(64)
+        sampler.add(np.arange(n))
+        sampler.update_priorities(np.arange(n), rng.random(n) + 0.01)
+        # values at and just past the total are where round off walks right
+        total_p = sampler.tree.total
+        edges = np.array([total_p, total_p * (1 + 1e-12), total_p + 1e-9])
+        idx = sampler.tree.find(edges)
+        sampled, _ = sampler.sample_indices(1000)
+        ok = idx.max() == n - 1 and sampled.max() < n
+        passes += ok
+        total += 1
+        if verbose or not ok:
+            print(f"{n} stored: edges found {idx}, max sampled {sampled.max()}")
+    print(f"SumTree partially filled passed {passes}/{total}")
+    return passes == total
+
+
+def per_weights_test(verbose=False):
+    """Importance weights are (N * P(i)) ** -beta over the batch max"""
+    np.random.seed(0)
+    sampler = PrioritizedSampler(20, alpha=0.6, beta=0.4, beta_steps=10)
+    sampler.add(np.arange(20))
+    td = np.linspace(0.1, 3.0, 20)
+    sampler.update_priorities(np.arange(20), td)
+    prio_ok = np.allclose(sampler.tree.get(np.arange(20)), (td + sampler.eps) ** 0.6)
+    passes, total = 0, 0
+    for i in range(15):
+        idx, w = sampler.sample_indices(64)
+        beta = 0.4 + min(1.0, i / 10) * 0.6
+        probs = sampler.tree.get(idx) / sampler.tree.total
+        expected = (20 * probs) ** -beta
+        expected /= expected.max()
+        ok = np.isclose(sampler.beta, beta) and np.allclose(w, expected, rtol=1e-5)
+        passes += ok
+        total += 1
+        if verbose and not ok:
+            print(f"sample {i}: beta {sampler.beta} expected {beta}")
+    print(f"PER priorities {prio_ok}, weights passed {passes}/{total}")
+    return prio_ok and passes == total
+
+
+def wraparound_test(verbose=False):
+    """Adds that wrap the ring keep exactly the last capacity rows"""
+    rng = np.random.default_rng(0)
+    capacity = 50
+    buf = TorchReplayBuffer(capacity, 4, continuous_action_dim=2)
+    ref = {"obs": np.zeros((capacity, 4), np.float32)}
+    ref["continuous_actions"] = np.zeros((capacity, 2), np.float32)
+    ref["global_rewards"] = np.zeros(capacity, np.float32)
+    passes, total = 0, 0
+    # block sizes that do not divide capacity, so writes split at the end
+    for n in [7, 13, 30, 50, 3, 11, 29, 17]:
+        step = {
+            "obs": rng.normal(size=(n, 4)).astype(np.float32),
+            "obs_": rng.normal(size=(n, 4)).astype(np.float32),
+            "global_rewards": rng.normal(size=n).astype(np.float32),
+            "terminated": np.zeros(n, np.float32),
+            "continuous_actions": rng.normal(size=(n, 2)).astype(np.float32),
+        }
+        rows = buf.add(**step)
+        for k in ref:
+            ref[k][rows] = step[k]
+        total += 1
+        b = buf.batch(np.arange(buf.size))
+        ok = np.array_equal(b.obs[0].numpy(), ref["obs"][: buf.size])
+        ok = ok and np.array_equal(
+            b.continuous_actions[0].numpy(), ref["continuous_actions"][: buf.size]
+        )
+        ok = ok and np.array_equal(
+            b.global_rewards.numpy(), ref["global_rewards"][: buf.size]
+        )
+        ok = ok and buf.ptr == (rows[-1] + 1) % capacity
+        passes += ok
+        if verbose and not ok:
+            print(f"add of {n} rows to ptr {rows[0]} differs")
+    print(f"TorchReplayBuffer wraparound passed {passes}/{total}")
+    return passes == total
+
+
+def dedup_test(verbose=False):
+    """dedup_next_obs on and off must hand out identical batches"""
+    passes, total = 0, 0
+    # (capacity, n_envs, done_prob): long episodes, episodes shorter than the
+    # default side table assumes, every step ending an episode, and more envs
+    # than the default side table has rows
+    cases = [(60, 3, 0.05), (60, 3, 0.5), (64, 4, 1.0), (30, 6, 0.5)]
+    for capacity, n_envs, done_prob in cases:
+        rng = np.random.default_rng(0)
+        plain = TorchReplayBuffer(capacity, 5, n_discrete_actions=1)
+        dedup = TorchReplayBuffer(
+            capacity, 5, n_discrete_actions=1, dedup_next_obs=True
+        )
+        # enough steps to wrap the ring several times
+        for t, step in enumerate(vector_steps(80, n_envs, 5, done_prob, rng)):
+            plain.add(**step)
+            dedup.add(**step)
+            total += 1
+            idx = torch.arange(plain.size)
+            a, b = plain.batch(idx), dedup.batch(idx)
+            ok = all(
+                torch.equal(getattr(a, k), getattr(b, k))
+                for k in ["obs", "obs_", "global_rewards", "terminated"]
+            )
+            passes += ok
+            if not ok and verbose:
+                print(f"capacity {capacity} n_envs {n_envs} step {t} differs")
+        if verbose:
+            print(
+                f"done_prob {done_prob}: side table grew to {dedup.terminal_capacity}"
+            )
+    print(f"TorchReplayBuffer dedup matches plain passed {passes}/{total}")
+    return passes == total
+
+
+def n_step_test(verbose=False):
+    """n-step windows follow each env's own steps, also across wraparound"""
+    gamma, n, n_envs = 0.9, 3, 3
+    passes, total = 0, 0
+    for dedup in [False, True]:
+        rng = np.random.default_rng(1)
+        buf = TorchReplayBuffer(
+            30, 5, n_discrete_actions=1, dedup_next_obs=dedup, n_step=n, gamma=gamma
+        )
+        log = []  # every row ever written, in order
+        for step in vector_steps(25, n_envs, 5, 0.3, rng):
+            buf.add(**step)
+            for e in range(n_envs):
+                log.append({k: v[e] for k, v in step.items()})
+            total += 1
+            idx = np.arange(buf.size)
+            b = buf.batch(idx)
+            ok = True
+            for i in idx:
+                # logical position of ring row i
+                p = len(log) - 1 - (buf.ptr - 1 - i) % buf.capacity
+                ret, disc, q = 0.0, 1.0, p
+                for k in range(n):
+                    q = p + k * n_envs
+                    if q >= len(log):
+                        q -= n_envs
+                        break
+                    ret += gamma**k * log[q]["global_rewards"]
+                    disc *= gamma
+                    if log[q]["terminated"] > 0:
+                        disc = 0.0
+                    if log[q]["terminated"] + log[q]["truncated"] > 0:
+                        break
+                ok = ok and np.isclose(b.n_step_rewards[i].item(), ret, atol=1e-5)
+                ok = ok and np.isclose(b.n_step_discount[i].item(), disc, atol=1e-6)
+                ok = ok and np.array_equal(b.obs_[0, i].numpy(), log[q]["obs_"])
+            passes += ok
+            if verbose and not ok:
+                print(f"dedup {dedup}: step {len(log) // n_envs} differs")
+    print(f"TorchReplayBuffer n-step windows passed {passes}/{total}")
+    return passes == total
+
+
+if __name__ == "__main__":
+    sum_tree_test()
+    partial_tree_test()
+    per_weights_test()
+    wraparound_test()
+    dedup_test()
+    n_step_test()
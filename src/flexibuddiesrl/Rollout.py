@@ -0,0 +1,314 @@
+import time
+import numpy as np
+import gymnasium as gym
+from flexibuff import FlexiBatch
+from .Agent import Agent
+from .Util import mark_time_ordered
+
+
+class RolloutCollector:
+    """
+    Steps a gymnasium.vector env (sync or async) with one batched
+    agent.train_actions call per vector step and writes the results into
+    preallocated [T, N] arrays. The arrays can then be handed to
+    reinforcement_learn either as one time-ordered FlexiBatch per env
+    (env_batches, for on-policy agents like PG) or as a single flat batch of
+    every valid transition (flat_batch, for DQN / TD3 / DDPG).
+
+    The vector env must use gymnasium's default NEXT_STEP autoreset. The step
+    right after an episode ends only resets that env, so its row is marked
+    invalid and left out of every batch.
+    """
+
+    def __init__(self, envs: gym.vector.VectorEnv, agent: Agent, n_steps=128):
+        self.envs = envs
+        self._allocate(envs, agent, n_steps, envs.num_envs)
+
+    def _allocate(self, envs, agent, n_steps, n_envs):
+        autoreset = envs.metadata.get("autoreset_mode", None)
+        assert (
+            autoreset is None or str(autoreset.value) == "NextStep"
+        ), f"RolloutCollector expects NEXT_STEP autoreset, got {autoreset}"
+        self.agent = agent
+        self.n_steps = n_steps
+        self.n_envs = n_envs
+        self._setup_action_space(envs.single_action_space)
+
+        T, N = n_steps, self.n_envs
+        obs_shape = envs.single_observation_space.shape
+        # observations are kept in the agent's codec dtype, see set_obs_codec
+        self.codec = getattr(agent, "obs_codec", None)
+        obs_dtype = np.float32 if self.codec is None else self.codec.numpy_dtype
+        # obs has one extra row so obs_ is just the view obs[1:]
+        self.obs = np.zeros((T + 1, N, *obs_shape), dtype=obs_dtype)
+        self.rewards = np.zeros((T, N), dtype=np.float32)
+        self.terminated = np.zeros((T, N), dtype=np.float32)
+        self.truncated = np.zeros((T, N), dtype=np.float32)
+        self.valid = np.zeros((T, N), dtype=bool)
+        self.discrete_actions = np.zeros((T, N, self.n_disc), dtype=np.int64)
+        self.discrete_log_probs = np.zeros((T, N, self.n_disc), dtype=np.float32)
+        self.continuous_actions = np.zeros((T, N, self.n_cont), dtype=np.float32)
+        self.continuous_log_probs = np.zeros((T, N), dtype=np.float32)
+
+        self._next_obs = None
+        self._prev_done = np.zeros(N, dtype=bool)
+        self._ep_returns = np.zeros(N, dtype=np.float64)
+        self.episode_returns = []
+        self.total_steps = 0
+        self.last_sps = 0.0
+
+    def _setup_action_space(self, space):
+        # arrays are sized by what the agent outputs, the env may use less
+        disc_dims = getattr(self.agent, "discrete_action_dims", None)
+        self.n_disc = 0 if disc_dims is None else len(disc_dims)
+        self.n_cont = getattr(self.agent, "continuous_action_dim", None)
+        if self.n_cont is None:
+            self.n_cont = getattr(self.agent, "continuous_action_dims", 0)
+        self.n_cont = int(self.n_cont or 0)
+        if isinstance(space, gym.spaces.Discrete):
+            self.action_type = "discrete"
+            assert self.n_disc >= 1, "Discrete env needs a discrete agent head"
+        elif isinstance(space, gym.spaces.MultiDiscrete):
+            self.action_type = "multi_discrete"
+            assert self.n_disc >= len(space.nvec), "Not enough discrete agent heads"
+            self.n_env_disc = len(space.nvec)
+        elif isinstance(space, gym.spaces.Box):
+            self.action_type = "continuous"
+            self.env_action_shape = space.shape
+            assert self.n_cont >= int(
+                np.prod(space.shape)
+            ), "Not enough continuous agent actions for the env"
+        else:
+            raise ValueError(f"RolloutCollector does not support {space}")
+
+    def _env_actions(self, dact, cact):
+        if self.action_type == "discrete":
+            return dact[:, 0]
+        if self.action_type == "multi_discrete":
+            return dact[:, : self.n_env_disc]
+        n = int(np.prod(self.env_action_shape))
+        return cact[:, :n].reshape(cact.shape[0], *self.env_action_shape)
+
+    def _act(self, t, sl, obs, step=True):
+        """Runs train_actions on obs for envs sl, stores row t, returns env actions"""
+        n = obs.shape[0]
+        dact, cact, dlp, clp, _ = self.agent.train_actions(obs, step=step)
+        if self.n_disc > 0:
+            self.discrete_actions[t, sl] = np.reshape(dact, (n, self.n_disc))
+            if isinstance(dlp, np.ndarray):
+                self.discrete_log_probs[t, sl] = np.reshape(dlp, (n, self.n_disc))
+        if self.n_cont > 0:
+            self.continuous_actions[t, sl] = np.reshape(cact, (n, self.n_cont))
+            if isinstance(clp, np.ndarray):
+                self.continuous_log_probs[t, sl] = np.reshape(clp, (n,))
+        return self._env_actions(
+            self.discrete_actions[t, sl], self.continuous_actions[t, sl]
+        )
+
+    def _encode(self, obs):
+        return obs if self.codec is None else self.codec.encode(obs)
+
+    def _record(self, t, sl, obs_, rewards, terminated, truncated):
+        self.obs[t + 1, sl] = self._encode(obs_)
+        self.rewards[t, sl] = rewards
+        self.terminated[t, sl] = terminated
+        self.truncated[t, sl] = truncated
+        # rows stepped right after an episode ended are autoreset steps
+        self.valid[t, sl] = ~self._prev_done[sl]
+        self.rewards[t, sl] *= self.valid[t, sl]
+
+        done = np.logical_or(terminated, truncated)
+        self._ep_returns[sl] += self.rewards[t, sl]
+        for r in self._ep_returns[sl][done]:
+            self.episode_returns.append(float(r))
+        self._ep_returns[sl][done] = 0.0
+        self._prev_done[sl] = done
+
+    def reset(self, seed=None):
+        obs, _ = self.envs.reset(seed=seed)
+        self._next_obs = self._encode(obs)
+        self._prev_done[:] = False
+        self._ep_returns[:] = 0.0
+
+    def collect(self):
+        """
+        Fills the [T, N] arrays with n_steps vector steps and returns self so
+        that env_batches() / flat_batch() can be chained on.
+        """
+        if self._next_obs is None:
+            self.reset()
+        start = time.perf_counter()
+        sl = slice(None)
+        self.obs[0] = self._next_obs
+        for t in range(self.n_steps):
+            actions = self._act(t, sl, self.obs[t])
+            obs_, rewards, terminated, truncated, _ = self.envs.step(actions)
+            self._record(t, sl, obs_, rewards, terminated, truncated)
+        self._next_obs = self.obs[-1].copy()
+        self.total_steps += self.n_steps * self.n_envs
+        self.last_sps = self.n_steps * self.n_envs / (time.perf_counter() - start)
+        return self
+
+    def _batch(self, t_idx, n_idx, terminated, truncated, device, dedup=False):
+        rv = {
+            "obs": self.obs[:-1][t_idx, n_idx][None],
+            "global_rewards": self.rewards[t_idx, n_idx],
+            "discrete_actions": self.discrete_actions[t_idx, n_idx][None],
+            "discrete_log_probs": self.discrete_log_probs[t_idx, n_idx][None],
+            "continuous_actions": self.continuous_actions[t_idx, n_idx][None],
+            "continuous_log_probs": self.continuous_log_probs[t_idx, n_idx][None],
+        }
+        if dedup:
+            # only rows whose next batch row is not their next step keep obs_
+            ends = np.append(t_idx[1:] != t_idx[:-1] + 1, len(t_idx) > 0)
+            rows = np.nonzero(ends)[0]
+            rv["obs_terminal"] = self.obs[1:][t_idx[rows], n_idx[rows]][None]
+            rv["obs_terminal_rows"] = rows
+        else:
+            rv["obs_"] = self.obs[1:][t_idx, n_idx][None]
+        batch = FlexiBatch(
+            registered_vals=rv,
+            terminated=terminated,
+            truncated=truncated,
+        )
+        if device is not None:
+            batch.to_torch(device)
+        return batch
+
+    def env_batches(self, device="cpu", dedup_next_obs=False):
+        """
+        One time-ordered FlexiBatch per env holding only the valid rows,
+        marked as such so agents can take n-step windows from it.
+        Truncation is folded into terminated so returns and GAE do not run
+        across episode boundaries. dedup_next_obs leaves obs_ out and keeps
+        only the episode end and last next observations (index shift mode,
+        see Util.next_obs).
+
+        Dropping the autoreset rows makes an env's batch shorter than
+        n_steps by one row per episode it finished. Every episode is at
+        least one step long, so each batch keeps at least n_steps // 2 rows.
+        Segments are never padded or merged because GAE would run across
+        the join; PG's reinforcement_learn takes a short final minibatch,
+        but use n_steps >= 2 * mini_batch_size if every minibatch has to
+        be full.
+        """
+        batches = []
+        for i in range(self.n_envs):
+            t_idx = np.nonzero(self.valid[:, i])[0]
+            assert (
+                len(t_idx) >= self.n_steps // 2
+            ), f"env {i} kept {len(t_idx)} of {self.n_steps} rows"
+            n_idx = np.full_like(t_idx, i)
+            term = np.maximum(self.terminated[t_idx, i], self.truncated[t_idx, i])
+            batch = self._batch(
+                t_idx, n_idx, term, self.truncated[t_idx, i], device, dedup_next_obs
+            )
+            batches.append(mark_time_ordered(batch))
+        return batches
+
+    def flat_batch(self, device="cpu"):
+        """
+        Every valid transition in a single FlexiBatch for off-policy agents.
+        terminated keeps only true terminations so truncated steps bootstrap.
+        Rows of different envs are interleaved, so for n_step > 1 use
+        env_batches or a TorchReplayBuffer instead.
+        """
+        t_idx, n_idx = np.nonzero(self.valid)
+        return self._batch(
+            t_idx,
+            n_idx,
+            self.terminated[t_idx, n_idx],
+            self.truncated[t_idx, n_idx],
+            device,
+        )
+
+
+class PipelinedRolloutCollector(RolloutCollector):
+    """
+    Splits the env fleet into two AsyncVectorEnv halves and alternates them so
+    that train_actions for one half runs while the other half's env.step is
+    executing in its worker processes:
+
+        act A(t), step_async A
+        act B(t), step_async B    <- overlaps with A stepping
+        wait A(t), act A(t+1), step_async A    <- overlaps with B stepping
+        wait B(t) ...
+
+    Only the abstract train_actions signature is used so every Agent works.
+    After each collect, overlap_efficiency is the fraction of env stepping
+    time that was hidden behind inference (1.0 means the envs never stalled
+    the learner) and wait_fraction is the share of wall time spent blocked
+    in step_wait.
+    """
+
+    def __init__(self, env_fns, agent: Agent, n_steps=128, **async_kwargs):
+        assert len(env_fns) >= 2, "Need at least 2 envs to pipeline two halves"
+        half = len(env_fns) // 2
+        self.envs = None
+        self.halves = [
+            (gym.vector.AsyncVectorEnv(env_fns[:half], **async_kwargs), slice(0, half)),
+            (
+                gym.vector.AsyncVectorEnv(env_fns[half:], **async_kwargs),
+                slice(half, len(env_fns)),
+            ),
+        ]
+        self._allocate(self.halves[0][0], agent, n_steps, len(env_fns))
+        self.overlap_efficiency = 0.0
+        self.wait_fraction = 0.0
+
+    def reset(self, seed=None):
+        for envs, sl in self.halves:
+            obs, _ = envs.reset(seed=None if seed is None else seed + sl.start)
+            self.obs[0, sl] = self._encode(obs)
+        self._next_obs = self.obs[0].copy()
+        self._prev_done[:] = False
+        self._ep_returns[:] = 0.0
+
+    def collect(self):
+        if self._next_obs is None:
+            self.reset()
+        start = time.perf_counter()
+        self.obs[0] = self._next_obs
+        busy = [0.0, 0.0]  # time from step_async until step_wait returns
+        wait_time = 0.0
+        sent = [0.0, 0.0]
+
+        def launch(h, t):
+            envs, sl = self.halves[h]
+            # one vector step is both halves, so only the second one counts
+            # towards the agent's step / eps / lr schedules
+            envs.step_async(self._act(t, sl, self.obs[t, sl], step=h == 1))
+            sent[h] = time.perf_counter()
+
+        def finish(h, t):
+            nonlocal wait_time
+            envs, sl = self.halves[h]
+            w = time.perf_counter()
+            obs_, rewards, terminated, truncated, _ = envs.step_wait()
+            done_at = time.perf_counter()
+            wait_time += done_at - w
+            busy[h] += done_at - sent[h]
+            self._record(t, sl, obs_, rewards, terminated, truncated)
+
+        launch(0, 0)
+        for t in range(self.n_steps):
+            launch(1, t)
+            finish(0, t)
+            if t + 1 < self.n_steps:
+                launch(0, t + 1)
+            finish(1, t)
+
+        wall = time.perf_counter() - start
+        self._next_obs = self.obs[-1].copy()
+        self.total_steps += self.n_steps * self.n_envs
+        self.last_sps = self.n_steps * self.n_envs / wall
+        env_time = sum(busy)
+        self.overlap_efficiency = (
+            (env_time - wait_time) / env_time if env_time > 0 else 0.0
+        )
+        self.wait_fraction = wait_time / wall
+        return self
+
+    def close(self):
+        for envs, _ in self.halves:
+            envs.close()
@@ -0,0 +1,90 @@
+import numpy as np
+import torch
+import gymnasium as gym
+from flexibuddiesrl.PG_stabalized import PG
+from flexibuddiesrl.DQN import DQN
+from flexibuddiesrl.Rollout import RolloutCollector, PipelinedRolloutCollector
+
+
+def make_env():
+    return gym.make("CartPole-v1")
+
+
+def make_envs(n_envs=4):
+    return gym.vector.SyncVectorEnv([make_env for _ in range(n_envs)])
+
+
+def make_dqn():
+    return DQN(
+        obs_dim=4, discrete_action_dims=[2], continuous_action_dims=0, hidden_dims=[32]
+    )
+
+
+def env_batches_test(verbose=False):
+    """Every per-env batch, short ones included, trains PPO without errors"""
+    envs = make_envs()
+    agent = PG(
+        obs_dim=4,
+        discrete_action_dims=[2],
+        continuous_action_dim=0,
+        hidden_dims=[32, 32],
+        mini_batch_size=64,
+    )
+    collector = RolloutCollector(envs, agent, n_steps=64)
+    collector.reset(seed=0)
+    passes, total = 0, 0
+    for _ in range(3):
+        for batch in collector.collect().env_batches():
+            total += 1
+            n = batch.global_rewards.shape[0]
+            losses = agent.reinforcement_learn(batch)
+            ok = n >= collector.n_steps // 2 and all(np.isfinite(losses))
+            passes += ok
+            if verbose or not ok:
+                print(f"{n} rows: losses {losses}")
+    envs.close()
+    # with 4 envs and CartPole's short random episodes some batches are short
+    print(f"RolloutCollector env_batches passed {passes}/{total}")
+    return passes == total
+
+
+def flat_batch_test(verbose=False):
+    """The flat batch holds exactly the valid rows and trains DQN"""
+    envs = make_envs()
+    agent = make_dqn()
+    collector = RolloutCollector(envs, agent, n_steps=32)
+    collector.reset(seed=0)
+    batch = collector.collect().flat_batch()
+    rows_ok = batch.global_rewards.shape[0] == collector.valid.sum()
+    losses = agent.reinforcement_learn(batch)
+    ok = rows_ok and all(np.isfinite(losses))
+    envs.close()
+    if verbose:
+        print(f"{collector.valid.sum()} valid rows, losses {losses}")
+    print(f"RolloutCollector flat_batch passed: {ok}")
+    return ok
+
+
+def pipelined_step_test(verbose=False):
+    """Both collectors advance agent.step once per vector step"""
+    n_steps = 16
+    plain, piped = make_dqn(), make_dqn()
+    envs = make_envs()
+    RolloutCollector(envs, plain, n_steps=n_steps).collect()
+    envs.close()
+    collector = PipelinedRolloutCollector([make_env] * 4, piped, n_steps=n_steps)
+    collector.collect()
+    collector.close()
+    ok = plain.step == piped.step == n_steps
+    if verbose or not ok:
+        print(f"RolloutCollector step {plain.step}, pipelined step {piped.step}")
+    print(f"PipelinedRolloutCollector agent.step passed: {ok}")
+    return ok
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    np.random.seed(0)
+    env_batches_test()
+    flat_batch_test()
+    pipelined_step_test()
@@ -2,7 +2,9 @@ import torch
 import torch.nn.functional as F
 import numpy as np
 from .Agent import Agent, MixedActor, ValueSA
-from .Util import T, get_multi_discrete_one_hot
+from .Util import T, get_multi_discrete_one_hot, n_step_targets, next_obs
+from .Checkpoint import save_training_state, load_training_state_file
+from .Instrumentation import Diagnostics, total_grad_norm
 from flexibuff import FlexiBatch
 import os
 import pickle
@@ -19,6 +21,7 @@ class TD3(Agent):
         action_noise=0.1,
         hidden_dims=np.array([256, 256]),
         gamma=0.99,
+        n_step=1,
         policy_frequency=2,
         target_update_percentage=0.01,
         name="Test_TD3",
@@ -44,6 +47,10 @@ class TD3(Agent):
             The hidden dimensions of the actor and critic
         gamma: float
             The discount factor
+        n_step: int
+            Steps of reward summed before bootstrapping. When this is more
+            than 1 batches must be time ordered (one env / episode stream) or
+            come from TorchReplayBuffer.for_agent, see Util.n_step_targets
         policy_frequency: int
             The frequency of policy updates
         target_update_percentage: float
@@ -88,6 +95,7 @@ class TD3(Agent):
         self.target_update_percentage = target_update_percentage
         self.rand_steps = rand_steps
         self.gamma = gamma
+        self.n_step = n_step
         self.policy_frequency = policy_frequency
         self.eval_mode = eval_mode
         self.name = name
@@ -200,16 +208,24 @@ class TD3(Agent):
         # print(noisyact)
         return noisyact
 
-    def _get_random_actions(self, action_mask=None, debug=False):
+    def _get_random_actions(self, action_mask=None, debug=False, batch_shape=()):
         continuous_actions = (
-            torch.rand(size=(self.continuous_action_dim,), device=self.device) * 2 - 1
+            torch.rand(
+                size=(*batch_shape, self.continuous_action_dim), device=self.device
+            )
+            * 2
+            - 1
         ) * self.actor.action_scales - self.actor.action_biases
         discrete_actions = torch.zeros(
-            (len(self.discrete_action_dims),), device=self.device, dtype=torch.long
+            (*batch_shape, len(self.discrete_action_dims)),
+            device=self.device,
+            dtype=torch.long,
         )
 
         for dim, dim_size in enumerate(self.discrete_action_dims):
-            discrete_actions[dim] = torch.randint(dim_size, (1,))
+            discrete_actions[..., dim] = torch.randint(
+                dim_size, batch_shape, device=self.device
+            )
         return discrete_actions, continuous_actions
 
     def train_actions(self, observations, action_mask=None, step=False, debug=False):
@@ -218,10 +234,12 @@ class TD3(Agent):
             print("    TD3 train_actions Observations: ", observations)
         if step:
             self.step += 1
+            if self.metrics is not None:
+                self.metrics.inc("env_steps", int(np.prod(observations.shape[:-1])))
 
         if self.step < self.rand_steps:
             discrete_actions, continuous_actions = self._get_random_actions(
-                action_mask, debug=debug
+                action_mask, debug=debug, batch_shape=observations.shape[:-1]
             )
 
             return (
@@ -231,6 +249,7 @@ class TD3(Agent):
                 None,
                 None,
             )
+        self.timer.start("forward")
         with torch.no_grad():
             continuous_actions, discrete_action_activations = self.actor(
                 x=observations, action_mask=action_mask, gumbel=True, debug=debug
@@ -282,7 +301,7 @@ class TD3(Agent):
             for i, activation in enumerate(discrete_action_activations):
                 if debug:
                     print("    TD3 train_actions activation: ", activation)
-                discrete_actions[i] = torch.argmax(activation, dim=-1)
+                discrete_actions[..., i] = torch.argmax(activation, dim=-1)
 
             if debug:
                 print(
@@ -290,8 +309,10 @@ class TD3(Agent):
                     discrete_actions,
                 )
 
+            self.timer.start("to_numpy")
             discrete_actions = discrete_actions.detach().cpu().numpy()
             continuous_actions_noisy = continuous_actions_noisy.detach().cpu().numpy()
+            self.timer.stop()
             return (
                 discrete_actions,
                 continuous_actions_noisy,
@@ -315,11 +336,18 @@ class TD3(Agent):
             target_param.data.copy_(tau * param.data + (1 - tau) * target_param.data)
 
     def reinforcement_learn(
-        self, batch: FlexiBatch, agent_num=0, critic_only=False, debug=False
+        self,
+        batch: FlexiBatch,
+        agent_num=0,
+        critic_only=False,
+        debug=False,
+        weights=None,  # per-sample importance weights, e.g. from prioritized replay
+        return_td_errors=False,  # also return |target - Q| per sample, shape [B]
     ):
         aloss_item = 0
         closs_item = 0
         self.rl_step += 1
+        self.timer.start("target")
         with torch.no_grad():
             if batch.action_mask is not None:
                 mask = batch.action_mask[agent_num]
@@ -327,8 +355,18 @@ class TD3(Agent):
             else:
                 mask = 1.0
                 mask_ = 1.0
+            rewards = batch.global_rewards
+            discount = self.gamma * (1 - batch.terminated)
+            obs_ = next_obs(batch, agent_num)
+            n_step = n_step_targets(batch, self.gamma, self.n_step)
+            if n_step is not None:
+                rewards, discount, last = n_step
+                if last is not None:
+                    obs_ = obs_[last]
+                    if torch.is_tensor(mask_):
+                        mask_ = mask_[last]
             continuous_actions_, discrete_action_activations_ = self.actor_target(
-                batch.obs_[agent_num], mask_, gumbel=True
+                obs_, mask_, gumbel=True
             )
             daa_ = discrete_action_activations_
             if len(discrete_action_activations_) == 1:
@@ -352,19 +390,18 @@ class TD3(Agent):
             if debug:
                 print("u_: ", u_, "shape: ", u_.shape)
             qtarget = torch.minimum(
-                self.critic1_target(x=batch.obs_[agent_num], u=u_),
-                self.critic2_target(x=batch.obs_[agent_num], u=u_),
+                self.critic1_target(x=obs_, u=u_),
+                self.critic2_target(x=obs_, u=u_),
             ).squeeze(-1)
             if debug:
                 print("TD3 reinforcement_learn qtarget: ", qtarget)
             # TODO configure reward channel beyong just global_rewards
-            next_q_value = (
-                batch.global_rewards + (1 - batch.terminated) * self.gamma * qtarget
-            )
+            next_q_value = rewards + discount * qtarget
             if debug:
                 print("TD3 reinforcement_learn next_q_value: ", next_q_value)
 
         # for each discrete action, get the one hot coding and concatinate them
+        self.timer.start("forward")
 
         actions = torch.cat(
             [
@@ -379,18 +416,35 @@ class TD3(Agent):
         )
         q1_values = self.critic1(batch.obs[agent_num], actions).squeeze(-1)
         q2_values = self.critic2(batch.obs[agent_num], actions).squeeze(-1)
-        qf1_loss = F.mse_loss(q1_values, next_q_value)
-        qf2_loss = F.mse_loss(q2_values, next_q_value)
+        self.timer.start("loss")
+        diag = Diagnostics() if self.diagnostics else None
+        if diag is not None:
+            diag.add_stats("q", q1_values)
+            diag.add("target_q_mean", next_q_value.mean())
+        if weights is None:
+            qf1_loss = F.mse_loss(q1_values, next_q_value)
+            qf2_loss = F.mse_loss(q2_values, next_q_value)
+        else:
+            qf1_loss = (weights * (q1_values - next_q_value) ** 2).mean()
+            qf2_loss = (weights * (q2_values - next_q_value) ** 2).mean()
         L = qf1_loss + qf2_loss
 
         # optimize the critic
+        self.timer.start("backward")
         self.critic_optimizer.zero_grad()
         L.backward()
+        self.timer.start("optimizer")
+        if diag is not None:
+            diag.add(
+                "critic_grad_norm",
+                total_grad_norm(self.critic_optimizer.param_groups[0]["params"]),
+            )
         self.critic_optimizer.step()
 
         if self.rl_step % self.policy_frequency == 0 and not critic_only:
+            self.timer.start("forward")
             c_act, d_act = self.actor(x=batch.obs[agent_num], action_mask=mask)
-
+            self.timer.start("loss")
             if len(d_act) == 1:
                 d_act = d_act[0]
             else:
@@ -398,15 +452,38 @@ class TD3(Agent):
             actor_loss = -self.critic1(
                 batch.obs[agent_num], torch.cat([c_act, d_act], dim=-1)
             ).mean()
+            self.timer.start("backward")
             self.actor_optimizer.zero_grad()
             actor_loss.backward()
+            self.timer.start("optimizer")
+            if diag is not None:
+                diag.add("actor_grad_norm", total_grad_norm(self.actor.parameters()))
             self.actor_optimizer.step()
 
             # update the target network
+            self.timer.start("target_update")
             self.polyak_update(self.target_update_percentage)
+            self.timer.start("to_numpy")
             aloss_item = actor_loss.item()
+            if self.metrics is not None:
+                self.metrics.set("actor_loss", aloss_item)
 
+        self.timer.start("to_numpy")
         closs_item = L.item()
+        if diag is not None:
+            self._publish_diagnostics(diag)
+        if self.metrics is not None:
+            self.metrics.inc("updates")
+            self.metrics.set("critic_loss", closs_item)
+        self.timer.step()
+        if return_td_errors:
+            td_errors = (
+                0.5
+                * (
+                    (q1_values - next_q_value).abs() + (q2_values - next_q_value).abs()
+                ).detach()
+            )
+            return aloss_item, closs_item, td_errors
         return aloss_item, closs_item
 
     def ego_actions(self, observations, action_mask=None):
@@ -415,26 +492,54 @@ class TD3(Agent):
                 observations, action_mask, gumbel=False
             )
             discrete_actions = torch.zeros(
-                (observations.shape[0], len(discrete_action_activations)),
+                (*observations.shape[:-1], len(discrete_action_activations)),
                 device=self.device,
                 dtype=torch.float32,
             )
             for i, activation in enumerate(discrete_action_activations):
-                discrete_actions[:, i] = torch.argmax(activation, dim=1)
+                discrete_actions[..., i] = torch.argmax(activation, dim=-1)
             return discrete_actions, continuous_actions
 
-    def imitation_learn(self, observations, continuous_actions, discrete_actions):
-        con_a, disc_a = self.actor.forward(observations, gumbel=False)
-        loss = F.mse_loss(con_a, continuous_actions) + F.cross_entropy(
-            disc_a, discrete_actions
+    def imitation_loss(
+        self,
+        observations,
+        continuous_actions=None,
+        discrete_actions=None,
+        action_mask=None,
+    ):
+        return self.actor.imitation_loss(
+            observations, continuous_actions, discrete_actions, action_mask
         )
-        self.actor_optimizer.zero_grad()
-        loss.backward()
-        self.actor_optimizer.step()
 
+    def _imitation_optimizer(self):
+        return self.actor_optimizer
+
+    def _imitation_step(self):
+        self.actor_optimizer.step()
         # update the target network
         self.polyak_update(self.target_update_percentage)
-        return loss
+
+    def imitation_learn(
+        self,
+        observations,
+        continuous_actions=None,
+        discrete_actions=None,
+        action_mask=None,
+        debug=False,
+    ):
+        dloss, closs = self.imitation_loss(
+            observations, continuous_actions, discrete_actions, action_mask
+        )
+        loss = dloss + closs
+        if torch.is_tensor(loss):  # no demonstrated actions leaves it at 0
+            self.actor_optimizer.zero_grad()
+            loss.backward()
+            self._imitation_step()
+        if torch.is_tensor(dloss):
+            dloss = dloss.item()
+        if torch.is_tensor(closs):
+            closs = closs.item()
+        return dloss, closs
 
     def utility_function(self, observations, actions=None):
         return 0  # Returns the single-agent critic for a single action.
@@ -502,6 +607,7 @@ class TD3(Agent):
             self._dump_attr(
                 self.__dict__[self.attrs[i]], checkpoint_path + f"/{self.attrs[i]}"
             )
+        save_training_state(self, checkpoint_path)
 
     def load(self, checkpoint_path):
         if checkpoint_path is None:
@@ -515,14 +621,14 @@ class TD3(Agent):
             np.array(self.discrete_action_dims)
         )
         if self.continuous_action_dim > 0:
-            self.min_actions = torch.from_numpy(np.array(self.min_actions)).to(
-                self.device
-            )
-            self.max_actions = torch.from_numpy(np.array(self.max_actions)).to(
-                self.device
-            )
+            # saved as tensors, the actor wants numpy and the agent torch
+            self.min_actions = np.array(torch.as_tensor(self.min_actions).cpu())
+            self.max_actions = np.array(torch.as_tensor(self.max_actions).cpu())
 
         self._get_torch_params()
+        if self.continuous_action_dim > 0:
+            self.min_actions = torch.from_numpy(self.min_actions).to(self.device)
+            self.max_actions = torch.from_numpy(self.max_actions).to(self.device)
 
         self.actor.load_state_dict(torch.load(checkpoint_path + "/actor"))
         self.actor_target.load_state_dict(torch.load(checkpoint_path + "/actor_target"))
@@ -534,6 +640,7 @@ class TD3(Agent):
         self.critic2_target.load_state_dict(
             torch.load(checkpoint_path + "/critic2_target")
         )
+        load_training_state_file(self, checkpoint_path)
 
 
 if __name__ == "__main__":
@@ -35,3 +35,205 @@ def minmaxnorm(data, mins, maxes):
 
 def normgrad(parameters, grad_clip=0.5):
     torch.nn.utils.clip_grad_norm_(parameters, grad_clip)
+
+
+def n_step_window(rewards, terminated, gamma, truncated=None, valid=None):
+    """
+    n-step returns of [B, n] windows, row b holding the steps t, t+1, ...
+    of one env / episode stream. valid masks the steps past the end of the
+    data, it has to be True for a prefix of each row. Each window stops
+    early at a termination, a truncation or the end of valid.
+
+    Returns (returns, discount, m) all of shape [B]:
+        returns[b] = sum_k gamma**k * r[b, k] over the window
+        discount[b] = gamma**m if the window did not end in a termination,
+            else 0
+        m[b] = the number of rewards summed, at least 1
+    """
+    k = torch.arange(rewards.shape[-1], device=rewards.device)
+    valid = torch.ones_like(rewards) if valid is None else valid.float()
+    term = terminated.float() * valid
+    stop = term
+    if truncated is not None:
+        stop = torch.maximum(term, truncated.float() * valid)
+    # step k is included only if nothing stopped the window before it
+    alive = torch.cumprod(
+        torch.cat([torch.ones_like(stop[:, :1]), 1 - stop[:, :-1]], dim=-1), dim=-1
+    )
+    alive = alive * valid
+    returns = (rewards.float() * alive * gamma**k).sum(-1)
+    m = alive.sum(-1)
+    hit_terminal = (term * alive).sum(-1) > 0
+    discount = gamma**m * (~hit_terminal).float()
+    return returns, discount, m.long()
+
+
+def n_step_returns(rewards, terminated, gamma, n, truncated=None):
+    """
+    Vectorized n-step returns over a time ordered batch (one env / episode
+    stream, e.g. from sample_episodes or RolloutCollector.env_batches).
+    Each window stops early at a termination, at a truncation or at the end
+    of the batch.
+
+    Returns (returns, discount, last) all of shape [T]:
+        returns[t] = sum_k gamma**k * r[t+k] over the window
+        discount[t] = gamma**m if the window did not end in a termination,
+            else 0, where m is the number of rewards summed
+        last[t] = t + m - 1, so obs_[last] is the state to bootstrap from
+    so the n-step target is returns + discount * Q(obs_[last]).
+    """
+    T_len = rewards.shape[0]
+    k = torch.arange(n, device=rewards.device)
+    idx = torch.arange(T_len, device=rewards.device).unsqueeze(-1) + k  # [T, n]
+    valid = idx < T_len
+    idx = idx.clamp(max=T_len - 1)
+    returns, discount, m = n_step_window(
+        rewards[idx],
+        terminated[idx],
+        gamma,
+        None if truncated is None else truncated[idx],
+        valid,
+    )
+    last = torch.arange(T_len, device=rewards.device) + m - 1
+    return returns, discount, last
+
+
+def mark_time_ordered(batch):
+    """
+    Flags a FlexiBatch whose rows are consecutive steps of one env / episode
+    stream (e.g. from FlexibleBuffer.sample_episodes), so agents with
+    n_step > 1 can build their windows from adjacent rows. Returns batch.
+    """
+    batch.time_ordered = True
+    return batch
+
+
+def n_step_targets(batch, gamma, n):
+    """
+    (rewards, discount, last) for the target rewards + discount * V(obs_[last])
+    or None for a one step target. Batches sampled with n-step windows
+    (TorchReplayBuffer with n_step) carry n_step_rewards and n_step_discount
+    and their obs_ already is the state to bootstrap from, last is None for
+    those. Otherwise n > 1 builds the windows from adjacent rows, which is
+    only correct for time ordered batches (see mark_time_ordered), anything
+    else, e.g. uniformly sampled replay, raises a ValueError.
+    """
+    discount = getattr(batch, "n_step_discount", None)
+    if discount is not None:
+        return batch.n_step_rewards, discount, None
+    if n <= 1:
+        return None
+    if not getattr(batch, "time_ordered", False):
+        raise ValueError(
+            f"n_step={n} needs n-step batches from TorchReplayBuffer(n_step=...) "
+            "or time ordered ones (RolloutCollector.env_batches, "
+            "mark_time_ordered), adjacent rows of this batch are not "
+            "consecutive steps"
+        )
+    return n_step_returns(
+        batch.global_rewards, batch.terminated, gamma, n, batch.truncated
+    )
+
+
+def next_obs(batch, agent_num=0, rows=None, name="obs_", obs_name="obs"):
+    """
+    batch.obs_[agent_num][rows] (all rows if rows is None) for any batch the
+    agents learn from, including time ordered batches in index shift mode.
+    Those leave obs_ out, which halves their observation memory. The next
+    observation of row t is then obs of row t + 1, except for the rows in
+    obs_terminal_rows [k] (episode ends and the last row) whose next
+    observations are kept in the side table obs_terminal [n_agents, k, ...].
+    """
+    obs_ = getattr(batch, name, None)
+    if obs_ is not None:
+        obs_ = obs_[agent_num]
+        return obs_ if rows is None else obs_[rows]
+    obs = getattr(batch, obs_name)[agent_num]
+    table = batch.obs_terminal[agent_num]
+    term_rows = batch.obs_terminal_rows
+    T_len = obs.shape[0]
+    if rows is None:
+        out = torch.cat([obs[1:], obs[-1:]])
+        out[term_rows] = table
+        return out
+    r = torch.as_tensor(rows, device=obs.device).reshape(-1) % T_len
+    # position of each row in the side table, -1 if it is not in it
+    pos = torch.full((T_len,), -1, dtype=torch.long, device=obs.device)
+    pos[term_rows] = torch.arange(term_rows.shape[0], device=obs.device)
+    p = pos[r]
+    shifted = obs[(r + 1).clamp(max=T_len - 1)]
+    keep = (p >= 0).reshape(-1, *[1] * (obs.dim() - 1))
+    out = torch.where(keep, table[p.clamp(min=0)], shifted)
+    if not torch.is_tensor(rows) and np.ndim(rows) == 0:
+        return out[0]
+    return out
+
+
+class ObsCodec:
+    """
+    Compact storage dtype for observations and the affine map back to
+    float32, obs = scale * q + offset:
+
+        codec = ObsCodec.uint8(low=0.0, high=255.0)  # pixels, 4x smaller
+        codec = ObsCodec.fp16()  # 2x smaller, no scaling
+        agent.set_obs_codec(codec)
+
+    Buffers store codec.encode(obs) and every network that reads
+    observations decodes them in its first layer with one addcmul, which
+    also does the cast, so observations stay compact until then. scale and
+    offset are scalars or per observation dim arrays.
+    """
+
+    def __init__(self, dtype=torch.uint8, scale=1.0, offset=0.0):
+        self.dtype = dtype
+        self.scale = torch.as_tensor(scale, dtype=torch.float32)
+        self.offset = torch.as_tensor(offset, dtype=torch.float32)
+        self.affine = bool((self.scale != 1).any() or (self.offset != 0).any())
+        self._on = {}
+
+    @classmethod
+    def uint8(cls, low=0.0, high=255.0):
+        """Quantizes [low, high] (scalars or per dim) to 256 levels"""
+        low = np.asarray(low, dtype=np.float32)
+        high = np.asarray(high, dtype=np.float32)
+        return cls(torch.uint8, (high - low) / 255.0, low)
+
+    @classmethod
+    def fp16(cls):
+        return cls(torch.float16)
+
+    @property
+    def numpy_dtype(self):
+        return torch.empty(0, dtype=self.dtype).numpy().dtype
+
+    def _params(self, device):
+        # scale and offset copied once per device
+        key = str(device)
+        if key not in self._on:
+            self._on[key] = (self.scale.to(device), self.offset.to(device))
+        return self._on[key]
+
+    def encode(self, x):
+        """float observations (numpy or torch) to the storage dtype"""
+        is_np = not torch.is_tensor(x)
+        t = torch.as_tensor(np.asarray(x) if is_np else x).float()
+        scale, offset = self._params(t.device)
+        if self.affine:
+            t = (t - offset) / scale
+        if not self.dtype.is_floating_point:
+            info = torch.iinfo(self.dtype)
+            t = t.round().clamp(info.min, info.max)
+        t = t.to(self.dtype)
+        return t.numpy() if is_np else t
+
+    def decode(self, q):
+        """Stored observations back to float32, one fused op"""
+        if not self.affine:
+            return q.float()
+        scale, offset = self._params(q.device)
+        return torch.addcmul(offset, q, scale)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_on"] = {}
+        return state
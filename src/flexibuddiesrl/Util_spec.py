@@ -0,0 +1,138 @@
+import copy
+import numpy as np
+import torch
+from flexibuff import FlexiBatch
+from flexibuddiesrl.Benchmark import benchmark_agents, synthetic_batch
+from flexibuddiesrl.Util import (
+    n_step_returns,
+    n_step_targets,
+    mark_time_ordered,
+    ObsCodec,
+)
+
+
+def n_step_returns_test(verbose=False):
+    """Windows stop at a termination, a truncation and the end of the batch"""
+    r = torch.tensor([1.0, 2.0, 3.0, 4.0, 5.0])
+    cases = [
+        # terminated inside the window: no bootstrap, last stays at the end
+        (
+            torch.tensor([0.0, 0.0, 1.0, 0.0, 0.0]),
+            None,
+            [1 + 0.5 * 2 + 0.25 * 3, 2 + 0.5 * 3, 3, 4 + 0.5 * 5, 5],
+            [0.0, 0.0, 0.0, 0.25, 0.5],
+            [2, 2, 2, 4, 4],
+        ),
+        # truncated inside the window: bootstrap from the truncated step
+        (
+            torch.zeros(5),
+            torch.tensor([0.0, 1.0, 0.0, 0.0, 0.0]),
+            [1 + 0.5 * 2, 2, 3 + 0.5 * 4 + 0.25 * 5, 4 + 0.5 * 5, 5],
+            [0.25, 0.5, 0.125, 0.25, 0.5],
+            [1, 1, 4, 4, 4],
+        ),
+    ]
+    passes = 0
+    for i, (term, trunc, returns, discount, last) in enumerate(cases):
+        got = n_step_returns(r, term, 0.5, 3, trunc)
+        ok = torch.allclose(got[0], torch.tensor(returns))
+        ok = ok and torch.allclose(got[1], torch.tensor(discount))
+        ok = ok and got[2].tolist() == last
+        passes += ok
+        if verbose or not ok:
+            print(f"case {i}: got {[g.tolist() for g in got]}")
+    print(f"n_step_returns passed {passes}/{len(cases)}")
+    return passes == len(cases)
+
+
+def n_step_targets_test(verbose=False):
+    """Only time ordered or presampled batches get n-step targets"""
+    batch = FlexiBatch(
+        registered_vals={"global_rewards": torch.ones(4)},
+        terminated=torch.zeros(4),
+        truncated=torch.zeros(4),
+    )
+    one_step = n_step_targets(batch, 0.9, 1) is None
+    try:
+        n_step_targets(batch, 0.9, 3)
+        raised = False
+    except ValueError:
+        raised = True
+    ordered = n_step_targets(mark_time_ordered(batch), 0.9, 3)
+    ordered_ok = torch.allclose(ordered[0][0], torch.tensor(1 + 0.9 + 0.81))
+    ok = one_step and raised and ordered_ok
+    if verbose:
+        print(f"one step {one_step}, unordered raised {raised}, ordered {ordered}")
+    print(f"n_step_targets passed: {ok}")
+    return ok
+
+
+def obs_codec_test(verbose=False):
+    """encode / decode round trips within half a quantization step"""
+    x = torch.rand(1000, 3) * torch.tensor([1.0, 10.0, 255.0])
+    u8 = ObsCodec.uint8(low=0.0, high=[1.0, 10.0, 255.0])
+    q = u8.encode(x)
+    step = torch.tensor([1.0, 10.0, 255.0]) / 255
+    error = (u8.decode(q) - x).abs()
+    ok = q.dtype == torch.uint8 and bool((error <= step / 2 + 1e-5).all())
+    on_np = u8.encode(x.numpy())
+    ok = ok and on_np.dtype == np.uint8 and np.array_equal(on_np, q.numpy())
+    f16 = ObsCodec.fp16()
+    ok = ok and torch.allclose(f16.decode(f16.encode(x)), x, rtol=1e-3)
+    if verbose or not ok:
+        print(f"max uint8 error {error.max(0).values}")
+    print(f"ObsCodec round trip passed: {ok}")
+    return ok
+
+
+def _with_obs(batch, f):
+    # FlexiBatch keeps obs in registered_vals, agents read them from there
+    names = ["obs", "obs_", "global_rewards", "discrete_actions"]
+    names += ["discrete_log_probs", "continuous_actions", "continuous_log_probs"]
+    rv = {k: getattr(batch, k) for k in names}
+    rv["obs"], rv["obs_"] = f(rv["obs"]), f(rv["obs_"])
+    return FlexiBatch(registered_vals=rv, terminated=batch.terminated)
+
+
+def set_obs_codec_test(verbose=False):
+    """An agent fed uint8 observations learns like one fed the float ones"""
+    codec = ObsCodec.uint8(low=0.0, high=1.0)
+    mixed = benchmark_agents(obs_dim=6, continuous_action_dim=2)
+    discrete = benchmark_agents(obs_dim=6, continuous_action_dim=0)
+    cases = [
+        ("DQN", mixed["DQN-egreedy"], 2),
+        ("PPO", discrete["PG-gae"], 0),
+        ("TD3", mixed["TD3"], 2),
+        ("DDPG", mixed["DDPG"], 2),
+    ]
+    passes = 0
+    for name, make, cdim in cases:
+        np.random.seed(0)
+        batch = synthetic_batch(64, 6, cdim, [3, 4])  # obs in [0, 1)
+        rounded = _with_obs(batch, lambda x: codec.decode(codec.encode(x)))
+        encoded = _with_obs(batch, codec.encode)
+        plain = make()
+        agents = [plain, copy.deepcopy(plain), copy.deepcopy(plain)]
+        agents[2].set_obs_codec(codec)
+        losses = []
+        for agent, b in zip(agents, [batch, rounded, encoded]):
+            torch.manual_seed(0)
+            np.random.seed(0)
+            losses.append(np.array(agent.reinforcement_learn(b), dtype=np.float64))
+        # decoding in the encoder is the same math as decoding beforehand
+        same = np.allclose(losses[2], losses[1], rtol=1e-4, atol=1e-6)
+        # and rounding obs to 1/255 barely moves the losses
+        close = np.allclose(losses[2], losses[0], rtol=1e-2, atol=1e-3)
+        ok = same and close and encoded.obs.dtype == torch.uint8
+        passes += ok
+        if verbose or not ok:
+            print(f"{name}: float {losses[0]}, rounded {losses[1]}, uint8 {losses[2]}")
+    print(f"set_obs_codec losses passed {passes}/{len(cases)}")
+    return passes == len(cases)
+
+
+if __name__ == "__main__":
+    n_step_returns_test()
+    n_step_targets_test()
+    obs_codec_test()
+    set_obs_codec_test()
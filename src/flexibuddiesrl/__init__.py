@@ -1,6 +1,124 @@
-from flexibuddiesrl.Agent import *
-from flexibuddiesrl.DDPG import *
-from flexibuddiesrl.TD3 import *
-from flexibuddiesrl.PG import *
-from flexibuddiesrl.DQN import *
-from flexibuddiesrl.Util import *
+import sys
+import types
+from importlib import import_module
+
+# Every public name and the module it lives in. Nothing is imported until a
+# name is first accessed (PEP 562), so `import flexibuddiesrl` does not pull
+# in torch, flexibuff or any algorithm and a worker that only needs DQN only
+# ever loads DQN and what it depends on.
+_exports = {
+    "flexibuddiesrl.Agent": [
+        "Agent",
+        "ffEncoder",
+        "MixedActor",
+        "StochasticActor",
+        "ValueSA",
+        "ValueS",
+        "QSCA",
+        "QSAA",
+        "QS",
+        "DuelingQSCA",
+        "DuelingQSAA",
+    ],
+    "flexibuddiesrl.DDPG": ["DDPG"],
+    "flexibuddiesrl.TD3": ["TD3"],
+    "flexibuddiesrl.PG": ["PG"],
+    "flexibuddiesrl.DQN": ["DQN", "dqntype"],
+    "flexibuddiesrl.Util": [
+        "T",
+        "get_multi_discrete_one_hot",
+        "minmaxnorm",
+        "normgrad",
+        "n_step_returns",
+        "n_step_window",
+        "n_step_targets",
+        "mark_time_ordered",
+        "next_obs",
+        "ObsCodec",
+    ],
+    "flexibuddiesrl.Rollout": ["RolloutCollector", "PipelinedRolloutCollector"],
+    "flexibuddiesrl.Replay": ["SumTree", "PrioritizedSampler", "TorchReplayBuffer"],
+    "flexibuddiesrl.Checkpoint": [
+        "agent_modules",
+        "agent_optimizers",
+        "rng_state",
+        "set_rng_state",
+        "training_state",
+        "load_training_state",
+        "save_training_state",
+        "load_training_state_file",
+        "snapshot",
+        "write_snapshot",
+        "save_checkpoint",
+        "save_async",
+        "read_checkpoint",
+        "load_checkpoint",
+        "load_snapshot",
+        "DeltaCheckpointer",
+    ],
+    "flexibuddiesrl.Hogwild": [
+        "SharedAdam",
+        "make_hogwild",
+        "train_hogwild",
+        "pg_rollout_worker",
+    ],
+    "flexibuddiesrl.Instrumentation": [
+        "PHASES",
+        "PhaseTimer",
+        "ActivationTracker",
+        "memory_report",
+        "Diagnostics",
+        "total_grad_norm",
+        "explained_variance",
+    ],
+    "flexibuddiesrl.CostModel": [
+        "forward_flops",
+        "param_count",
+        "agent_cost",
+        "cost_table",
+        "device_flops_per_s",
+        "predict_throughput",
+    ],
+    "flexibuddiesrl.Metrics": ["Metrics", "MetricsExporter"],
+    "flexibuddiesrl.Imitation": ["ImitationTrainer", "demonstrations"],
+    "flexibuddiesrl.OfflineDataset": [
+        "OfflineDataset",
+        "OfflineDatasetWriter",
+        "write_dataset",
+        "Prefetcher",
+    ],
+    # re-exported for code written against the old star imports
+    "flexibuff": ["FlexiBatch", "FlexibleBuffer"],
+}
+_name_to_module = {n: m for m, names in _exports.items() for n in names}
+__all__ = list(_name_to_module.keys())
+
+
+def __getattr__(name):
+    module = _name_to_module.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals().keys()) | set(__all__))
+
+
+class _LazyPackage(types.ModuleType):
+    # Importing a submodule binds it on the package, e.g. flexibuddiesrl.DQN
+    # would become the DQN module. Skip that for names that are also class
+    # exports so flexibuddiesrl.DQN stays the agent class like it always was.
+    def __setattr__(self, name, value):
+        if (
+            isinstance(value, types.ModuleType)
+            and value.__name__ == f"{__name__}.{name}"
+            and name in _name_to_module
+        ):
+            return
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _LazyPackage
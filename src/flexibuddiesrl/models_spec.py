@@ -331,9 +331,9 @@ if __name__ == "__main__":
     parser.add_argument(
         "--model",
         type=str,
-        choices=["DQN", "PG"],
+        choices=["DQN", "PG", "TD3", "DDPG", "all"],
         default="DQN",
-        help="Specify the model to test (DQN or PG).",
+        help="Specify the model to test, --hyperparams and --cost support DQN and PG, --performance all of them.",
     )
     parser.add_argument(
         "--hyperparams",
@@ -345,13 +345,64 @@ if __name__ == "__main__":
         action="store_true",
         help="Run performance tests for the specified model.",
     )
+    parser.add_argument(
+        "--cost",
+        action="store_true",
+        help="Print the static flop / parameter cost of every configuration of the specified model.",
+    )
+    parser.add_argument(
+        "--out",
+        type=str,
+        default=None,
+        help="Where to write the performance results as json.",
+    )
     args = parser.parse_args()
+    if (args.hyperparams or args.cost) and args.model not in ["DQN", "PG"]:
+        parser.error("--hyperparams and --cost only support --model DQN or PG")
 
     if args.hyperparams:
         print("Running hyperparameter tests...")
         test_hyperparams(args, verbose=args.debug)
+    if args.cost:
+        from flexibuddiesrl.CostModel import (
+            cost_table,
+            device_flops_per_s,
+            predict_throughput,
+        )
+
+        make_agents = {"DQN": dqn_agents, "PG": pg_agents}[args.model]
+        agents, agent_params = make_agents(3, 2, [4, 5, 6])
+        flops_per_s = device_flops_per_s(agents[0].device)
+        for row in cost_table(agents, agent_params):
+            tp = predict_throughput(row, flops_per_s)
+            print(
+                f"{row['index']}: params {row['params']}, train_actions {row['train_actions_flops']} flops/row, "
+                f"reinforcement_learn {row['reinforcement_learn_flops']} flops/sample "
+                f"(<= {tp['reinforcement_learn_samples_per_s']:.0f} samples/s), {row['config']}"
+            )
     if args.performance:
         print("Running performance tests...")
-        # Placeholder for performance tests
-        # You can implement specific performance tests here
-        pass
+        from flexibuddiesrl.Benchmark import (
+            benchmark_agents,
+            micro_benchmarks,
+            write_json,
+        )
+
+        agents = {
+            k: v
+            for k, v in benchmark_agents().items()
+            if args.model == "all" or k.split("-")[0] == args.model
+        }
+        results = micro_benchmarks(agents, verbose=args.debug)
+        for name, metrics in results["results"].items():
+            for metric, stats in metrics.items():
+                if "error" in stats:
+                    print(f"{name}.{metric}: {stats['error']}")
+                elif "unsupported" in stats:
+                    print(f"{name}.{metric}: unsupported, {stats['unsupported']}")
+                else:
+                    print(
+                        f"{name}.{metric}: p50 {stats['p50_ms']:.3f}ms p99 {stats['p99_ms']:.3f}ms"
+                    )
+        if args.out is not None:
+            write_json(results, args.out)